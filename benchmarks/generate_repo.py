@@ -0,0 +1,284 @@
+#!/usr/bin/python2
+#-*- coding: utf-8 -*-
+
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# (C) 2011 - Pierre-Yves Chibon <pingou@pingoured.fr>
+
+"""
+Generate a synthetic CRAN/Bioconductor sized set of repositories to
+benchmark the R-repo scripts without hitting the mirrors.
+
+The output directory receives:
+  - one folder per repository with its PACKAGES and PACKAGES.gz files,
+  - repos.cfg pointing to them through file:// urls,
+  - specs/, a folder of R-*.spec files for part of the packages, some of
+    them outdated,
+  - provided, the packages provided by R-core, one per line.
+
+The dependencies follow the usual shape of the R repositories: a few very
+popular packages used by almost everyone and a long tail of packages used
+by a handful, with some dependencies missing from the repositories, a few
+dependency cycles and some packages available in several repositories.
+"""
+
+import argparse
+import gzip
+import os
+import random
+import textwrap
+
+# Packages provided by R-core
+BASE_PACKAGES = ['compiler', 'grDevices', 'graphics', 'grid', 'methods',
+    'parallel', 'splines', 'stats', 'stats4', 'tcltk', 'tools', 'utils']
+
+# Repositories generated and the share of the packages they hold
+REPOSITORIES = [('cran', 0.8), ('bioconductor', 0.2)]
+
+# Maximum number of dependencies of each kind
+DEPENDENCY_FIELDS = [('Depends', 4), ('Imports', 8), ('LinkingTo', 2),
+    ('Suggests', 10)]
+
+SYLLABLES = ['ab', 'bio', 'clust', 'dat', 'ex', 'fit', 'gen', 'geo', 'gg',
+    'ist', 'kern', 'lm', 'map', 'mix', 'net', 'opt', 'plot', 'quant', 'rcpp',
+    'seq', 'spat', 'stat', 'surv', 'tab', 'tree', 'util', 'vis', 'wav', 'xy',
+    'zoo']
+
+
+def setup_parser():
+    """
+    Set the command line arguments.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('outdir',
+        help='Directory in which the repositories are generated.')
+    parser.add_argument('--packages', type=int, default=25000,
+        help='Number of packages to generate (defaults to %(default)s).')
+    parser.add_argument('--seed', type=int, default=42,
+        help='Seed of the random generator (defaults to %(default)s).')
+    parser.add_argument('--specs', type=float, default=0.5,
+        help='Share of the packages having a spec file (defaults to %(default)s).')
+    return parser
+
+
+def generate_names(rand, nb_packages):
+    """ Return nb_packages distinct package names looking like the R
+    ones, eg: ggplot, data.tab or survXY.
+    """
+    names = []
+    seen = set(BASE_PACKAGES)
+    while len(names) < nb_packages:
+        name = ''.join([rand.choice(SYLLABLES)
+            for _ in range(rand.randint(1, 3))])
+        if rand.random() < 0.1:
+            name = '%s.%s' % (name, rand.choice(SYLLABLES))
+        elif rand.random() < 0.2:
+            name = name + rand.choice(SYLLABLES).upper()
+        if len(name) < 3 or name in seen:
+            name = '%s%s' % (name, len(names))
+        if name in seen:
+            continue
+        seen.add(name)
+        names.append(name)
+    return names
+
+
+def generate_version(rand):
+    """ Return a random R version, eg: 1.2-3 or 0.10.1. """
+    version = '%s.%s' % (rand.randint(0, 3), rand.randint(0, 20))
+    if rand.random() < 0.5:
+        version = '%s-%s' % (version, rand.randint(0, 12))
+    elif rand.random() < 0.5:
+        version = '%s.%s' % (version, rand.randint(0, 9))
+    return version
+
+
+def pick_dependency(rand, names, cnt):
+    """ Return the name of a dependency of the cnt-th package: mostly one
+    of the most popular packages (the first ones) or a recent one,
+    sometimes a package of R-core and, for the packages of the long tail,
+    rarely a package missing from the repositories or a package coming
+    later (which may close a dependency cycle).
+    """
+    draw = rand.random()
+    if draw < 0.15 or cnt == 0:
+        return rand.choice(BASE_PACKAGES)
+    if cnt > len(names) / 10:
+        if draw < 0.152:
+            return 'archived%s' % rand.randint(0, 200)
+        if draw < 0.153:
+            return names[rand.randint(cnt, len(names) - 1)]
+    if draw < 0.6:
+        return names[(int(rand.paretovariate(1.1)) - 1) % cnt]
+    return names[rand.randint(max(0, cnt - 2000), cnt - 1)]
+
+
+def generate_records(nb_packages, seed):
+    """ Return the list of the package records of all the repositories:
+    dictionnaries of the fields of each package plus its 'repo'.
+    """
+    rand = random.Random(seed)
+    names = generate_names(rand, nb_packages)
+    records = []
+    for cnt, name in enumerate(names):
+        draw = rand.random()
+        for repo, share in REPOSITORIES:
+            if draw < share:
+                break
+            draw = draw - share
+        record = {'repo': repo, 'Package': name,
+            'Version': generate_version(rand)}
+        for field, maximum in DEPENDENCY_FIELDS:
+            # Most packages have few dependencies
+            nb_deps = min(int(rand.expovariate(3.0 / maximum)), maximum * 3)
+            deps = []
+            for _ in range(nb_deps):
+                dep = pick_dependency(rand, names, cnt)
+                if dep == name or dep in deps:
+                    continue
+                deps.append(dep)
+            if not deps:
+                continue
+            deps = [rand.random() < 0.3 and '%s (>= %s)' % (dep,
+                generate_version(rand)) or dep for dep in deps]
+            if field == 'Depends':
+                deps.insert(0, 'R (>= %s.%s.0)' % (rand.randint(2, 3),
+                    rand.randint(0, 15)))
+            record[field] = ', '.join(deps)
+        record['License'] = rand.choice(['GPL-2', 'GPL-3', 'GPL (>= 2)',
+            'MIT + file LICENSE', 'Artistic-2.0'])
+        record['MD5sum'] = '%032x' % rand.getrandbits(128)
+        record['NeedsCompilation'] = rand.choice(['yes', 'no', 'no'])
+        records.append(record)
+
+        # Some packages are available in several repositories
+        if rand.random() < 0.01:
+            duplicate = dict(record)
+            duplicate['repo'] = [repo_name for repo_name, _ in REPOSITORIES
+                if repo_name != repo][0]
+            duplicate['Version'] = generate_version(rand)
+            records.append(duplicate)
+    return records
+
+
+def format_record(record):
+    """ Return the given record as a paragraph of a PACKAGES file, the
+    long values being wrapped on continuation lines as R does.
+    """
+    lines = []
+    for field in ['Package', 'Version', 'Depends', 'Imports', 'LinkingTo',
+            'Suggests', 'License', 'MD5sum', 'NeedsCompilation']:
+        if field not in record:
+            continue
+        lines.extend(textwrap.wrap('%s: %s' % (field, record[field]),
+            width=72, subsequent_indent='        ', break_long_words=False,
+            break_on_hyphens=False))
+    return '\n'.join(lines) + '\n\n'
+
+
+def write_repositories(outdir, records):
+    """ Write the PACKAGES files of each repository and the repos.cfg
+    pointing to them.
+    """
+    config = open(os.path.join(outdir, 'repos.cfg'), 'w')
+    try:
+        for repo, _ in REPOSITORIES:
+            folder = os.path.join(outdir, repo)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            content = ''.join([format_record(record) for record in records
+                if record['repo'] == repo])
+            stream = open(os.path.join(folder, 'PACKAGES'), 'w')
+            try:
+                stream.write(content)
+            finally:
+                stream.close()
+            stream = gzip.open(os.path.join(folder, 'PACKAGES.gz'), 'wb')
+            try:
+                stream.write(content)
+            finally:
+                stream.close()
+            url = 'file://%s' % os.path.abspath(folder)
+            config.write('[repo:%s]\n' % repo)
+            config.write('url = %s/{name}.html\n' % url)
+            config.write('source = %s/%%{packname}_%%{version}.tar.gz\n' % url)
+            config.write('package = %s/PACKAGES\n\n' % url)
+    finally:
+        config.close()
+
+
+def write_specs(outdir, records, share, seed):
+    """ Write a spec file for the given share of the packages, a fifth of
+    them being at an older version than the upstream one.
+    """
+    rand = random.Random(seed)
+    folder = os.path.join(outdir, 'specs')
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    nb_specs = 0
+    for record in records:
+        if rand.random() >= share:
+            continue
+        version = record['Version'].replace('-', '.')
+        if rand.random() < 0.2:
+            version = '0.0.%s' % rand.randint(0, 9)
+        stream = open(os.path.join(folder, 'R-%s.spec' % record['Package']),
+            'w')
+        try:
+            stream.write('%%global packname  %s\n' % record['Package'])
+            stream.write('%global rlibdir  %{_datadir}/R/library\n\n')
+            stream.write('Name:             R-%{packname}\n')
+            stream.write('Version:          %s\n' % version)
+            stream.write('Release:          1%{?dist}\n')
+            stream.write('Source0:          %{packname}_%{version}.tar.gz\n')
+            stream.write('License:          %s\n\n' % record['License'])
+            stream.write('%description\n')
+            stream.write('Synthetic package %s.\n' % record['Package'])
+        finally:
+            stream.close()
+        nb_specs = nb_specs + 1
+    return nb_specs
+
+
+def generate(outdir, nb_packages=25000, seed=42, specs=0.5):
+    """ Generate the repositories, the spec folder and the list of the
+    packages provided by R-core in the given directory and return the
+    number of records and of spec files written.
+    """
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    records = generate_records(nb_packages, seed)
+    write_repositories(outdir, records)
+    nb_specs = write_specs(outdir, records, specs, seed)
+    stream = open(os.path.join(outdir, 'provided'), 'w')
+    try:
+        for name in BASE_PACKAGES:
+            stream.write(name + '\n')
+    finally:
+        stream.close()
+    return (len(records), nb_specs)
+
+
+def main():
+    """ Main function. """
+    args = setup_parser().parse_args()
+    nb_records, nb_specs = generate(args.outdir, args.packages, args.seed,
+        args.specs)
+    print '%s package records and %s specs written in %s' % (nb_records,
+        nb_specs, args.outdir)
+
+
+if __name__ == '__main__':
+    main()
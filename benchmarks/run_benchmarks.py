@@ -0,0 +1,345 @@
+#!/usr/bin/python2
+#-*- coding: utf-8 -*-
+
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# (C) 2011 - Pierre-Yves Chibon <pingou@pingoured.fr>
+
+"""
+Time the parsing, ordering, version checking and scheduling code of the
+R-repo scripts on the synthetic repositories of generate_repo.py and
+compare the timings with a stored baseline to catch regressions.
+
+    python benchmarks/run_benchmarks.py --save-baseline
+    (change the code)
+    python benchmarks/run_benchmarks.py
+
+The script exits with 1 if a benchmark got slower than the baseline by
+more than the tolerance.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'depgenerator'))
+sys.path.insert(0, os.path.join(HERE, '..'))
+import Rdepgenerator
+from check_spec_to_update import load_upstream_repo
+from generate_repo import generate
+from rrepo import version as rversion
+from rrepo.fetch import HttpCache
+from rrepo.graph import write_graph
+from rrepo.history import BuildHistory
+from rrepo.packages import clear_dependency_caches, iter_file_packages
+from rrepo.specs import SpecScanner
+from rrepo.version import get_newer
+
+# Differences of timing below this number of seconds are noise
+MIN_DELTA = 0.05
+
+# Mock configuration the dry-run builds are estimated for
+MOCK_CONFIG = 'epel-6-x86_64'
+
+
+def setup_parser():
+    """
+    Set the command line arguments.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data',
+        help='Directory of the synthetic repositories, generated if it does not exist (defaults to a temporary directory).')
+    parser.add_argument('--packages', type=int, default=25000,
+        help='Number of packages to generate (defaults to %(default)s).')
+    parser.add_argument('--seed', type=int, default=42,
+        help='Seed of the random generator (defaults to %(default)s).')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='Number of runs of each benchmark, the fastest one is kept (defaults to %(default)s).')
+    parser.add_argument('--baseline', default=os.path.join(HERE,
+        'baseline.json'),
+        help='File storing the baseline timings (defaults to %(default)s).')
+    parser.add_argument('--save-baseline', action='store_true',
+        help='Store the timings of this run as the new baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+        help='Slowdown relative to the baseline reported as a regression (defaults to %(default)s).')
+    return parser
+
+
+def measure(function, setup=None, repeat=3):
+    """ Run function repeat times and return the shortest duration and
+    the result of the last run. The output of the function is discarded.
+
+    :arg function, the function to time, called with the value returned
+    by setup if there is one.
+    :kwarg setup, a function called before each run, not timed.
+    :kwarg repeat, the number of runs.
+    """
+    best = None
+    result = None
+    devnull = open(os.devnull, 'w')
+    try:
+        for _ in range(repeat):
+            args = ()
+            if setup is not None:
+                args = (setup(),)
+            stdout = sys.stdout
+            sys.stdout = devnull
+            try:
+                start = time.time()
+                result = function(*args)
+                duration = time.time() - start
+            finally:
+                sys.stdout = stdout
+            if best is None or duration < best:
+                best = duration
+    finally:
+        devnull.close()
+    return (best, result)
+
+
+class Benchmarks(object):
+    """ The benchmarks, run in order as some reuse the results of the
+    previous ones.
+    """
+
+    def __init__(self, datadir, workdir, repeat=3):
+        """ Constructor.
+        :arg datadir, the directory generated by generate_repo.
+        :arg workdir, a directory in which the caches are created.
+        :kwarg repeat, the number of runs of each benchmark.
+        """
+        self.datadir = datadir
+        self.workdir = workdir
+        self.repeat = repeat
+        self.config = os.path.join(datadir, 'repos.cfg')
+        stream = open(os.path.join(datadir, 'provided'))
+        try:
+            self.provided = stream.read().split()
+        finally:
+            stream.close()
+        self.records = None
+        self.upstream = None
+        self.graph = None
+        self.rrepo = Rdepgenerator.Rrepo2rpm(self.config,
+            os.path.join(workdir, 'rrepo2rpm'))
+        self.rrepo.log.setLevel(logging.WARNING)
+
+    def parse_packages(self):
+        """ Parse the PACKAGES.gz files of the repositories. """
+        def parse():
+            records = []
+            for repo in sorted(os.listdir(self.datadir)):
+                path = os.path.join(self.datadir, repo, 'PACKAGES.gz')
+                if os.path.exists(path):
+                    records.extend(iter_file_packages(path, True))
+            return records
+        duration, self.records = measure(parse, repeat=self.repeat)
+        return duration
+
+    def parse_repo_packages(self):
+        """ Rrepo2rpm.__parse_repo_packages: the records into RPackage. """
+        def parse():
+            self.rrepo.packages = {}
+            self.rrepo._Rrepo2rpm__parse_repo_packages(self.records)
+            clear_dependency_caches()
+            return self.rrepo.packages
+        duration, self.packages = measure(parse, repeat=self.repeat)
+        return duration
+
+    def find_dependency_order(self):
+        """ Rrepo2rpm.__find_dependency_order on the parsed packages. """
+        def setup():
+            self.rrepo.packages = dict(self.packages)
+            self.rrepo.provided = list(self.provided)
+            self.rrepo.dependency_level = {}
+        def order(_):
+            self.rrepo._Rrepo2rpm__find_dependency_order()
+            return self.rrepo.dependency_level
+        duration, levels = measure(order, setup, self.repeat)
+        graph = {}
+        for level in levels.values():
+            for package in level:
+                graph[package.get('Package')] = package.get_dependencies()
+        self.graph = dict([(name, [dep for dep in deps if dep in graph])
+            for name, deps in graph.iteritems()])
+        return duration
+
+    def load_upstream_repo_cold(self):
+        """ check_spec_to_update.load_upstream_repo with an empty cache:
+        retrieval and indexing of the PACKAGES files.
+        """
+        def setup():
+            cachedir = tempfile.mkdtemp(dir=self.workdir)
+            return HttpCache(cachedir)
+        duration, _ = measure(lambda cache: load_upstream_repo(self.config,
+            cache), setup, self.repeat)
+        return duration
+
+    def load_upstream_repo_warm(self):
+        """ check_spec_to_update.load_upstream_repo with an up to date
+        cache and index.
+        """
+        cache = HttpCache(os.path.join(self.workdir, 'warm'))
+        measure(lambda: load_upstream_repo(self.config, cache), repeat=1)
+        duration, self.upstream = measure(lambda: load_upstream_repo(
+            self.config, cache), repeat=self.repeat)
+        return duration
+
+    def scan_specs(self):
+        """ SpecScanner.scan of the spec folder, without cache. """
+        def setup():
+            fd, cachefile = tempfile.mkstemp(dir=self.workdir)
+            os.close(fd)
+            os.unlink(cachefile)
+            return SpecScanner(cachefile)
+        duration, self.specs = measure(lambda scanner: scanner.scan(
+            os.path.join(self.datadir, 'specs')), setup, self.repeat)
+        return duration
+
+    def check_versions(self):
+        """ rrepo.version.get_newer of the specs against the upstream
+        versions, as check_spec_to_update does.
+        """
+        local = {}
+        for spec, info in self.specs.iteritems():
+            name = spec.rsplit('R-', 1)[1].rsplit('.spec', 1)[0]
+            if name in self.upstream and info['Version'] is not None:
+                local[name] = info['Version']
+        upstream = dict([(name, self.upstream[name]['Version'])
+            for name in local])
+        # Start without the memoized version keys, as a new process does
+        duration, _ = measure(lambda _: get_newer(local, upstream),
+            rversion._KEYS.clear, self.repeat)
+        return duration
+
+    def builder_dry_run(self):
+        """ Builder.build_graph in dry-run mode: estimation of the builds
+        from the history and simulation of the schedule.
+        """
+        try:
+            from multi_rpm_builder import Builder
+        except ImportError, err:
+            print 'builder_dry_run skipped: %s' % err
+            return None
+        filename = os.path.join(self.workdir, 'build_dependencies')
+        write_graph(filename, self.graph)
+        history = BuildHistory(os.path.join(self.workdir, 'history.sqlite'))
+        for cnt, name in enumerate(sorted(self.graph)[::10]):
+            history.record(name, MOCK_CONFIG, 60 + cnt % 600, 'succeed')
+        builder = Builder(16, dry_run=True)
+        builder.history.close()
+        builder.history = history
+        try:
+            duration, _ = measure(lambda: builder.build_graph(filename,
+                MOCK_CONFIG), repeat=self.repeat)
+        finally:
+            history.close()
+        return duration
+
+    def run(self):
+        """ Run all the benchmarks and return a dictionnary associating
+        their name to their duration, None for those which could not run.
+        """
+        results = {}
+        for name in ['parse_packages', 'parse_repo_packages',
+                'find_dependency_order', 'load_upstream_repo_cold',
+                'load_upstream_repo_warm', 'scan_specs', 'check_versions',
+                'builder_dry_run']:
+            results[name] = getattr(self, name)()
+            if results[name] is not None:
+                print '%-25s %8.3fs' % (name, results[name])
+        return results
+
+
+def load_baseline(filename):
+    """ Return the content of the baseline file, None if there is none. """
+    if not os.path.exists(filename):
+        return None
+    stream = open(filename)
+    try:
+        return json.load(stream)
+    finally:
+        stream.close()
+
+
+def save_baseline(filename, baseline):
+    """ Write the given baseline in the given file. """
+    stream = open(filename, 'w')
+    try:
+        json.dump(baseline, stream, indent=2, sort_keys=True)
+        stream.write('\n')
+    finally:
+        stream.close()
+
+
+def compare(results, baseline, tolerance):
+    """ Print the timings of this run next to the baseline ones and
+    return the list of the benchmarks which got slower by more than the
+    given tolerance.
+    """
+    regressions = []
+    print '\n%-25s %9s %9s %7s' % ('benchmark', 'baseline', 'now', 'ratio')
+    for name in sorted(results):
+        before = baseline.get(name)
+        now = results[name]
+        if before is None or now is None:
+            print '%-25s %9s %9s' % (name, before is None and '-' or
+                '%.3fs' % before, now is None and '-' or '%.3fs' % now)
+            continue
+        flag = ''
+        if now > before * (1 + tolerance) and now - before > MIN_DELTA:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print '%-25s %8.3fs %8.3fs %6.2fx%s' % (name, before, now,
+            now / max(before, 1e-6), flag)
+    return regressions
+
+
+def main():
+    """ Main function. """
+    args = setup_parser().parse_args()
+    workdir = tempfile.mkdtemp(prefix='rrepo-bench-')
+    try:
+        datadir = args.data or os.path.join(workdir, 'data')
+        if not os.path.exists(os.path.join(datadir, 'repos.cfg')):
+            print 'Generating %s packages in %s' % (args.packages, datadir)
+            generate(datadir, args.packages, args.seed)
+        results = Benchmarks(datadir, workdir, args.repeat).run()
+    finally:
+        shutil.rmtree(workdir)
+
+    baseline = load_baseline(args.baseline)
+    setup = {'packages': args.packages, 'seed': args.seed}
+    if baseline is not None:
+        if baseline['setup'] != setup:
+            print '\nThe baseline was run with %s, not comparing' % (
+                baseline['setup'])
+        elif compare(results, baseline['results'], args.tolerance):
+            if not args.save_baseline:
+                return 1
+    if args.save_baseline:
+        save_baseline(args.baseline, {'setup': setup, 'results': results})
+        print '\nBaseline saved in %s' % args.baseline
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
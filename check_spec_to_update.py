@@ -28,52 +28,31 @@ of the package to the screen.
 import ConfigParser
 import os
 import sys
-import urllib2
 
-from subprocess import Popen, PIPE
+from rrepo.fetch import HttpCache
+from rrepo.index import load_index
+from rrepo.packages import get_repos
+from rrepo.specs import SpecScanner
+from rrepo.version import get_newer
 
 
-def get_spec_version(specfile):
-    ''' Return the version of a package by greping its spec file.
-    :arg specfile, full path to the specfile to grep.
-    '''
-    version = Popen(["grep", "Version:", specfile], stdout=PIPE).stdout.read()[:-1]
-    return version.strip().split(' ')[-1:][0]
-
-
-def load_upstream_repo(config_file):
+def load_upstream_repo(config_file, cache=None):
     ''' Load all the R package information from upstream repository into
     a large dictionnary.
     :arg config_file, path to the repos.cfg containing information about
     the different upstream repository.
+    :kwarg cache, the rrepo.fetch.HttpCache through which the PACKAGES
+    files are retrieved, the default cache is used if None.
     '''
     parser = ConfigParser.ConfigParser()
     parser.read(config_file)
+    if cache is None:
+        cache = HttpCache()
+    index = load_index(get_repos(parser), cache)
     packages = {}
-    for section in parser.sections():
-        if section.startswith('repo:'):
-            url = parser.get(section, 'package')
-            stream = urllib2.urlopen(url)
-            content = stream.read()
-            stream.close()
-            upstream_packages = content.split('\n\n')
-            for upstream_package in upstream_packages:
-                if not upstream_package:
-                    continue
-                upstream_package = parseConfig(
-                    upstream_package.split('\n'))
-                #print upstream_package
-                upstream_package['version'] = upstream_package['version'
-                    ].replace('-', '.')
-                try:
-                    pack = packages[upstream_package['package']]
-                    if pack['version'].split('.') < upstream_package[
-                        'version'].split('.'):
-                        packages[upstream_package['package']
-                            ] = upstream_package
-                except KeyError:
-                    packages[upstream_package['package']
-                        ] = upstream_package
+    for upstream_package in index.iter_records():
+        packages[upstream_package['Package']] = upstream_package
+    index.close()
     print '%s packages loaded' % len(packages.keys())
     return packages
 
@@ -103,30 +82,32 @@ def main():
 
     packages = load_upstream_repo('depgenerator/repos.cfg')
 
-    filelist = os.listdir(folder)
-    spec_files = []
-    for filename in filelist:
-        if filename.endswith('.spec') and filename.startswith('R-'):
-            spec_files.append('%s/%s' % (folder, filename))
+    specs = SpecScanner().scan(folder)
 
-    cnt = 0
+    local = {}
     notfound = []
-    for spec in spec_files:
+    noversion = []
+    for spec, info in sorted(specs.iteritems()):
         name = spec.rsplit('R-', 1)[1].rsplit('.spec',1)[0]
-        version = get_spec_version(spec)
-        try:
-            upstream_version = packages[name]['version']
-        except KeyError:
+        if name not in packages:
             notfound.append(name)
             continue
-        version = version.split('.')
-        upstream_version = upstream_version.split('.')
-        if upstream_version > version:
-            cnt = cnt +1
-            print name
+        if info['Version'] is None:
+            noversion.append(spec)
+            continue
+        local[name] = info['Version']
+    upstream = dict([(name, packages[name]['Version']) for name in local])
+    outdated = get_newer(local, upstream)
+    for name in outdated:
+        print name
+    cnt = len(outdated)
     print '%s packages to update among %s packages' % (cnt,
-        len(spec_files))
+        len(specs))
     print '%s packages not found upstream' % len(notfound)
+    if noversion:
+        print '%s specs without a Version skipped:' % len(noversion)
+        for spec in noversion:
+            print '  %s' % spec
 
     stream = open('notfound.txt', 'w')
     for pkg in notfound:
@@ -134,34 +115,5 @@ def main():
     stream.close()
 
 
-def parseConfig(package):
-    ''' Returns a dictionnary of all the options available '''
-    COMMENT_CHAR = '#' # char for comments
-    OPTION_CHAR =  ':' # char used to separate option from value
-    
-    options = {}
-    for line in package:
-        # First, remove comments:
-        if COMMENT_CHAR in line:
-            # split on comment char, keep only the part before
-            line, comment = line.split(COMMENT_CHAR, 1)
-        # Second, find lines with an option=value:
-        if OPTION_CHAR in line:
-            # split on option char:
-            option, value = line.split(OPTION_CHAR, 1)
-            # strip spaces:
-            option = option.strip().lower()
-            value = value.strip()
-            # store in dictionary:
-            options[option] = value
-        else:
-            values = line.split(' ')
-            for value in values:
-                if value.strip() != '':
-                    options[option] += ' ' +value.strip()
-
-    return options
-
-
 if __name__ == '__main__':
     main()
@@ -23,45 +23,21 @@ Main functions for Rrepo2rpm
 
 import argparse
 import ConfigParser
+import json
 import logging
 import os
-import re
 import sys
-import urllib2
-from subprocess import Popen, PIPE
-from distutils.version import LooseVersion as V
+import tempfile
 
-
-def format_dependencies(dependencies):
-    """ Format the dependencies cleanning them as much as possible for rpm.
-    """
-    ignorelist = ['R']
-    # Regular expression used to determine whether the string is a
-    # version number
-    versionmotif = re.compile('\d\.\d\.?\d?')
-    char = {
-            '\r': '',
-            '(': ' ',
-            ')': ' ',
-            ',': ' ',
-            '  ': ' ',
-            }
-
-    for key in char.keys():
-        dependencies = dependencies.replace(key, char[key])
-    dep_list = []
-
-    for dep in dependencies.split(' '):
-        if dep.strip():
-            if  not ">" in dep \
-            and not "<" in dep \
-            and not "=" in dep \
-            and len(versionmotif.findall(dep)) == 0 \
-            and dep.strip() not in ignorelist:
-                dep = dep.strip()
-                dep_list.append(dep)
-
-    return dep_list
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..'))
+from rrepo.fetch import CACHE_DIR, HttpCache
+from rrepo.graph import dependency_levels, find_blockers, update_levels, \
+    write_graph
+from rrepo.index import load_index
+from rrepo.metrics import METRICS
+from rrepo.packages import RPackage, clear_dependency_caches, get_repos
+from rrepo.provides import ProvidesCache
 
 
 def get_logger():
@@ -82,8 +58,22 @@ def setup_parser():
         help='Whether you want to use all the dependencies (Depends, Suggests and Imports) or just the Depends and Imports (default)')
     parser.add_argument('--config', default='repos.cfg',
         help='A repo configuration files, it will use repos.cfg by default in the current working directory.')
+    parser.add_argument('--cache-dir', default=CACHE_DIR,
+        help='Directory in which the repositories metadata are cached (defaults to %s).' % CACHE_DIR)
+    parser.add_argument('--r-core-version', action='append',
+        help='[Epoch:]version-release of the R-core to plan against, the epoch defaulting to 0, can be given several times (defaults to the installed or available R-core).')
+    parser.add_argument('--r-core-primary',
+        help='A primary.xml(.gz) repository metadata file to read the provides of R-core from instead of using repoquery.')
+    parser.add_argument('--refresh-r-core', action='store_true',
+        help='Look for the installed or available R-core again instead of using the version found by the previous run.')
+    parser.add_argument('--full', action='store_true',
+        help='Order all the packages and write all the files again instead of updating the previous plan.')
     parser.add_argument('--exclude-rpm-dir',
         help='A path directory containing RPMs to be excluded from the list')
+    parser.add_argument('--metrics-json',
+        help='File to which the duration of each phase is appended as JSON lines.')
+    parser.add_argument('--metrics-textfile',
+        help='Prometheus textfile in which the duration of each phase is written.')
     parser.add_argument('--verbose', action='store_true',
         help='Give more info about what is going on.')
     parser.add_argument('--debug', action='store_true',
@@ -108,6 +98,73 @@ def write_package_list(filename, pkg_list):
         print er
 
 
+def load_plan_state(filename):
+    """ Return the plan saved in the file with the given filename by
+    save_plan_state, None if there is none or if it cannot be read.
+    """
+    log = get_logger()
+    if not os.path.exists(filename):
+        return None
+    stream = open(filename)
+    try:
+        state = json.load(stream)
+    except ValueError:
+        log.info('Could not read %s, ignoring it' % filename)
+        return None
+    finally:
+        stream.close()
+    if state.get('version') != STATE_VERSION:
+        return None
+    return state
+
+
+def save_plan_state(filename, state):
+    """ Atomically write the given plan in the file with the given
+    filename.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename) or '.',
+        suffix='.part')
+    stream = os.fdopen(fd, 'w')
+    try:
+        json.dump(state, stream)
+    finally:
+        stream.close()
+    os.rename(tmp, filename)
+
+
+def write_blocking_report(filename, causes, pkg_names):
+    """ Write in the file with the given filename the root causes
+    preventing the given packages from being built, starting with those
+    blocking the most packages, and for each package the causes blocking
+    it.
+    """
+    log = get_logger()
+    blockers = dict([(pkg_name, []) for pkg_name in pkg_names])
+    stream = open(filename, 'w')
+    try:
+        stream.write('# %s packages could not be built\n' % len(pkg_names))
+        stream.write('# Root causes, by number of packages blocked\n')
+        for kind, names, blocked in causes:
+            cause = '%s %s' % (kind, ' '.join(names))
+            stream.write('%s: %s packages blocked\n' % (cause, len(blocked)))
+            for pkg_name in blocked:
+                blockers[pkg_name].append(cause)
+        stream.write('\n# Packages and the root causes blocking them\n')
+        for pkg_name in pkg_names:
+            stream.write('%s: %s\n' % (pkg_name,
+                ', '.join(blockers[pkg_name])))
+    finally:
+        stream.close()
+    log.info('%s written' % filename)
+    for kind, names, blocked in causes[:5]:
+        log.info('%s %s blocks %s packages' % (kind, ' '.join(names),
+            len(blocked)))
+
+
+# File of the output directory keeping the plan of the previous run
+STATE_FILE = '.plan_state.json'
+STATE_VERSION = 1
+
 # Initial simple logging stuff
 LOG = get_logger()
 if '--debug' in sys.argv:
@@ -117,62 +174,6 @@ elif '--verbose' in sys.argv:
 
 
 
-class RPackage(object):
-    """
-    This is the object used to store the information known about a package.
-    """
-    def __init__(self):
-        """ Constructor. """
-        self.__dict = {}
-
-    def set(self, key, value):
-        """ Set an attribute with a given value to the object.
-        If the key is in 'Suggests', 'Depends', 'Imports' we will directly
-        format the value the way we want them.
-        """
-        if key in ['Suggests', 'Depends', 'Imports']:
-            if key in self.__dict.keys():
-                self.__dict[key].extend(format_dependencies(value))
-            else:
-                self.__dict[key] = format_dependencies(value)
-        else:
-            if key in self.__dict.keys():
-                self.__dict[key] = self.__dict[key] + value
-            else:
-                self.__dict[key] = value
-
-    def get(self, key):
-        """ Returned the requested attribute attributed to the given key.
-        """
-        if key in self.__dict.keys():
-            return self.__dict[key]
-        else:
-            return None
-
-    def get_dependencies(self, all_included=False):
-        """ Returned the list of 'Depends'. If all_included is True,
-        expend this list with 'Suggests' and 'Imports'.
-        """
-        dep = []
-        if 'Depends' in self.__dict.keys():
-            dep.extend(self.__dict['Depends'])
-        if 'Imports' in self.__dict.keys():
-            dep.extend(self.__dict['Imports'])
-        if all_included:
-            if 'Suggests' in self.__dict.keys():
-                dep.extend(self.__dict['Suggests'])
-        return dep
-
-    def __str__(self):
-        """ Give us a nice representation of the object when needed for
-        debugging.
-        """
-        string = ''
-        for key in self.__dict.keys():
-            string = string + '%s: %s\n' %(key, self.__dict[key])
-        return string
-
-
 class Rrepo2rpm(object):
     """ Main class for the project Rrepo2rpm.
     This class provides the functions to
@@ -182,7 +183,7 @@ class Rrepo2rpm(object):
     4) generate the output.
     """
 
-    def __init__(self, config='repos.cfg'):
+    def __init__(self, config='repos.cfg', cachedir=CACHE_DIR):
         """ Constructor.
         Instanciate the attributes of the object, loads the configuration
         file and generate the logger.
@@ -190,74 +191,112 @@ class Rrepo2rpm(object):
         parser = ConfigParser.ConfigParser()
         parser.read(config)
         self.config = parser
+        self.cache = HttpCache(cachedir)
 
         self.log = get_logger()
         self.log.setLevel(logging.INFO)
-        if args.debug:
+        if '--debug' in sys.argv:
             self.log.setLevel(logging.DEBUG)
 
         self.known = []
         self.provided = []
         self.packages = {}
         self.dependency_level = {}
+        self.graph = {}
+        self.levels = {}
+        self.dirty = None
 
-    def __find_dependency_order(self, all_dep=False, cnt = 0):
+    def __find_dependency_order(self, all_dep=False, previous=None):
         """ For all packages found, determine in which order it should
         be built.
-        """
-        start = len(self.packages.keys())
-
-        if cnt not in self.dependency_level.keys():
-            self.dependency_level[cnt] = []
 
-        known = self.provided[:]
-        known.extend(self.known)
-        for el in self.dependency_level.values():
-            for pkg in el:
-                known.append(pkg.get('Package'))
+        This is a Kahn-style topological sort (see
+        rrepo.graph.dependency_levels): a package lands on the level right
+        after the highest level of its dependencies, packages never
+        becoming buildable are left in self.packages as they have missing
+        dependencies.
+        With the plan of the previous run (see load_plan_state), only the
+        packages whose dependencies changed and those depending on them
+        are ordered again (see rrepo.graph.update_levels).
+        """
+        base = set(self.provided)
+        base.update(self.known)
 
         for pkg_name in self.packages.keys():
             if pkg_name in self.provided:
                 self.log.debug('%s is already provided' % pkg_name)
                 del self.packages[pkg_name]
-            elif pkg_name in self.dependency_level.values():
-                self.log.error('% is present twice, something wrong happened' \
-                    % pkg_name)
-                sys.exit(1)
-            else:
-                package = self.packages[pkg_name]
-                dep = set(package.get_dependencies(all_dep))
-                tmpknown = set(known)
-                if dep.issubset(tmpknown):
-                    self.dependency_level[cnt].append(package)
-                    del self.packages[pkg_name]
-        
-        stop = len(self.packages.keys())
-        self.log.info('Loop: %s, started with %s and ending with %s (added %s)' % (
-            cnt, start, stop, start - stop))
-        if start != stop:
-            self.__find_dependency_order(all_dep=all_dep, cnt = cnt + 1)
+
+        self.graph = dict([(pkg_name, sorted(set(
+            package.get_dependencies(all_dep))))
+            for pkg_name, package in self.packages.iteritems()])
+        self.dirty = None
+        if previous is not None and previous['all_dep'] == all_dep \
+                and previous['base'] == sorted(base):
+            self.levels, self.dirty = update_levels(self.graph, base,
+                previous['graph'], previous['levels'])
+            self.log.info('Incremental plan: %s packages ordered again' % (
+                len(self.dirty)))
         else:
-            self.log.info('Could not add any more packages to buid, stopping')
-            del self.dependency_level[cnt]
-            self.log.info('%s packages are provided' % len(self.provided))
-            cnt = sum([len(el) for el in self.dependency_level.values()])
-            self.log.info('%s packages can be built' % cnt)
-            self.log.info('%s packages had missing dependencies' % len(
-                self.packages.keys()))
-
-    def __get_provided_library(self):
+            self.levels = dict(dependency_levels(self.graph, base))
+        for pkg_name, cnt in sorted(self.levels.iteritems()):
+            self.dependency_level.setdefault(cnt, []).append(
+                self.packages.pop(pkg_name))
+
+        for cnt in sorted(self.dependency_level.keys()):
+            self.log.info('Level: %s, %s packages' % (cnt,
+                len(self.dependency_level[cnt])))
+        self.log.info('Could not add any more packages to buid, stopping')
+        self.log.info('%s packages are provided' % len(self.provided))
+        cnt = sum([len(el) for el in self.dependency_level.values()])
+        self.log.info('%s packages can be built' % cnt)
+        self.log.info('%s packages had missing dependencies' % len(
+            self.packages))
+
+    def __get_plan_state(self, all_dep=False):
+        """ Return the plan computed, to be saved with save_plan_state. """
+        base = set(self.provided)
+        base.update(self.known)
+        return {'version': STATE_VERSION, 'all_dep': all_dep,
+            'base': sorted(base), 'graph': self.graph,
+            'levels': self.levels}
+
+    def __find_blockers(self, all_dep=False):
+        """ For the packages which could not be built, find the root
+        causes preventing them from being built: dependencies missing from
+        the repositories and dependency cycles, as returned by
+        rrepo.graph.find_blockers.
+        """
+        available = set(self.provided)
+        available.update(self.known)
+        for level in self.dependency_level.values():
+            available.update([pkg.get('Package') for pkg in level])
+        graph = dict([(pkg_name, package.get_dependencies(all_dep))
+            for pkg_name, package in self.packages.iteritems()])
+        causes = find_blockers(graph, available)
+
+        missing = set()
+        cycles = set()
+        for kind, names, _ in causes:
+            if kind == 'missing':
+                missing.update([pkg_name for pkg_name in graph
+                    if names[0] in graph[pkg_name]])
+            else:
+                cycles.update(names)
+        self.log.info('%s packages have a missing dependency' % len(missing))
+        self.log.info('%s packages are part of a dependency cycle' % len(
+            cycles - missing))
+        self.log.info('%s packages are blocked by another package' % len(
+            set(graph) - missing - cycles))
+        return causes
+
+    def __get_provided_library(self, evrs=None, primary=None,
+            refresh=False):
         """
         This function returns the list of R libraries provided by the
-        R-core rpm.
+        R-core rpm, for each of the given R-core versions.
         """
-        cmd = ['repoquery', '--provides', 'R-core', '--disablerepo=r-repo']
-        self.log.debug(cmd)
-        provided = Popen(cmd, stdout=PIPE).stdout.read()
-        self.provided = []
-        for prov in provided.split('\n'):
-            if prov.startswith('R-'):
-                self.provided.append(prov.split(' ')[0].split('R-')[1])
+        return ProvidesCache(self.cache.root).resolve(evrs, primary, refresh)
 
     def __load_rpm_from_dir(self, directory):
         """
@@ -278,61 +317,23 @@ class Rrepo2rpm(object):
         1) it is the latest version
         2) they are not already provided
         """
-        repo = None
-        version = None
-        for section in self.config.sections():
-            if section.startswith('repo:'):
-                url = self.config.get(section, 'package')
-                self.log.debug('Parsing repo: %s' % section)
-                try:
-                    stream = urllib2.urlopen(url)
-                    content = stream.read()
-                    stream.close()
-                    self.__parse_repo_packages(section, content)
-                    self.log.debug('%s done' % section)
-                except IOError, err:
-                    self.log.info('Something went wrong while retrieving info for repo %s'
-                        % url)
-                    self.log.debug('ERROR: %s' % err)
+        index = load_index(get_repos(self.config), self.cache)
+        self.__parse_repo_packages(index.iter_records())
+        index.close()
+        clear_dependency_caches()
         self.log.info('TOTAL: %s packages retrieved' % (len(self.packages.keys())))
 
-    def __parse_repo_packages(self, repo, content):
+    def __parse_repo_packages(self, records):
         """
-        This function receive the content of a PACKAGES file from a repo
-        and parse it to extract all packages and their information.
+        This function receive the package records of the index of the
+        repositories and convert them into RPackage objects.
         """
-        cnt = 0
-        for line in content.split('\n'):
-            if line.strip() != '':
-                if ':' in line:
-                    key, value = line.split(':')
-                    key = key.strip()
-                else:
-                    value = line.strip()
-                value = value.strip()
-                if key == 'Package':
-                    cnt = cnt + 1
-                    package = RPackage()
-                    package.set('repo', repo)
-                    package.set(key, value)
-                else:
-                    package.set(key, value)
-            else:
-                name = package.get('Package')
-                if name not in self.packages.keys():
-                    self.log.debug('Adding package: %s'  % (name))
-                    self.packages[name] = package
-                else:
-                    self.log.debug('%s already retrieved' % (name))
-                    old_pkg = self.packages[name]
-                    self.log.debug('  repo %s vs %s' % (old_pkg.get('repo'),
-                        package.get('repo')))
-                    old_version = old_pkg.get('Version').replace('-', '.')
-                    new_version = package.get('Version').replace('-', '.')
-                    if V(old_version) < V(new_version):
-                        self.log.debug('    Using %s version which is newer' % package.get('repo'))
-                        self.packages[name] = package
-        self.log.debug('%s packages retrieved' % (cnt))
+        for record in records:
+            package = RPackage()
+            for key, value in record.iteritems():
+                package.set(key, value)
+            self.log.debug('Adding package: %s'  % (record['Package']))
+            self.packages[record['Package']] = package
 
     def main(self, args):
         """
@@ -340,32 +341,116 @@ class Rrepo2rpm(object):
         """
         if args.exclude_rpm_dir:
             self.__load_rpm_from_dir(args.exclude_rpm_dir)
-        self.__get_provided_library()
-        self.__load_repos()
-        self.__find_dependency_order(all_dep=args.all_dep)
-        self.__generate_output()
-
-    def __generate_output(self):
-        """ Write down to file the information we have collected.
+        with METRICS.span('provides'):
+            provides = self.__get_provided_library(args.r_core_version,
+                args.r_core_primary, args.refresh_r_core)
+        with METRICS.span('load'):
+            self.__load_repos()
+        packages = self.packages
+        for evr in sorted(provides):
+            self.log.info('Planning against R-core %s' % evr)
+            self.provided = sorted(provides[evr])
+            self.packages = dict(packages)
+            self.dependency_level = {}
+            outdir = '.'
+            if len(provides) > 1:
+                outdir = 'R-core-%s' % evr
+            statefile = os.path.join(outdir, STATE_FILE)
+            previous = None
+            if not args.full:
+                previous = load_plan_state(statefile)
+            with METRICS.span('ordering', r_core=evr):
+                self.__find_dependency_order(args.all_dep, previous)
+            if self.dirty is None:
+                previous = None
+            with METRICS.span('output', r_core=evr):
+                self.__generate_output(outdir, args.all_dep, previous)
+                if self.dirty is None or self.dirty:
+                    save_plan_state(statefile,
+                        self.__get_plan_state(args.all_dep))
+
+    def __generate_output(self, outdir='.', all_dep=False, previous=None):
+        """ Write down to file the information we have collected, in
+        the given directory.
+        With the plan of the previous run, whose files are in this
+        directory, only the files which changed are written.
         """
-        filename = 'package_with_missing_dependencies'
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        old_levels = {}
+        if previous is not None:
+            old_levels = previous['levels']
+
         keys = self.packages.keys()
         keys.sort()
-        pkgs = [self.packages[key] for key in keys]
-        write_package_list(filename, pkgs)
-
-        for level in self.dependency_level.keys():
-            filename = 'level_%s_packages' % level
+        filename = os.path.join(outdir, 'package_with_missing_dependencies')
+        report = os.path.join(outdir, 'blocking_report')
+        # The causes blocking a package only depend on the packages it
+        # depends on, which are all re-ordered if one of them changed
+        if previous is None or not os.path.exists(filename) \
+                or not os.path.exists(report) \
+                or set(keys) != set(previous['graph']).difference(old_levels) \
+                or [key for key in keys if key in self.dirty]:
+            pkgs = [self.packages[key] for key in keys]
+            write_package_list(filename, pkgs)
+            write_blocking_report(report, self.__find_blockers(all_dep),
+                keys)
+
+        old_members = {}
+        for pkg_name, level in old_levels.iteritems():
+            if pkg_name not in self.known:
+                old_members.setdefault(level, set()).add(pkg_name)
+        written = 0
+        unchanged = 0
+        for level in set(old_members).union(self.dependency_level):
+            filename = os.path.join(outdir, 'level_%s_packages' % level)
             pkgs = []
-            for pkg in self.dependency_level[level]:
+            for pkg in self.dependency_level.get(level, []):
                 if pkg.get('Package') not in self.known:
                     pkgs.append(pkg)
-            self.known.sort()
+            if not pkgs and level not in self.dependency_level:
+                # The level does not exist anymore
+                if os.path.exists(filename):
+                    os.unlink(filename)
+                continue
+            if previous is not None and os.path.exists(filename) \
+                    and old_members.get(level, set()) == set(
+                        [pkg.get('Package') for pkg in pkgs]):
+                unchanged = unchanged + 1
+                continue
             write_package_list(filename, pkgs)
+            written = written + 1
+        self.known.sort()
+        self.log.info('%s level files written, %s unchanged' % (written,
+            unchanged))
+
+        # The dependencies between the packages to build, for
+        # multi_rpm_builder --graph
+        filename = os.path.join(outdir, 'build_dependencies')
+        if previous is not None and os.path.exists(filename) \
+                and set(self.levels) == set(old_levels) \
+                and not [pkg_name for pkg_name in self.dirty
+                    if pkg_name in self.levels]:
+            return
+        graph = {}
+        for level in self.dependency_level.values():
+            for pkg in level:
+                if pkg.get('Package') not in self.known:
+                    graph[pkg.get('Package')] = pkg.get_dependencies(all_dep)
+        for name in graph:
+            graph[name] = set([dep for dep in graph[name] if dep in graph])
+        write_graph(filename, graph)
+        self.log.info('%s written' % filename)
 
 
 if __name__ == '__main__':
     parser = setup_parser()
     args = parser.parse_args()
-    rrepo = Rrepo2rpm(args.config)
-    rrepo.main(args)
+    METRICS.configure('Rdepgenerator', args.metrics_json,
+        args.metrics_textfile)
+    try:
+        with METRICS.span('total'):
+            rrepo = Rrepo2rpm(args.config, args.cache_dir)
+            rrepo.main(args)
+    finally:
+        METRICS.close()
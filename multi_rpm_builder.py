@@ -28,6 +28,17 @@ import sys
 from datetime import datetime
 from multiprocessing import Pool
 from r2spec.r2spec_obj import R2rpm, setup_parser as r2spec_parser
+from rrepo.graph import read_graph
+from rrepo.history import BuildHistory, get_arch
+from rrepo.metrics import METRICS
+from rrepo.mockroot import prepare_root
+from rrepo.resources import Admission, DISK_RESERVE, MEGABYTE, \
+    MEMORY_RESERVE
+from rrepo.scheduler import DagScheduler, ResultFiles, \
+    get_queue_priorities, print_simulation
+
+# Directory in which mock writes the results of the builds
+RESULT_DIR = '/data/mock/results/'
 
 def setup_parser():
     """
@@ -39,8 +50,28 @@ def setup_parser():
         help='Input file containing the rpm to build.')
     parser.add_argument('--mock-config', default='fedora-rawhide-i386',
         help='Mock configuration to use (defaults to fedora-rawhide-i386).')
+    parser.add_argument('--graph', action='store_true',
+        help='The input file is the build_dependencies file written by Rdepgenerator, each package is built as soon as its dependencies are.')
+    parser.add_argument('--dry-run', action='store_true',
+        help='Do not build anything, estimate how long the builds would take from the previous builds.')
+    parser.add_argument('--no-warm-root', action='store_true',
+        help='Let mock create a new chroot for each build instead of reusing one chroot per worker.')
+    parser.add_argument('--max-load', type=float,
+        help='Do not start new builds while the load average is above this value (defaults to twice the number of cores).')
+    parser.add_argument('--memory-reserve', type=int,
+        default=MEMORY_RESERVE / MEGABYTE,
+        help='Memory in MiB to keep free when starting builds (defaults to %(default)s).')
+    parser.add_argument('--disk-reserve', type=int,
+        default=DISK_RESERVE / MEGABYTE,
+        help='Space in MiB to keep free in the results directory when starting builds (defaults to %(default)s).')
+    parser.add_argument('--no-admission', action='store_true',
+        help='Start as many builds as there are cores, whatever the memory, disk and load of the machine.')
     parser.add_argument('--ncores', type=int,
         help='Number of cores to use (all by default)')
+    parser.add_argument('--metrics-json',
+        help='File to which the metrics of each build are appended as JSON lines.')
+    parser.add_argument('--metrics-textfile',
+        help='Prometheus textfile in which the metrics of the builds are written.')
     parser.add_argument('--verbose', action='store_true',
         help='Give more info about what is going on.')
     parser.add_argument('--debug', action='store_true',
@@ -48,7 +79,7 @@ def setup_parser():
     return parser
 
 
-def build_rpm(packagename, mock_config):
+def build_rpm(packagename, mock_config, warm_root=True):
     r2specparser = r2spec_parser('R2rpm')
     arg = r2specparser.parse_args('')
     arg.package = packagename
@@ -58,7 +89,9 @@ def build_rpm(packagename, mock_config):
     #arg.mock_config = mock_config
     #arg.mock_config = 'epel-6-x86_64'
     arg.mock_config = 'epel-6-i386'
-    arg.mock_resultdir = '/data/mock/results/'
+    if warm_root:
+        arg.mock_config = prepare_root(arg.mock_config)
+    arg.mock_resultdir = RESULT_DIR
     arg.keep_logs = True
     return R2rpm().main(arg)
 
@@ -67,16 +100,39 @@ class Builder(object):
     """ This is the class that does most of the work.
     """
 
-    def __init__(self, ncores=None):
+    def __init__(self, ncores=None, dry_run=False, warm_root=True,
+            limits=None):
         """ Constructor.
         Instanciate the attributes (including the pool to which the 
         tasks are assigned).
+        In dry_run mode, no build is run, the time they would take is
+        estimated from the history of the previous builds.
+        With warm_root, each worker reuses its own mock root between its
+        builds.
+        limits are the keyword arguments of the rrepo.resources.Admission
+        holding back the builds the machine has no resources for, all the
+        cores are used if None.
         """
         self.ncores = multiprocessing.cpu_count()
-        if ncores is None:
+        if ncores is not None:
+            self.ncores = ncores
+        self.dry_run = dry_run
+        self.warm_root = warm_root
+        self.limits = limits
+        self.history = BuildHistory()
+        self.pool = None
+        if not dry_run:
             self.pool = Pool(self.ncores)
-        else:
-            self.pool = Pool(ncores)
+
+    def get_admission(self, pkg_names, mock_config):
+        """ Return the rrepo.resources.Admission for the builds of the
+        given packages with the given mock configuration, None if the
+        resources of the machine are not checked.
+        """
+        if self.limits is None:
+            return None
+        return Admission(RESULT_DIR, self.history.estimate_resources(
+            pkg_names, get_arch(mock_config)), **self.limits)
 
     def main(self, filename, mock_config):
         """ Reads the fill name, queue all the builds and run them.
@@ -86,47 +142,88 @@ class Builder(object):
         pkg_names = stream.read().split('\n')
         stream.close()
 
-        builds = []
-        for pkg in pkg_names:
-            if pkg:
-                builds.append(self.pool.apply_async(build_rpm, (pkg, mock_config) ))
-                #print build_rpm(pkg, mock_config)
-
-        print '%s builds queued' % len(builds)
-
-        cnt = 0
-        failed = []
-        succeed = []
-        for build in builds:
-            output = None
-            try:
-                output = build.get()
-            except Exception, err:
-                print "ERROR:", err
-                print "On:", pkg_names[cnt]
-            if output:
-                failed.append(pkg_names[cnt])
-            else:
-                succeed.append(pkg_names[cnt])
-            cnt = cnt + 1
-        
+        pkg_names = [pkg for pkg in pkg_names if pkg]
+        graph = dict([(pkg, []) for pkg in pkg_names])
+        # The builds are run in the order of the file
+        priorities = get_queue_priorities(pkg_names)
+
+        if self.dry_run:
+            print_simulation(graph,
+                self.history.estimate(pkg_names, get_arch(mock_config)),
+                self.ncores, priorities)
+            return
+
+        print '%s builds queued' % len(graph)
+
+        scheduler = DagScheduler(self.pool, self.ncores, graph,
+            history=self.history, mock_config=mock_config,
+            priorities=priorities,
+            admission=self.get_admission(pkg_names, mock_config),
+            resultdir=RESULT_DIR)
+        results = ResultFiles({'failed': 'failed', 'succeed': 'succeed'})
+        try:
+            with METRICS.span('builds'):
+                succeed, failed, _ = scheduler.run(build_rpm,
+                    lambda pkg: (pkg, mock_config, self.warm_root), results)
+        finally:
+            results.close()
+
         print '\n%s packages failed' % len(failed)
         print '%s packages succeed' % len(succeed)
 
-        stream = open('failed', 'w')
-        stream.write('\n'.join(failed))
-        stream.close()
-        stream = open('succeed', 'w')
-        stream.write('\n'.join(succeed))
-        stream.close()
+    def build_graph(self, filename, mock_config):
+        """ Reads the dependency graph in the given file and build all
+        its packages, each one as soon as all its dependencies are built,
+        starting first the ones with the longest chain of packages
+        depending on them.
+        """
+        graph = read_graph(filename)
+        durations = self.history.estimate(graph, get_arch(mock_config))
+
+        if self.dry_run:
+            print_simulation(graph, durations, self.ncores)
+            return
+
+        print '%s builds to run' % len(graph)
+
+        scheduler = DagScheduler(self.pool, self.ncores, graph, durations,
+            self.history, mock_config,
+            admission=self.get_admission(graph, mock_config),
+            resultdir=RESULT_DIR)
+        results = ResultFiles({'failed': 'failed', 'skipped': 'skipped',
+            'succeed': 'succeed'})
+        try:
+            with METRICS.span('builds'):
+                succeed, failed, skipped = scheduler.run(build_rpm,
+                    lambda pkg: (pkg, mock_config, self.warm_root), results)
+        finally:
+            results.close()
+
+        print '\n%s packages failed' % len(failed)
+        print '%s packages skipped due to a failed dependency' % len(skipped)
+        print '%s packages succeed' % len(succeed)
 
 if __name__ == "__main__":
     parser = setup_parser()
     args = parser.parse_args()
     start = datetime.now()
     print "Start at:" , start
-    builder = Builder(args.ncores)
-    builder.main(args.inputfile, args.mock_config)
+    limits = None
+    if not args.no_admission:
+        limits = {'max_load': args.max_load,
+            'memory_reserve': args.memory_reserve * MEGABYTE,
+            'disk_reserve': args.disk_reserve * MEGABYTE}
+    METRICS.configure('multi_rpm_builder', args.metrics_json,
+        args.metrics_textfile)
+    try:
+        builder = Builder(args.ncores, args.dry_run, not args.no_warm_root,
+            limits)
+        if args.graph:
+            builder.build_graph(args.inputfile, args.mock_config)
+        else:
+            builder.main(args.inputfile, args.mock_config)
+    finally:
+        METRICS.close()
     end = datetime.now()
     print "End at:", end
     print "Time elapsed: ", end - start
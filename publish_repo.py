@@ -0,0 +1,292 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# (C) 2011 - Pierre-Yves Chibon <pingou@pingoured.fr>
+
+"""
+This script publishes the RPMs built by mock into the R-repo.
+
+The RPMs found in the results directory are moved (or hard linked) into
+the folder of their architecture, the noarch ones being linked into the
+folder of each architecture. Only these new RPMs are signed and the
+metadata of the repositories which received new RPMs are updated, reusing
+the checksums computed for the RPMs already published.
+"""
+
+import argparse
+import errno
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+from rrepo.fetch import CACHE_DIR
+
+logging.basicConfig()
+LOG = logging.getLogger()
+if '--debug' in sys.argv:
+    LOG.setLevel(logging.DEBUG)
+elif '--verbose' in sys.argv:
+    LOG.setLevel(logging.INFO)
+
+# Folders of the repository receiving the RPMs of each architecture
+ARCH_FOLDERS = {
+    'i386': 'i386',
+    'i686': 'i386',
+    'x86_64': 'x86_64',
+}
+
+# Folders of the repository which get their own metadata
+REPOSITORIES = sorted(set(ARCH_FOLDERS.values()))
+
+# Number of RPMs given to a single rpm --addsign
+SIGN_BATCH_SIZE = 50
+
+
+def setup_parser():
+    """
+    Set the command line arguments.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resultdir', default='/data/mock/results/',
+        help='Directory in which mock wrote the RPMs (defaults to %(default)s).')
+    parser.add_argument('--repodir',
+        default='/data/repo/RPMS/entreprise/6/r-repo/',
+        help='Directory of the repository, containing one folder per architecture (defaults to %(default)s).')
+    parser.add_argument('--srpmdir',
+        default=os.path.expanduser('~/rpmbuild/SRPMS/'),
+        help='Directory receiving the source RPMs (defaults to %(default)s).')
+    parser.add_argument('--keep-results', action='store_true',
+        help='Hard link the RPMs instead of moving them out of the results directory.')
+    parser.add_argument('--no-sign', action='store_true',
+        help='Do not sign the new RPMs.')
+    parser.add_argument('--sign-workers', type=int,
+        default=multiprocessing.cpu_count(),
+        help='Number of rpm --addsign run at once (defaults to the number of cores), the key must be usable without prompting for its passphrase (eg: through gpg-agent) to use more than one.')
+    parser.add_argument('--verbose', action='store_true',
+        help='Give more info about what is going on.')
+    parser.add_argument('--debug', action='store_true',
+        help='Output bunches of debugging info.')
+    return parser
+
+
+def get_rpm_arch(filename):
+    """ Return the architecture of an RPM from its file name, eg: x86_64
+    for R-foo-1.0-1.el6.x86_64.rpm, src for a source RPM.
+    """
+    return filename.rsplit('.', 2)[-2]
+
+
+def find_rpms(resultdir):
+    """ Return the full path to all the RPMs in the given directory and
+    its sub-directories.
+    """
+    rpms = []
+    for root, _, filenames in os.walk(resultdir):
+        for filename in filenames:
+            if filename.endswith('.rpm'):
+                rpms.append(os.path.join(root, filename))
+    return sorted(rpms)
+
+
+def place(source, target, keep=False):
+    """ Put the file source at target, replacing any file already there.
+    The file is renamed, or hard linked if keep is True, and is only
+    copied if both are on different filesystems.
+    """
+    folder = os.path.dirname(target)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    if not keep:
+        try:
+            os.rename(source, target)
+            return
+        except OSError, err:
+            if err.errno != errno.EXDEV:
+                raise
+    fd, tmp = tempfile.mkstemp(dir=folder, suffix='.part')
+    os.close(fd)
+    os.unlink(tmp)
+    try:
+        try:
+            os.link(source, tmp)
+        except OSError, err:
+            if err.errno != errno.EXDEV:
+                raise
+            shutil.copy2(source, tmp)
+        os.rename(tmp, target)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+    if not keep:
+        os.unlink(source)
+
+
+def link_noarch(repodir, filename):
+    """ Make the noarch RPM with the given file name part of the
+    repository of each architecture.
+    """
+    for folder in REPOSITORIES:
+        if not os.path.isdir(os.path.join(repodir, folder)):
+            os.makedirs(os.path.join(repodir, folder))
+        link = os.path.join(repodir, folder, filename)
+        if os.path.lexists(link):
+            os.unlink(link)
+        os.symlink(os.path.join('..', 'noarch', filename), link)
+
+
+def sign(rpms):
+    """ Sign the given list of RPMs and return the exit code of rpm. """
+    cmd = ['rpm', '--addsign'] + rpms
+    LOG.debug(' '.join(cmd))
+    return subprocess.call(cmd)
+
+
+def sign_all(rpms, nworkers):
+    """ Sign the given RPMs, by batches of SIGN_BATCH_SIZE run in parallel,
+    and return the list of those which could not be signed, the RPMs of
+    a failed batch being signed again one by one.
+    """
+    batches = [rpms[cnt:cnt + SIGN_BATCH_SIZE]
+        for cnt in range(0, len(rpms), SIGN_BATCH_SIZE)]
+    if not batches:
+        return []
+    pool = ThreadPool(max(1, min(nworkers, len(batches))))
+    try:
+        outcodes = pool.map(sign, batches)
+        # Sign the RPMs of the failed batches one by one to find those
+        # which cannot be signed
+        retries = [[rpm] for batch, outcode in zip(batches, outcodes)
+            if outcode and len(batch) > 1 for rpm in batch]
+        failed = [batch[0] for batch, outcode in zip(batches, outcodes)
+            if outcode and len(batch) == 1]
+        for batch, outcode in zip(retries, pool.map(sign, retries)):
+            if outcode:
+                failed.extend(batch)
+    finally:
+        pool.close()
+    return sorted(failed)
+
+
+def update_repository(folder, cachedir):
+    """ Update the metadata of the repository in the given folder, only
+    reading the RPMs which are not in its current metadata, and return the
+    exit code of createrepo.
+    """
+    cmd = ['createrepo', '--update', '--cachedir', cachedir, folder]
+    LOG.debug(' '.join(cmd))
+    return subprocess.call(cmd)
+
+
+def is_published(source, target):
+    """ Return whether the RPM source is already published at target: the
+    file there is at least as recent as source, signing it having only
+    made it more recent.
+    """
+    return os.path.exists(target) \
+        and os.stat(target).st_mtime >= os.stat(source).st_mtime
+
+
+def unpublish(source, target, keep=False):
+    """ Take the RPM published at target out of the repository, moving it
+    back to source unless it was only linked there, so that it is
+    published again by the next run.
+    """
+    if keep:
+        os.unlink(target)
+    else:
+        place(target, source)
+
+
+def publish(args):
+    """ Move the RPMs of the results directory into the repository, sign
+    them and update the metadata of the repository.
+    """
+    published = {}
+    changed = {}
+    skipped = 0
+    for rpm in find_rpms(args.resultdir):
+        filename = os.path.basename(rpm)
+        arch = get_rpm_arch(filename)
+        if arch == 'src':
+            target = os.path.join(args.srpmdir, filename)
+            if is_published(rpm, target):
+                skipped = skipped + 1
+            else:
+                place(rpm, target, args.keep_results)
+            continue
+        if arch == 'noarch':
+            target = os.path.join(args.repodir, 'noarch', filename)
+            folders = REPOSITORIES
+        elif arch in ARCH_FOLDERS:
+            target = os.path.join(args.repodir, ARCH_FOLDERS[arch], filename)
+            folders = [ARCH_FOLDERS[arch]]
+        else:
+            print 'Unknown architecture %s, skipping %s' % (arch, rpm)
+            continue
+        if is_published(rpm, target):
+            # Left in the results directory by --keep-results
+            skipped = skipped + 1
+            continue
+        place(rpm, target, args.keep_results)
+        if arch == 'noarch':
+            link_noarch(args.repodir, filename)
+        published[target] = rpm
+        changed[target] = folders
+    print '%s RPMs published, %s already published' % (len(published),
+        skipped)
+
+    # The RPMs are signed before being added to the metadata, as signing
+    # changes their checksum
+    if not args.no_sign:
+        failed = sign_all(sorted(published), args.sign_workers)
+        print '%s RPMs signed' % (len(published) - len(failed))
+        for rpm in failed:
+            # Unsigned RPMs never enter the metadata, the next run tries
+            # again
+            print 'Could not sign %s, taken out of the repository' % rpm
+            unpublish(published[rpm], rpm, args.keep_results)
+            if get_rpm_arch(rpm) == 'noarch':
+                for folder in REPOSITORIES:
+                    link = os.path.join(args.repodir, folder,
+                        os.path.basename(rpm))
+                    if os.path.lexists(link):
+                        os.unlink(link)
+            del changed[rpm]
+
+    cachedir = os.path.join(CACHE_DIR, 'createrepo')
+    folders = set()
+    for target_folders in changed.values():
+        folders.update(target_folders)
+    for folder in sorted(folders):
+        if update_repository(os.path.join(args.repodir, folder), cachedir):
+            print 'Could not update the repository %s' % folder
+        else:
+            print 'Repository %s updated' % folder
+
+
+if __name__ == '__main__':
+    parser = setup_parser()
+    args = parser.parse_args()
+    start = datetime.now()
+    publish(args)
+    print "Time elapsed: ", datetime.now() - start
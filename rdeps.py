@@ -0,0 +1,110 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# (C) 2011 - Pierre-Yves Chibon <pingou@pingoured.fr>
+
+"""
+This script lists the packages of the upstream repositories depending,
+directly or not, on the given packages, that is the packages to rebuild
+once they are updated, in the order in which they should be built.
+
+The list is written in a file usable as input of multi_rpm_builder and
+the dependencies between these packages in a file usable by
+multi_rpm_builder --graph.
+"""
+
+import argparse
+import ConfigParser
+import sys
+
+from rrepo.fetch import CACHE_DIR, HttpCache
+from rrepo.graph import get_rebuild_order, write_graph
+from rrepo.index import load_index
+from rrepo.packages import get_repos
+
+
+def setup_parser():
+    """
+    Set the command line arguments.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('packages', nargs='*',
+        help='Name of the packages whose reverse dependencies are wanted.')
+    parser.add_argument('--from-file',
+        help='File containing the name of the packages, one per line (eg: the output of check_spec_to_update).')
+    parser.add_argument('--config', default='depgenerator/repos.cfg',
+        help='A repo configuration files (defaults to %(default)s).')
+    parser.add_argument('--cache-dir', default=CACHE_DIR,
+        help='Directory in which the repositories metadata are cached (defaults to %(default)s).')
+    parser.add_argument('--all-dep', action='store_true',
+        help='Consider the Suggests as well as the Depends and Imports.')
+    parser.add_argument('--direct', action='store_true',
+        help='Only list the packages depending directly on the given ones.')
+    parser.add_argument('--include-roots', action='store_true',
+        help='List the given packages as well.')
+    parser.add_argument('--output', default='rebuild_packages',
+        help='File in which the packages are written in build order (defaults to %(default)s).')
+    parser.add_argument('--graph-output', default='rebuild_dependencies',
+        help='File in which the dependencies between these packages are written (defaults to %(default)s).')
+    return parser
+
+
+def main():
+    ''' Main function.
+    Load the index of the upstream repositories, compute the reverse
+    dependencies of the given packages and write them down.
+    '''
+    args = setup_parser().parse_args()
+    names = list(args.packages)
+    if args.from_file:
+        stream = open(args.from_file)
+        try:
+            names.extend([line.strip() for line in stream if line.strip()])
+        finally:
+            stream.close()
+    if not names:
+        print 'No package specified'
+        return 1
+
+    parser = ConfigParser.ConfigParser()
+    parser.read(args.config)
+    index = load_index(get_repos(parser), HttpCache(args.cache_dir))
+    try:
+        for name in names:
+            if index.get(name) is None:
+                print '%s is not in the repositories' % name
+        order, graph = get_rebuild_order(index.get_graph(
+            all_dep=args.all_dep), names, args.direct, args.include_roots)
+    finally:
+        index.close()
+
+    stream = open(args.output, 'w')
+    try:
+        for name in order:
+            stream.write(name + '\n')
+    finally:
+        stream.close()
+    write_graph(args.graph_output, graph)
+    for name in order:
+        print name
+    print '%s packages to rebuild, written in %s and %s' % (len(order),
+        args.output, args.graph_output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
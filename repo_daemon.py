@@ -0,0 +1,113 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# (C) 2011 - Pierre-Yves Chibon <pingou@pingoured.fr>
+
+"""
+This script runs the query service of the R-repo: it loads the upstream
+repositories, the dependency levels of their packages and the versions of
+the spec files once, keeps them up to date in the background and answers
+the queries of repo_query.py over a Unix socket.
+"""
+
+import argparse
+import ConfigParser
+import logging
+import signal
+import sys
+
+from rrepo.daemon import SOCKET_PATH, QueryServer, load_state
+from rrepo.fetch import CACHE_DIR, HttpCache
+from rrepo.packages import get_repos
+from rrepo.provides import ProvidesCache
+from rrepo.specs import SpecScanner
+from rrepo.version import version_key
+
+logging.basicConfig()
+LOG = logging.getLogger('rrepo')
+if '--debug' in sys.argv:
+    LOG.setLevel(logging.DEBUG)
+else:
+    LOG.setLevel(logging.INFO)
+
+
+def setup_parser():
+    """
+    Set the command line arguments.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='depgenerator/repos.cfg',
+        help='A repo configuration files (defaults to %(default)s).')
+    parser.add_argument('--cache-dir', default=CACHE_DIR,
+        help='Directory in which the repositories metadata are cached (defaults to %(default)s).')
+    parser.add_argument('--specs',
+        help='Folder containing the spec files, needed to answer the outdated queries.')
+    parser.add_argument('--socket', default=SOCKET_PATH,
+        help='Path of the socket to listen on (defaults to %(default)s).')
+    parser.add_argument('--refresh', type=int, default=600,
+        help='Number of seconds between two refreshes (defaults to %(default)s).')
+    parser.add_argument('--all-dep', action='store_true',
+        help='Consider the Suggests as well as the Depends and Imports.')
+    parser.add_argument('--r-core-version',
+        help='[Epoch:]version-release of the R-core to plan against, the epoch defaulting to 0 (defaults to the installed or available R-core).')
+    parser.add_argument('--r-core-primary',
+        help='A primary.xml(.gz) repository metadata file to read the provides of R-core from instead of using repoquery.')
+    parser.add_argument('--refresh-r-core', action='store_true',
+        help='Look for the installed or available R-core again instead of using the version found by the previous run.')
+    parser.add_argument('--debug', action='store_true',
+        help='Output bunches of debugging info.')
+    return parser
+
+
+def main():
+    ''' Main function.
+    Load the state of the repositories and serve the queries until
+    interrupted.
+    '''
+    args = setup_parser().parse_args()
+    parser = ConfigParser.ConfigParser()
+    parser.read(args.config)
+    repos = get_repos(parser)
+    cache = HttpCache(args.cache_dir)
+    evrs = None
+    if args.r_core_version:
+        evrs = [args.r_core_version]
+    provides = ProvidesCache(args.cache_dir).resolve(evrs,
+        args.r_core_primary, args.refresh_r_core)
+    # Plan against the most recent R-core if several are found
+    provided = provides[max(provides, key=version_key)]
+    scanner = SpecScanner()
+
+    def load():
+        return load_state(repos, cache, provided, args.all_dep, args.specs,
+            scanner)
+
+    server = QueryServer(args.socket, load, args.refresh)
+    # Remove the socket when stopped by kill as well
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    LOG.info('Listening on %s' % args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
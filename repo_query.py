@@ -0,0 +1,132 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# (C) 2011 - Pierre-Yves Chibon <pingou@pingoured.fr>
+
+"""
+Thin client of the query service run by repo_daemon.py.
+
+    repo_query.py level Rcpp ggplot2
+    repo_query.py buildable Rcpp
+    repo_query.py rdeps Rcpp [--direct] [--include-roots]
+    repo_query.py outdated
+    repo_query.py version Rcpp
+    repo_query.py status
+
+It only imports the standard library so that it starts in no time.
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+
+# Same as rrepo.daemon.SOCKET_PATH, not imported to keep the client light
+SOCKET_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'r-repo',
+    'rrepod.sock')
+
+
+def setup_parser():
+    """
+    Set the command line arguments.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('query',
+        choices=['level', 'buildable', 'rdeps', 'outdated', 'version',
+            'status'],
+        help='The query to run.')
+    parser.add_argument('packages', nargs='*',
+        help='Name of the packages the query is about.')
+    parser.add_argument('--direct', action='store_true',
+        help='For rdeps, only list the packages depending directly on the given ones.')
+    parser.add_argument('--include-roots', action='store_true',
+        help='For rdeps, list the given packages as well.')
+    parser.add_argument('--json', action='store_true',
+        help='Print the raw answer of the service.')
+    parser.add_argument('--socket', default=SOCKET_PATH,
+        help='Path of the socket of the service (defaults to %(default)s).')
+    return parser
+
+
+def query(path, request):
+    ''' Send the given request to the service listening on the socket at
+    the given path and return its answer.
+    '''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(request) + '\n')
+        stream = sock.makefile('r')
+        try:
+            return json.loads(stream.readline())
+        finally:
+            stream.close()
+    finally:
+        sock.close()
+
+
+def print_result(name, result):
+    ''' Print the result of the given query in a format easy to use in a
+    shell script.
+    '''
+    if isinstance(result, list):
+        for item in result:
+            print item
+    elif name == 'buildable':
+        for package in sorted(result):
+            info = result[package]
+            if info['buildable']:
+                print '%s: buildable%s' % (package,
+                    ' (level %s)' % info['level'] if 'level' in info else '')
+            else:
+                print '%s: blocked by %s' % (package,
+                    ', '.join(info['blocked_by']))
+    elif name == 'version':
+        for package in sorted(result):
+            print '%s: %s (spec %s)' % (package, result[package]['upstream'],
+                result[package]['local'])
+    else:
+        for key in sorted(result):
+            print '%s: %s' % (key, result[key])
+
+
+def main():
+    ''' Main function.
+    Send the query given on the command line and print its answer.
+    '''
+    args = setup_parser().parse_args()
+    request = {'query': args.query, 'packages': args.packages,
+        'direct': args.direct, 'include_roots': args.include_roots}
+    try:
+        reply = query(args.socket, request)
+    except socket.error, err:
+        print >> sys.stderr, 'Could not reach the service on %s: %s' % (
+            args.socket, err)
+        return 2
+    if 'error' in reply:
+        print >> sys.stderr, reply['error']
+        return 1
+    if args.json:
+        print json.dumps(reply['result'], indent=2, sort_keys=True)
+    else:
+        print_result(args.query, reply['result'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
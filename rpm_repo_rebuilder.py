@@ -26,10 +26,23 @@ import argparse
 import logging
 import multiprocessing
 import sys
-from datetime import datetime
+from datetime import datetime, timedelta
 from multiprocessing import Pool
 from subprocess import Popen, PIPE
 from r2spec.r2spec_obj import R2rpm, setup_parser as r2spec_parser
+from rrepo.history import BuildHistory, get_arch
+from rrepo.metrics import METRICS
+from rrepo.mockroot import prepare_root
+from rrepo.resources import Admission, DISK_RESERVE, MEGABYTE, \
+    MEMORY_RESERVE
+from rrepo.scheduler import DagScheduler, ResultFiles, \
+    get_queue_priorities, print_simulation
+
+# Architectures the packages are built for
+ARCHS = ['i686', 'x86_64']
+
+# Directory in which mock writes the results of the builds
+RESULT_DIR = '/data/mock/results/'
 
 logging.basicConfig()
 LOG = logging.getLogger()
@@ -48,8 +61,26 @@ def setup_parser():
         help='Input file containing the rpm to build.')
     parser.add_argument('--mock-config', default='fedora-rawhide',
         help='Mock configuration to use (defaults to fedora-rawhide). Do not specify the arch as this is a rebuild for both.')
+    parser.add_argument('--dry-run', action='store_true',
+        help='Do not build anything, estimate how long the builds would take from the previous builds.')
+    parser.add_argument('--no-warm-root', action='store_true',
+        help='Let mock create a new chroot for each build instead of reusing one chroot per worker.')
+    parser.add_argument('--max-load', type=float,
+        help='Do not start new builds while the load average is above this value (defaults to twice the number of cores).')
+    parser.add_argument('--memory-reserve', type=int,
+        default=MEMORY_RESERVE / MEGABYTE,
+        help='Memory in MiB to keep free when starting builds (defaults to %(default)s).')
+    parser.add_argument('--disk-reserve', type=int,
+        default=DISK_RESERVE / MEGABYTE,
+        help='Space in MiB to keep free in the results directory when starting builds (defaults to %(default)s).')
+    parser.add_argument('--no-admission', action='store_true',
+        help='Start as many builds as there are cores, whatever the memory, disk and load of the machine.')
     parser.add_argument('--ncores', type=int,
         help='Number of cores to use (all by default)')
+    parser.add_argument('--metrics-json',
+        help='File to which the metrics of each build are appended as JSON lines.')
+    parser.add_argument('--metrics-textfile',
+        help='Prometheus textfile in which the metrics of the builds are written.')
     parser.add_argument('--verbose', action='store_true',
         help='Give more info about what is going on.')
     parser.add_argument('--debug', action='store_true',
@@ -57,7 +88,7 @@ def setup_parser():
     return parser
 
 
-def build_rpm(packagename, mock_config):
+def build_rpm(packagename, mock_config, warm_root=True):
     #LOG.debug ('  R2rpm %s -- %s' %(packagename, mock_config))
     print '  R2rpm %s -- %s' %(packagename, mock_config)
     r2specparser = r2spec_parser('R2rpm')
@@ -68,7 +99,9 @@ def build_rpm(packagename, mock_config):
     #arg.force_dl = True
     arg.no_check = True
     arg.mock_config = mock_config
-    arg.mock_resultdir = '/data/mock/results/'
+    if warm_root:
+        arg.mock_config = prepare_root(arg.mock_config)
+    arg.mock_resultdir = RESULT_DIR
     arg.keep_logs = True
     return R2rpm().main(arg)
 
@@ -77,38 +110,72 @@ class Builder(object):
     """ This is the class that does most of the work.
     """
 
-    def __init__(self, ncores=None):
+    def __init__(self, ncores=None, dry_run=False, warm_root=True,
+            limits=None):
         """ Constructor.
         Instanciate the attributes (including the pool to which the 
         tasks are assigned).
+        In dry_run mode, no build is run, the time they would take is
+        estimated from the history of the previous builds.
+        With warm_root, each worker reuses its own mock root between its
+        builds.
+        limits are the keyword arguments of the rrepo.resources.Admission
+        holding back the builds the machine has no resources for, all the
+        cores are used if None.
         """
         self.log = LOG
+        self.built = None
         self.ncores = multiprocessing.cpu_count()
-        if ncores is None:
+        if ncores is not None:
+            self.ncores = ncores
+        self.dry_run = dry_run
+        self.warm_root = warm_root
+        self.limits = limits
+        self.history = BuildHistory()
+        self.pool = None
+        if not dry_run:
             self.pool = Pool(self.ncores)
-        else:
-            self.pool = Pool(ncores)
+
+    def get_admission(self, pkg_names, mock_config):
+        """ Return the rrepo.resources.Admission for the builds of the
+        given packages with the given mock configuration, None if the
+        resources of the machine are not checked.
+        """
+        if self.limits is None:
+            return None
+        return Admission(RESULT_DIR, self.history.estimate_resources(
+            pkg_names, get_arch(mock_config)), **self.limits)
+
+    def load_built(self, archs):
+        """ Retrieve in a single repoquery call the list of R packages
+        already present in the repositories for the given architectures
+        (and noarch) and store it as a set of (name, arch).
+
+        :arg archs, the list of architectures to query.
+        """
+        cmd = ['repoquery', '--qf', '%{name} %{arch}', '--archlist',
+            ','.join(archs + ['noarch']), 'R-*']
+        self.log.debug(" ".join(cmd))
+        with METRICS.span('repoquery'):
+            output = Popen(cmd, stdout=PIPE).stdout.read()
+        self.built = set()
+        for line in output.split('\n'):
+            if line.startswith('R-') and ' ' in line:
+                name, arch = line.strip().rsplit(' ', 1)
+                self.built.add((name[2:], arch))
+        self.log.debug('%s packages already built' % len(self.built))
 
     def is_built(self, pkgname, arch):
         """ For a given package, returns if the package is present in
         the repository, (True if it is, False otherwise).
+        A noarch package is considered built for all architectures.
 
         :arg pkgname, name of the package to search in the repositories.
         """
-        arch_pkg = []
-        built = False
-        cmd = ['repoquery', '--envra', 'R-%s' % pkgname, '--archlist', arch ]
-        self.log.debug(" ".join(cmd))
-        #print cmd
-        archname = Popen(cmd, stdout=PIPE).stdout.read()[:-1]
-        if archname:
-            built = True
-        cmd = ['repoquery', '--envra', 'R-%s' % pkgname]
-        self.log.debug(" ".join(cmd))
-        noarch = Popen(cmd, stdout=PIPE).stdout.read()[:-1]
-        if noarch:
-            built = True
-        return built
+        if self.built is None:
+            self.load_built(ARCHS)
+        return (pkgname, arch) in self.built \
+            or (pkgname, 'noarch') in self.built
 
     def multiple_build(self, pkg_names, arch, mock_config):
         """ For a given list of package and one architecture, for each
@@ -119,47 +186,47 @@ class Builder(object):
         :arg arch, the architecture to build against (i686/x86_64)
         """
         print arch
-        builds = []
+        mock_arch = arch
+        if mock_arch == 'i686':
+            mock_arch = 'i386'
+        mock_cfg = '%s-%s' %(mock_config, mock_arch)
+        pkgs = []
         for pkg in pkg_names:
             if pkg:
                 self.log.debug(pkg)
                 if not self.is_built(pkg, arch):
                     self.log.debug('  %s' % arch)
-                    mock_arch = arch
-                    if mock_arch == 'i686':
-                        mock_arch = 'i386'
-                    mock_cfg = '%s-%s' %(mock_config, mock_arch)
-                    builds.append(self.pool.apply_async(build_rpm, (pkg, mock_cfg) ))
+                    pkgs.append(pkg)
                     #print build_rpm(pkg, mock_config)
 
-        print '%s builds queued' % len(builds)
-
-        cnt = 0
-        failed = []
-        succeed = []
-        for build in builds:
-            output = None
-            try:
-                output = build.get()
-            except Exception, err:
-                print "ERROR:", err
-                print "On:", pkg_names[cnt]
-            if output:
-                failed.append(pkg_names[cnt])
-            else:
-                succeed.append(pkg_names[cnt])
-            cnt = cnt + 1
-        
+        graph = dict([(pkg, []) for pkg in pkgs])
+        # The builds are run in the order of the file
+        priorities = get_queue_priorities(pkgs)
+
+        if self.dry_run:
+            return print_simulation(graph,
+                self.history.estimate(pkgs, get_arch(mock_cfg)),
+                self.ncores, priorities)
+
+        print '%s builds queued' % len(graph)
+
+        scheduler = DagScheduler(self.pool, self.ncores, graph,
+            history=self.history, mock_config=mock_cfg,
+            priorities=priorities,
+            admission=self.get_admission(pkgs, mock_cfg),
+            resultdir=RESULT_DIR)
+        results = ResultFiles({'failed': 'failed_%s' % arch,
+            'succeed': 'succeed_%s' % arch}, 'a')
+        try:
+            with METRICS.span('builds', arch=arch):
+                succeed, failed, _ = scheduler.run(build_rpm,
+                    lambda pkg: (pkg, mock_cfg, self.warm_root), results)
+        finally:
+            results.close()
+
         print '\n%s packages failed' % len(failed)
         print '%s packages succeed' % len(succeed)
 
-        stream = open('failed_%s' % arch, 'a')
-        stream.write('\n'.join(failed))
-        stream.close()
-        stream = open('succeed_%s' % arch, 'a')
-        stream.write('\n'.join(succeed))
-        stream.close()
-
     def main(self, filename, mock_config):
         """ Reads the fill name, queue all the builds and run them.
         """
@@ -168,8 +235,13 @@ class Builder(object):
         pkg_names = stream.read().split('\n')
         stream.close()
 
-        self.multiple_build(pkg_names, 'i686', mock_config)
-        self.multiple_build(pkg_names, 'x86_64', mock_config)
+        makespan = 0
+        for arch in ARCHS:
+            makespan = makespan + (self.multiple_build(pkg_names, arch,
+                mock_config) or 0)
+        if self.dry_run:
+            # The architectures are built one after the other
+            print 'Estimated total: %s' % timedelta(seconds=int(makespan))
 
 
 if __name__ == "__main__":
@@ -177,8 +249,19 @@ if __name__ == "__main__":
     args = parser.parse_args()
     start = datetime.now()
     print "Start at:" , start
-    builder = Builder(args.ncores)
-    builder.main(args.inputfile, args.mock_config)
+    limits = None
+    if not args.no_admission:
+        limits = {'max_load': args.max_load,
+            'memory_reserve': args.memory_reserve * MEGABYTE,
+            'disk_reserve': args.disk_reserve * MEGABYTE}
+    METRICS.configure('rpm_repo_rebuilder', args.metrics_json,
+        args.metrics_textfile)
+    try:
+        builder = Builder(args.ncores, args.dry_run, not args.no_warm_root,
+            limits)
+        builder.main(args.inputfile, args.mock_config)
+    finally:
+        METRICS.close()
     end = datetime.now()
     print "End at:", end
     print "Time elapsed: ", end - start
@@ -0,0 +1,260 @@
+#-*- coding: utf-8 -*-
+
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# (C) 2011 - Pierre-Yves Chibon <pingou@pingoured.fr>
+
+
+"""
+Query service keeping the state of the repositories in memory.
+
+The index of the upstream repositories, the dependency levels of their
+packages and the versions of the local spec files are loaded once and
+refreshed in the background. Queries are sent over a Unix socket, one
+JSON object per line, and answered with one JSON object per line:
+
+    {"query": "level", "packages": ["Rcpp"]}
+    {"result": {"Rcpp": 0}}
+
+The queries available are listed in QUERIES.
+"""
+
+import json
+import logging
+import os
+import SocketServer
+import threading
+import time
+
+from rrepo.fetch import CACHE_DIR
+from rrepo.graph import dependency_levels, find_blockers, \
+    get_rebuild_order, reverse_graph
+from rrepo.index import load_index
+from rrepo.version import get_newer
+
+LOG = logging.getLogger('rrepo')
+
+# Default path of the socket of the service
+SOCKET_PATH = os.path.join(CACHE_DIR, 'rrepod.sock')
+
+
+class RepoState(object):
+    """ Snapshot of the repositories the queries are answered from, it is
+    never modified once built, a refresh builds a new one.
+    """
+
+    def __init__(self, versions, graph, provided, local=None):
+        """ Constructor.
+        :arg versions, a dictionnary associating the packages of the
+        repositories to their version.
+        :arg graph, the dependency graph of all these packages.
+        :arg provided, the packages provided by R-core.
+        :kwarg local, a dictionnary associating package names to the
+        version of their spec file.
+        """
+        self.versions = versions
+        self.graph = graph
+        self.reverse = reverse_graph(graph)
+        self.provided = set(provided)
+        self.local = local or {}
+        self.loaded = time.time()
+
+        tobuild = dict([(name, deps) for name, deps in graph.iteritems()
+            if name not in self.provided])
+        self.levels = dict(dependency_levels(tobuild, self.provided))
+        leftovers = dict([(name, deps) for name, deps in tobuild.iteritems()
+            if name not in self.levels])
+        self.blockers = dict([(name, []) for name in leftovers])
+        available = self.provided.union(self.levels)
+        for kind, names, blocked in find_blockers(leftovers, available):
+            for name in blocked:
+                self.blockers[name].append('%s %s' % (kind, ' '.join(names)))
+        upstream = dict([(name, versions[name]) for name in self.local
+            if name in versions])
+        self.outdated = get_newer(self.local, upstream)
+
+    def level(self, packages):
+        """ Return the build level of each of the given packages, None for
+        those which cannot be built or are not in the repositories.
+        """
+        return dict([(name, self.levels.get(name)) for name in packages])
+
+    def buildable(self, packages):
+        """ Return for each of the given packages whether it can be built,
+        its level and what blocks it.
+        """
+        result = {}
+        for name in packages:
+            if name in self.provided:
+                result[name] = {'buildable': True, 'provided': True}
+            elif name in self.levels:
+                result[name] = {'buildable': True,
+                    'level': self.levels[name]}
+            elif name in self.blockers:
+                result[name] = {'buildable': False,
+                    'blocked_by': self.blockers[name]}
+            else:
+                result[name] = {'buildable': False,
+                    'blocked_by': ['missing %s' % name]}
+        return result
+
+    def rdeps(self, packages, direct=False, include_roots=False):
+        """ Return the packages to rebuild after the given ones, in build
+        order (see rrepo.graph.get_rebuild_order).
+        """
+        return get_rebuild_order(self.graph, packages, direct,
+            include_roots, self.reverse)[0]
+
+    def version(self, packages):
+        """ Return the upstream and local version of the given packages.
+        """
+        return dict([(name, {'upstream': self.versions.get(name),
+            'local': self.local.get(name)}) for name in packages])
+
+    def status(self):
+        """ Return some figures about the state. """
+        return {'packages': len(self.versions), 'buildable': len(
+            self.levels), 'blocked': len(self.blockers), 'specs': len(
+            self.local), 'outdated': len(self.outdated), 'loaded':
+            self.loaded}
+
+
+# Queries available and how they are answered from a RepoState
+QUERIES = {
+    'level': lambda state, query: state.level(query['packages']),
+    'buildable': lambda state, query: state.buildable(query['packages']),
+    'rdeps': lambda state, query: state.rdeps(query['packages'],
+        query.get('direct', False), query.get('include_roots', False)),
+    'outdated': lambda state, query: state.outdated,
+    'version': lambda state, query: state.version(query['packages']),
+    'status': lambda state, query: state.status(),
+}
+
+
+def get_spec_versions(scanner, folder):
+    """ Return a dictionnary associating the package built by each spec
+    of the given folder to the version of the spec, the package name
+    being taken from the name of the spec file as check_spec_to_update
+    does. The specs without a Version are skipped.
+    """
+    local = {}
+    for spec, info in scanner.scan(folder).iteritems():
+        if info['Version'] is None:
+            LOG.warning('No Version found in %s, skipped' % spec)
+            continue
+        name = os.path.basename(spec)[len('R-'):-len('.spec')]
+        local[name] = info['Version']
+    return local
+
+
+def load_state(repos, cache, provided, all_dep=False, specfolder=None,
+        scanner=None):
+    """ Load the state of the given repositories and spec folder.
+
+    :arg repos, the repositories as returned by rrepo.packages.get_repos.
+    :arg cache, the rrepo.fetch.HttpCache used to retrieve them.
+    :arg provided, the packages provided by R-core.
+    :kwarg all_dep, whether the Suggests are considered.
+    :kwarg specfolder, the folder containing the spec files.
+    :kwarg scanner, the rrepo.specs.SpecScanner reading them.
+    """
+    index = load_index(repos, cache)
+    try:
+        versions = index.get_versions()
+        graph = index.get_graph(all_dep=all_dep)
+    finally:
+        index.close()
+    local = None
+    if specfolder is not None:
+        local = get_spec_versions(scanner, specfolder)
+    return RepoState(versions, graph, provided, local)
+
+
+class QueryHandler(SocketServer.StreamRequestHandler):
+    """ Answer the queries sent on a connection, one per line. """
+
+    def handle(self):
+        """ Read the queries and write their answers. """
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            start = time.time()
+            try:
+                query = json.loads(line)
+                answer = QUERIES[query['query']]
+            except (ValueError, KeyError, TypeError):
+                reply = {'error': 'Invalid query, known queries: %s' % (
+                    ', '.join(sorted(QUERIES)))}
+            else:
+                try:
+                    reply = {'result': answer(self.server.state, query)}
+                except (KeyError, TypeError), err:
+                    reply = {'error': 'Invalid arguments: %s' % err}
+            self.wfile.write(json.dumps(reply) + '\n')
+            self.wfile.flush()
+            LOG.debug('%s answered in %.1fms' % (line.strip(),
+                (time.time() - start) * 1000))
+
+
+class QueryServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """ Unix socket server answering the queries from a RepoState
+    refreshed in the background.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, load, refresh=600):
+        """ Constructor, the state is loaded before the socket is opened.
+        :arg path, the path of the socket.
+        :arg load, a function returning a new RepoState.
+        :kwarg refresh, the number of seconds between two refreshes of the
+        state.
+        """
+        self.load = load
+        self.refresh = refresh
+        self.state = load()
+        if os.path.exists(path):
+            # Left by a previous instance
+            os.unlink(path)
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        SocketServer.UnixStreamServer.__init__(self, path, QueryHandler)
+        os.chmod(path, 0600)
+        thread = threading.Thread(target=self.__refresh_loop,
+            name='refresh')
+        thread.daemon = True
+        thread.start()
+
+    def __refresh_loop(self):
+        """ Reload the state every self.refresh seconds, the previous one
+        being kept if the reload fails.
+        """
+        while True:
+            time.sleep(self.refresh)
+            try:
+                state = self.load()
+            except Exception, err:
+                LOG.info('Could not refresh the state: %s' % err)
+                continue
+            # Queries in progress keep using the previous state
+            self.state = state
+            LOG.info('State refreshed')
+
+    def server_close(self):
+        """ Close the socket and remove its file. """
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
@@ -0,0 +1,214 @@
+#-*- coding: utf-8 -*-
+
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# (C) 2011 - Pierre-Yves Chibon <pingou@pingoured.fr>
+
+
+"""
+Fetch layer for the metadata of the R repositories.
+
+The files retrieved are stored on disk together with their ETag and
+Last-Modified headers. The following requests for the same url are sent
+with If-None-Match / If-Modified-Since so that a repository which did not
+change only costs a '304 Not Modified' answer.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import urllib2
+from multiprocessing.pool import ThreadPool
+
+from rrepo.metrics import METRICS
+
+# Default location of the cache shared by all the scripts
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'r-repo')
+
+# Size of the blocks written to the disk
+CHUNK_SIZE = 64 * 1024
+
+LOG = logging.getLogger('rrepo')
+
+
+def get_digest(path):
+    """ Return the sha1 of the content of a file stored in the cache,
+    as computed when it was retrieved.
+
+    :arg path, the path to the file as returned by HttpCache.fetch.
+    """
+    stream = open(path + '.json')
+    try:
+        info = json.load(stream)
+    finally:
+        stream.close()
+    if 'sha1' in info:
+        return info['sha1']
+    # Files retrieved before the digest was recorded
+    digest = hashlib.sha1()
+    stream = open(path, 'rb')
+    try:
+        chunk = stream.read(CHUNK_SIZE)
+        while chunk:
+            digest.update(chunk)
+            chunk = stream.read(CHUNK_SIZE)
+    finally:
+        stream.close()
+    return digest.hexdigest()
+
+
+class HttpCache(object):
+    """ On-disk cache of the files retrieved over HTTP, refreshed using
+    conditional requests.
+    """
+
+    def __init__(self, cachedir=CACHE_DIR, max_age=0):
+        """ Constructor.
+        :kwarg cachedir, the directory in which the files are stored.
+        :kwarg max_age, number of seconds during which a cached file is
+        used without even asking the server whether it changed.
+        """
+        self.root = cachedir
+        self.cachedir = os.path.join(cachedir, 'http')
+        self.max_age = max_age
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+
+    def get_paths(self, url):
+        """ Return the path to the cached content and to the file
+        containing the headers of the given url.
+        """
+        key = hashlib.sha1(url).hexdigest()
+        path = os.path.join(self.cachedir, key)
+        return (path, path + '.json')
+
+    def get_meta(self, url):
+        """ Return the information stored about the given url or None if
+        it has never been retrieved.
+        """
+        body, meta = self.get_paths(url)
+        if not os.path.exists(body) or not os.path.exists(meta):
+            return None
+        stream = open(meta)
+        try:
+            return json.load(stream)
+        except ValueError:
+            return None
+        finally:
+            stream.close()
+
+    def fetch(self, url):
+        """ Return the path to an up to date local copy of the file at the
+        given url, retrieving it only if it changed since the last call.
+        """
+        body, meta = self.get_paths(url)
+        info = self.get_meta(url)
+        if info and time.time() - info['checked'] < self.max_age:
+            LOG.debug('%s fetched less than %ss ago' % (url, self.max_age))
+            return body
+
+        request = urllib2.Request(url)
+        if info:
+            if info.get('etag'):
+                request.add_header('If-None-Match', info['etag'])
+            if info.get('last_modified'):
+                request.add_header('If-Modified-Since',
+                    info['last_modified'])
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError, err:
+            if err.code != 304 or not info:
+                raise
+            LOG.debug('%s not modified' % url)
+            info['checked'] = time.time()
+            self.__write_meta(meta, info)
+            return body
+
+        digest = hashlib.sha1()
+        fd, tmp = tempfile.mkstemp(dir=self.cachedir, suffix='.part')
+        try:
+            stream = os.fdopen(fd, 'wb')
+            try:
+                chunk = response.read(CHUNK_SIZE)
+                while chunk:
+                    digest.update(chunk)
+                    stream.write(chunk)
+                    chunk = response.read(CHUNK_SIZE)
+            finally:
+                stream.close()
+            os.rename(tmp, body)
+        finally:
+            response.close()
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+        LOG.debug('%s retrieved' % url)
+        info = {
+            'url': url,
+            'etag': response.info().getheader('ETag'),
+            'last_modified': response.info().getheader('Last-Modified'),
+            'sha1': digest.hexdigest(),
+            'checked': time.time(),
+        }
+        self.__write_meta(meta, info)
+        return body
+
+    def fetch_packages(self, url):
+        """ Return the path to an up to date local copy of the given
+        PACKAGES file and whether this copy is gzipped.
+        The PACKAGES.gz file is preferred, the plain PACKAGES file is used
+        if the repository does not provide it.
+        """
+        with METRICS.span('fetch', repo=url):
+            try:
+                return (self.fetch(url + '.gz'), True)
+            except IOError:
+                return (self.fetch(url), False)
+
+    def fetch_all_packages(self, urls, nthreads=None):
+        """ Retrieve all the given PACKAGES files in parallel and return a
+        dictionnary associating each url to the (path, compressed) tuple
+        of its local copy, or to the IOError raised while retrieving it.
+        """
+        if not urls:
+            return {}
+        pool = ThreadPool(nthreads or len(urls))
+        try:
+            results = pool.map(self._fetch_packages_or_error, urls)
+        finally:
+            pool.close()
+        return dict(zip(urls, results))
+
+    def _fetch_packages_or_error(self, url):
+        """ Wrapper around fetch_packages returning the error instead of
+        raising it, so that one failing repository does not prevent the
+        others from being retrieved.
+        """
+        try:
+            return self.fetch_packages(url)
+        except IOError, err:
+            return err
+
+    def __write_meta(self, meta, info):
+        """ Atomically write the given information in the file meta. """
+        fd, tmp = tempfile.mkstemp(dir=self.cachedir, suffix='.part')
+        stream = os.fdopen(fd, 'w')
+        try:
+            json.dump(info, stream)
+        finally:
+            stream.close()
+        os.rename(tmp, meta)
@@ -0,0 +1,369 @@
+#-*- coding: utf-8 -*-
+
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# (C) 2011 - Pierre-Yves Chibon <pingou@pingoured.fr>
+
+
+"""
+Dependency graph of the packages to build.
+
+A graph is a dictionnary associating each package to the list of the
+packages it depends on. Dependencies which are not themselves keys of the
+graph are considered available (provided by R or already built).
+"""
+
+import heapq
+from collections import deque
+
+
+def read_graph(filename):
+    """ Read a graph written by write_graph: one package per line
+    followed by ':' and the space separated list of its dependencies.
+    """
+    graph = {}
+    stream = open(filename)
+    try:
+        for line in stream:
+            if ':' not in line:
+                if line.strip():
+                    graph[line.strip()] = []
+                continue
+            name, deps = line.split(':', 1)
+            graph[name.strip()] = deps.split()
+    finally:
+        stream.close()
+    return graph
+
+
+def write_graph(filename, graph):
+    """ Write the given graph in the given file, see read_graph. """
+    stream = open(filename, 'w')
+    try:
+        for name in sorted(graph):
+            stream.write('%s: %s\n' % (name, ' '.join(sorted(graph[name]))))
+    finally:
+        stream.close()
+
+
+def reverse_graph(graph):
+    """ Return the reverse of the given graph: a dictionnary associating
+    each package of the graph to the list of the packages of the graph
+    depending on it.
+    """
+    rdeps = dict([(name, []) for name in graph])
+    for name, deps in graph.iteritems():
+        for dep in set(deps):
+            if dep in rdeps:
+                rdeps[dep].append(name)
+    return rdeps
+
+
+def topological_order(graph):
+    """ Return the packages of the graph sorted so that each package comes
+    after its dependencies. The packages part of, or depending on, a cycle
+    are left out.
+    """
+    rdeps = reverse_graph(graph)
+    waiting = dict([(name, len(set([dep for dep in deps if dep in graph])))
+        for name, deps in graph.iteritems()])
+    queue = deque(sorted([name for name in graph if not waiting[name]]))
+    order = []
+    while queue:
+        name = queue.popleft()
+        order.append(name)
+        for rdep in rdeps[name]:
+            waiting[rdep] = waiting[rdep] - 1
+            if not waiting[rdep]:
+                queue.append(rdep)
+    return order
+
+
+def transitive_rdeps(rdeps, names):
+    """ Return the set of the packages depending, directly or not, on any
+    of the given packages, according to the given reverse graph (see
+    reverse_graph).
+    """
+    seen = set()
+    queue = list(names)
+    while queue:
+        for rdep in rdeps.get(queue.pop(), ()):
+            if rdep not in seen:
+                seen.add(rdep)
+                queue.append(rdep)
+    return seen
+
+
+def get_rebuild_order(graph, names, direct=False, include_roots=False,
+        rdeps=None):
+    """ Return the packages of the graph to rebuild after the given ones,
+    in build order, the packages in a dependency cycle coming last, and
+    the dependency graph between them.
+
+    :arg graph, the dependency graph of all the packages.
+    :arg names, the names of the packages updated.
+    :kwarg direct, whether only the packages depending directly on the
+    given ones are returned.
+    :kwarg include_roots, whether the given packages are returned too.
+    :kwarg rdeps, the reverse of the graph, computed if None.
+    """
+    if rdeps is None:
+        rdeps = reverse_graph(graph)
+    if direct:
+        rebuild = set()
+        for name in names:
+            rebuild.update(rdeps.get(name, ()))
+    else:
+        rebuild = transitive_rdeps(rdeps, names)
+    if include_roots:
+        rebuild.update([name for name in names if name in graph])
+    subgraph = dict([(name, [dep for dep in graph[name] if dep in rebuild])
+        for name in rebuild])
+    order = topological_order(subgraph)
+    order.extend(sorted(set(subgraph) - set(order)))
+    return (order, subgraph)
+
+
+def dependency_levels(graph, available=(), levels=None):
+    """ Return the (package, level) of the packages of the graph in the
+    order they become buildable, level 0 packages only depending on
+    available packages and each other package being on the level right
+    after the highest level of its dependencies.
+    Contrary to the rest of this module, the dependencies neither in the
+    graph nor available are considered missing: the packages depending on
+    them, directly or not, are left out, as are the dependency cycles.
+
+    :kwarg available, the packages provided or already built.
+    :kwarg levels, a dictionnary associating packages outside the graph
+    to the level they were already placed on, the packages of the graph
+    depending on them are placed after them.
+    """
+    if levels is None:
+        levels = {}
+    waiting = {}
+    rdeps = {}
+    level = {}
+    for name, deps in graph.iteritems():
+        deps = set(deps).difference(available)
+        placed = [levels[dep] + 1 for dep in deps
+            if dep in levels and dep not in graph]
+        if placed:
+            level[name] = max(placed)
+            deps = [dep for dep in deps if dep not in levels or dep in graph]
+        waiting[name] = len(deps)
+        for dep in deps:
+            rdeps.setdefault(dep, []).append(name)
+
+    queue = deque()
+    for name in graph:
+        if not waiting[name]:
+            level.setdefault(name, 0)
+            queue.append(name)
+
+    order = []
+    while queue:
+        name = queue.popleft()
+        order.append((name, level[name]))
+        for rdep in rdeps.get(name, []):
+            level[rdep] = max(level.get(rdep, 0), level[name] + 1)
+            waiting[rdep] = waiting[rdep] - 1
+            if not waiting[rdep]:
+                queue.append(rdep)
+    return order
+
+
+def update_levels(graph, available, old_graph, old_levels):
+    """ Return the levels of the packages of the graph, as computed by
+    dependency_levels, reusing those computed for a previous graph: only
+    the packages whose dependencies changed, the new ones and the packages
+    depending on them or on removed packages, directly or not, are placed
+    again.
+    Return them as a dictionnary together with the set of the packages
+    placed again.
+
+    :arg graph, the dependency graph of the packages to build.
+    :arg available, the packages provided or already built, the same as
+    for the previous graph.
+    :arg old_graph, the previous dependency graph.
+    :arg old_levels, a dictionnary associating the packages of the
+    previous graph to their level, those which could not be built being
+    left out.
+    """
+    # Comparing the lists first avoids building sets for the packages
+    # which did not change, the most common case
+    changed = set([name for name, deps in graph.iteritems()
+        if name not in old_graph or (old_graph[name] != deps
+            and set(old_graph[name]) != set(deps))])
+    changed.update([name for name in old_graph if name not in graph])
+    if not changed:
+        return (dict(old_levels), set())
+    rdeps = {}
+    for name, deps in graph.iteritems():
+        for dep in deps:
+            rdeps.setdefault(dep, []).append(name)
+    dirty = transitive_rdeps(rdeps, changed)
+    dirty.update([name for name in changed if name in graph])
+
+    levels = dict([(name, level) for name, level in old_levels.iteritems()
+        if name in graph and name not in dirty])
+    subgraph = dict([(name, graph[name]) for name in dirty])
+    levels.update(dependency_levels(subgraph, available, levels))
+    return (levels, dirty)
+
+
+def critical_path_lengths(graph, weights=None, default=1):
+    """ Return a dictionnary associating each package of the graph to the
+    length of the longest chain of builds starting with it, that is its
+    own weight plus the longest critical path of the packages depending on
+    it.
+
+    :kwarg weights, a dictionnary associating packages to their weight
+    (eg: their expected build time).
+    :kwarg default, the weight of the packages absent from weights.
+    """
+    if weights is None:
+        weights = {}
+    rdeps = reverse_graph(graph)
+    lengths = {}
+    for name in reversed(topological_order(graph)):
+        longest = 0
+        for rdep in rdeps[name]:
+            longest = max(longest, lengths.get(rdep, 0))
+        lengths[name] = weights.get(name, default) + longest
+    return lengths
+
+
+def strongly_connected_components(graph):
+    """ Return the strongly connected components of the graph, as lists of
+    packages, each component coming after the components it depends on
+    (Tarjan's algorithm, run without recursion so that long chains of
+    dependencies do not hit the recursion limit).
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+
+    def get_deps(name):
+        return iter(sorted(set([dep for dep in graph[name] if dep in graph])))
+
+    for root in sorted(graph):
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, get_deps(root))]
+        while work:
+            name, deps = work[-1]
+            for dep in deps:
+                if dep not in index:
+                    index[dep] = lowlink[dep] = len(index)
+                    stack.append(dep)
+                    on_stack.add(dep)
+                    work.append((dep, get_deps(dep)))
+                    break
+                elif dep in on_stack:
+                    lowlink[name] = min(lowlink[name], index[dep])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[name])
+                if lowlink[name] == index[name]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == name:
+                            break
+                    components.append(component)
+    return components
+
+
+def find_blockers(graph, available=()):
+    """ Return the root causes preventing the packages of the graph from
+    being built, as a list of (kind, names, blocked) tuples sorted by
+    decreasing number of packages blocked:
+    - ('missing', (dep,), blocked) for a dependency which is neither in
+      the graph nor available,
+    - ('cycle', members, blocked) for a dependency cycle between packages
+      of the graph,
+    blocked being the set of the packages of the graph which cannot be
+    built until the cause is fixed.
+
+    :arg graph, the dependency graph of the packages which could not be
+    built.
+    :kwarg available, the packages provided or already built.
+    """
+    available = set(available)
+    missing = {}
+    subgraph = {}
+    for name, deps in graph.iteritems():
+        subgraph[name] = []
+        for dep in set(deps):
+            if dep in graph:
+                subgraph[name].append(dep)
+            elif dep not in available:
+                missing.setdefault(dep, []).append(name)
+    rdeps = reverse_graph(subgraph)
+
+    def get_blocked(names):
+        blocked = set(names)
+        queue = list(names)
+        while queue:
+            for rdep in rdeps[queue.pop()]:
+                if rdep not in blocked:
+                    blocked.add(rdep)
+                    queue.append(rdep)
+        return blocked
+
+    causes = []
+    for dep, names in missing.iteritems():
+        causes.append(('missing', (dep,), get_blocked(names)))
+    for component in strongly_connected_components(subgraph):
+        if len(component) > 1 or component[0] in subgraph[component[0]]:
+            causes.append(('cycle', tuple(sorted(component)),
+                get_blocked(component)))
+    causes.sort(key=lambda cause: (-len(cause[2]), cause[0], cause[1]))
+    return causes
+
+
+class ReadyQueue(object):
+    """ Priority queue of the packages ready to be built, the package
+    with the longest critical path coming first.
+    """
+
+    def __init__(self, priorities):
+        """ Constructor.
+        :arg priorities, a dictionnary associating packages to their
+        priority, typically their critical path length.
+        """
+        self.priorities = priorities
+        self.heap = []
+
+    def push(self, name):
+        """ Add a package to the queue. """
+        heapq.heappush(self.heap, (-self.priorities.get(name, 0), name))
+
+    def pop(self):
+        """ Remove and return the package with the highest priority. """
+        return heapq.heappop(self.heap)[1]
+
+    def __len__(self):
+        """ Return the number of packages in the queue. """
+        return len(self.heap)
@@ -0,0 +1,176 @@
+#-*- coding: utf-8 -*-
+
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# (C) 2011 - Pierre-Yves Chibon <pingou@pingoured.fr>
+
+
+"""
+History of the builds run, used to estimate how long the next ones will
+take.
+
+Every build is recorded in a SQLite database with its wall time, the
+architecture and mock configuration used, its outcome and, when known,
+the peak memory it used and the size of its results.
+"""
+
+import os
+import sqlite3
+import time
+
+from rrepo.fetch import CACHE_DIR
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS builds (
+    package TEXT NOT NULL,
+    arch TEXT,
+    mock_config TEXT,
+    duration REAL NOT NULL,
+    outcome TEXT NOT NULL,
+    finished REAL NOT NULL,
+    rss INTEGER,
+    disk INTEGER
+)'''
+
+# Columns added after the first version of the schema
+COLUMNS = (('rss', 'INTEGER'), ('disk', 'INTEGER'))
+
+INDEX = 'CREATE INDEX IF NOT EXISTS builds_package ON builds (package, arch)'
+
+# Duration assumed for a build when nothing is known about it (seconds)
+DEFAULT_DURATION = 600
+
+# Peak memory and disk assumed for a build when nothing is known (bytes)
+DEFAULT_RSS = 512 * 1024 * 1024
+DEFAULT_DISK = 50 * 1024 * 1024
+
+
+def get_arch(mock_config):
+    """ Return the architecture of a mock configuration, eg: i386 for
+    epel-6-i386.
+    """
+    return mock_config.rsplit('-', 1)[-1]
+
+
+def median(values):
+    """ Return the median of a non-empty list of numbers. """
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class BuildHistory(object):
+    """ Store of the duration of the builds. """
+
+    def __init__(self, path=os.path.join(CACHE_DIR, 'build_history.sqlite')):
+        """ Constructor.
+        :kwarg path, the path to the SQLite database.
+        """
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.text_factory = str
+        self.conn.execute(SCHEMA)
+        existing = [row[1] for row in
+            self.conn.execute('PRAGMA table_info(builds)')]
+        for column, kind in COLUMNS:
+            if column not in existing:
+                self.conn.execute('ALTER TABLE builds ADD COLUMN %s %s'
+                    % (column, kind))
+        self.conn.execute(INDEX)
+        self.conn.commit()
+
+    def record(self, package, mock_config, duration, outcome, rss=None,
+            disk=None):
+        """ Record a build.
+
+        :arg package, the name of the package built.
+        :arg mock_config, the mock configuration used.
+        :arg duration, the wall time of the build in seconds.
+        :arg outcome, 'succeed' or 'failed'.
+        :kwarg rss, the peak memory used by the build in bytes.
+        :kwarg disk, the size of the results of the build in bytes.
+        """
+        self.conn.execute('INSERT INTO builds VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (package, get_arch(mock_config), mock_config, duration, outcome,
+                time.time(), rss, disk))
+        self.conn.commit()
+
+    def get_values(self, column, arch=None, succeed_only=True):
+        """ Return a dictionnary associating each package to the list of
+        the known values of the given column for its builds, successful
+        ones only if succeed_only, for the given architecture or for all
+        of them if arch is None.
+        """
+        query = 'SELECT package, %s FROM builds WHERE %s IS NOT NULL' % (
+            column, column)
+        params = ()
+        if succeed_only:
+            query = query + " AND outcome = 'succeed'"
+        if arch is not None:
+            query = query + ' AND arch = ?'
+            params = (arch,)
+        values = {}
+        for package, value in self.conn.execute(query, params):
+            values.setdefault(package, []).append(value)
+        return values
+
+    def __estimate(self, column, packages, arch, default, succeed_only=True):
+        """ Return a dictionnary associating each of the given packages to
+        the median of the values of the given column for its previous
+        builds on this architecture, or on any architecture, or the
+        median of all the builds, or the given default.
+        """
+        on_arch = self.get_values(column, arch, succeed_only)
+        on_any = self.get_values(column, None, succeed_only)
+        everything = [value for values in on_any.itervalues()
+            for value in values]
+        if everything:
+            default = median(everything)
+        estimates = {}
+        for package in packages:
+            if package in on_arch:
+                estimates[package] = median(on_arch[package])
+            elif package in on_any:
+                estimates[package] = median(on_any[package])
+            else:
+                estimates[package] = default
+        return estimates
+
+    def estimate(self, packages, arch=None):
+        """ Return a dictionnary associating each of the given packages to
+        its expected build time: the median of its previous successful
+        builds on this architecture, or on any architecture, or the
+        median of all the builds, or DEFAULT_DURATION.
+        """
+        return self.__estimate('duration', packages, arch, DEFAULT_DURATION)
+
+    def estimate_resources(self, packages, arch=None):
+        """ Return a dictionnary associating each of the given packages to
+        the (memory, disk) in bytes its build is expected to use, estimated
+        as the build time (see estimate) but from all the builds, the ones
+        which failed because they ran out of memory or disk being the most
+        telling ones.
+        """
+        rss = self.__estimate('rss', packages, arch, DEFAULT_RSS, False)
+        disk = self.__estimate('disk', packages, arch, DEFAULT_DISK, False)
+        return dict([(package, (rss[package], disk[package]))
+            for package in packages])
+
+    def close(self):
+        """ Close the connection to the database. """
+        self.conn.close()
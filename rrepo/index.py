@@ -0,0 +1,269 @@
+#-*- coding: utf-8 -*-
+
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# (C) 2011 - Pierre-Yves Chibon <pingou@pingoured.fr>
+
+
+"""
+Persistent index of the packages available in the R repositories.
+
+The PACKAGES files of all the repositories are parsed once, the latest
+version of each package is selected and the result is stored in a SQLite
+database, together with the dependencies between the packages indexed
+by dependency so that the packages depending on a given one are found
+without reading the whole index. The name of the database is derived from
+the snapshots of the PACKAGES files it was built from, so as long as no
+repository changes the following runs simply open it instead of parsing
+anything.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+
+from rrepo.fetch import get_digest
+from rrepo.metrics import METRICS
+from rrepo.packages import DEPENDENCY_FIELDS, format_dependencies, \
+    iter_file_packages
+from rrepo.version import is_newer
+
+LOG = logging.getLogger('rrepo')
+
+# Fields of the PACKAGES records kept in the index and their columns
+FIELDS = [
+    ('Package', 'name'),
+    ('Version', 'version'),
+    ('repo', 'repo'),
+    ('Depends', 'depends'),
+    ('Imports', 'imports'),
+    ('Suggests', 'suggests'),
+    ('source', 'source'),
+    ('MD5sum', 'md5sum'),
+]
+
+SCHEMA = 'CREATE TABLE packages (%s, PRIMARY KEY (name))' % ', '.join(
+    ['%s TEXT' % column for _, column in FIELDS])
+
+DEPENDENCIES_SCHEMA = '''CREATE TABLE dependencies (
+    name TEXT NOT NULL,
+    dep TEXT NOT NULL,
+    field TEXT NOT NULL
+)'''
+
+DEPENDENCIES_INDEXES = (
+    'CREATE INDEX dependencies_dep ON dependencies (dep)',
+    'CREATE INDEX dependencies_name ON dependencies (name)',
+)
+
+# Version of the layout of the index, part of its key so that the indexes
+# written by a previous version are rebuilt
+INDEX_VERSION = 2
+
+
+def snapshot_key(snapshots):
+    """ Return the key identifying the given set of repository snapshots.
+
+    :arg snapshots, a list of (section, url, path, compressed) tuples
+    describing the local copies of the PACKAGES files.
+    """
+    key = hashlib.sha1('%s\n' % INDEX_VERSION)
+    for section, url, path, compressed in sorted(snapshots):
+        key.update('%s\0%s\0%s\0%s\n' % (section, url, compressed,
+            get_digest(path)))
+    return key.hexdigest()
+
+
+def get_source_url(url, name, version):
+    """ Return the url of the tarball of the given package version in the
+    repository whose PACKAGES file is at the given url.
+    """
+    return '%s/%s_%s.tar.gz' % (url.rsplit('/', 1)[0], name, version)
+
+
+class PackageIndex(object):
+    """ Read access to an index built by build_index. """
+
+    def __init__(self, path):
+        """ Constructor.
+        :arg path, the path to the SQLite database of the index.
+        """
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.text_factory = str
+        self.dependencies = {}
+
+    def __row_to_record(self, row):
+        """ Convert a row of the database into a package record. """
+        record = {}
+        for (field, _), value in zip(FIELDS, row):
+            if value is not None:
+                record[field] = value
+        return record
+
+    def get(self, name):
+        """ Return the record of the package with the given name or None
+        if it is not in the repositories.
+        """
+        cursor = self.conn.execute('SELECT * FROM packages WHERE name = ?',
+            (name,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return self.__row_to_record(row)
+
+    def iter_records(self):
+        """ Yield the records of all the packages of the index. """
+        for row in self.conn.execute('SELECT * FROM packages ORDER BY name'):
+            yield self.__row_to_record(row)
+
+    def __get_dependencies(self, all_dep):
+        """ Return the dependencies of all the packages, as a dictionnary
+        associating package names to sets of names, considering Suggests
+        only if all_dep is True.
+        They are read at once on first use, which is much faster than
+        querying the database for every package of a large graph.
+        """
+        if all_dep not in self.dependencies:
+            fields = [field.lower() for field in DEPENDENCY_FIELDS]
+            if not all_dep:
+                fields.remove('suggests')
+            deps = {}
+            for name, dep in self.conn.execute(
+                    'SELECT name, dep FROM dependencies WHERE field IN (%s)'
+                    % ', '.join(['?'] * len(fields)), fields):
+                deps.setdefault(name, set()).add(dep)
+            self.dependencies[all_dep] = deps
+        return self.dependencies[all_dep]
+
+    def get_graph(self, names=None, all_dep=False):
+        """ Return the dependency graph, as described in rrepo.graph, of
+        the given packages, restricted to the dependencies among them, or
+        of all the packages, with all their dependencies, if names is None.
+        """
+        deps = self.__get_dependencies(all_dep)
+        if names is None:
+            return dict([(name, sorted(deps.get(name, ())))
+                for name in self.get_versions()])
+        names = set(names)
+        return dict([(name, [dep for dep in deps.get(name, ())
+            if dep in names]) for name in names])
+
+    def get_versions(self):
+        """ Return a dictionnary associating each package to its version.
+        """
+        return dict(self.conn.execute('SELECT name, version FROM packages'))
+
+    def __len__(self):
+        """ Return the number of packages in the index. """
+        return self.conn.execute('SELECT count(*) FROM packages').fetchone()[0]
+
+    def close(self):
+        """ Close the connection to the database. """
+        self.conn.close()
+
+
+def iter_dependencies(records):
+    """ Yield a (name, dependency, field) tuple for each dependency of
+    the given package records, field being depends, imports or suggests.
+    """
+    for record in records:
+        for field in DEPENDENCY_FIELDS:
+            if field in record:
+                for dep in set(format_dependencies(record[field])):
+                    yield (record['Package'], dep, field.lower())
+
+
+def build_index(path, snapshots):
+    """ Parse the given PACKAGES files and write the index of their
+    packages at the given path.
+    When a package is present in several repositories, the most recent
+    version is kept, the first repository wins in case of equality.
+
+    :arg path, the path of the SQLite database to create.
+    :arg snapshots, a list of (section, url, path, compressed) tuples
+    describing the local copies of the PACKAGES files.
+    """
+    packages = {}
+    for section, url, filename, compressed in snapshots:
+        cnt = 0
+        for record in iter_file_packages(filename, compressed):
+            cnt = cnt + 1
+            name = record['Package']
+            if name in packages and not is_newer(record['Version'],
+                    packages[name]['Version']):
+                continue
+            record['repo'] = section
+            record['source'] = get_source_url(url, name, record['Version'])
+            packages[name] = record
+        LOG.debug('%s: %s packages indexed' % (section, cnt))
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    os.close(fd)
+    try:
+        conn = sqlite3.connect(tmp)
+        conn.text_factory = str
+        conn.execute(SCHEMA)
+        conn.executemany('INSERT INTO packages VALUES (%s)' % ', '.join(
+            ['?'] * len(FIELDS)), [[record.get(field) for field, _ in FIELDS]
+                for record in packages.itervalues()])
+        conn.execute(DEPENDENCIES_SCHEMA)
+        conn.executemany('INSERT INTO dependencies VALUES (?, ?, ?)',
+            iter_dependencies(packages.itervalues()))
+        for index in DEPENDENCIES_INDEXES:
+            conn.execute(index)
+        conn.commit()
+        conn.close()
+        os.rename(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+    LOG.info('Index of %s packages written in %s' % (len(packages), path))
+
+
+def load_index(repos, cache):
+    """ Return the PackageIndex of the given repositories, building it
+    only if one of them changed since the last time the index was built.
+    The repositories that could not be retrieved are left out.
+
+    :arg repos, the list of (section, url) of the repositories as
+    returned by rrepo.packages.get_repos.
+    :arg cache, the rrepo.fetch.HttpCache used to retrieve the PACKAGES
+    files, the index is stored next to it.
+    """
+    fetched = cache.fetch_all_packages([url for _, url in repos])
+    snapshots = []
+    for section, url in repos:
+        if isinstance(fetched[url], IOError):
+            LOG.info('Something went wrong while retrieving info for repo %s'
+                % url)
+            LOG.debug('ERROR: %s' % fetched[url])
+            continue
+        snapshots.append((section, url) + fetched[url])
+
+    path = os.path.join(cache.root, 'index-%s.sqlite' % snapshot_key(
+        snapshots))
+    if not os.path.exists(path):
+        with METRICS.span('parse'):
+            build_index(path, snapshots)
+        for entry in os.listdir(cache.root):
+            if entry.startswith('index-') and entry.endswith('.sqlite') \
+                    and entry != os.path.basename(path):
+                os.unlink(os.path.join(cache.root, entry))
+    else:
+        LOG.debug('Using index %s' % path)
+    return PackageIndex(path)
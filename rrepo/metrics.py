@@ -0,0 +1,294 @@
+#-*- coding: utf-8 -*-
+
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# (C) 2011 - Pierre-Yves Chibon <pingou@pingoured.fr>
+
+"""
+Timing of the phases of the scripts and metrics of the builds.
+
+The phases (retrieval of each repository, parsing, lookup of the R-core
+provides, ordering, output...) are timed as spans and each build is
+recorded with its time spent waiting in the queue, initializing the mock
+root and building, the size of its results and its outcome.
+
+They are collected in METRICS, shared by the whole process like a logger,
+and written, once configured by the script, as JSON lines and as a
+Prometheus textfile (for the textfile collector of node_exporter).
+
+The workers of the builders time the steps of a build with build_phase,
+these timings are sent back with the result of the build by
+rrepo.scheduler.call (see pop_build_phases).
+"""
+
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+# Upper bounds in seconds of the buckets of the build durations histogram
+BUILD_BUCKETS = (60, 300, 900, 1800, 3600, 7200)
+
+# Minimum number of seconds between two writes of the textfile while
+# builds are running
+TEXTFILE_INTERVAL = 60
+
+# Timings of the steps of the current build, per thread
+_BUILD_PHASES = threading.local()
+
+
+def escape(value):
+    """ Return the given label value escaped for the Prometheus text
+    format.
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def format_labels(labels):
+    """ Return the given dictionnary of labels in the Prometheus text
+    format, eg: {job="rdeps",phase="fetch"}.
+    """
+    return '{%s}' % ','.join(['%s="%s"' % (key, escape(labels[key]))
+        for key in sorted(labels)])
+
+
+@contextlib.contextmanager
+def build_phase(name):
+    """ Time the step of the current build with the given name, eg:
+    mock_init.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        phases = getattr(_BUILD_PHASES, 'phases', None)
+        if phases is None:
+            phases = _BUILD_PHASES.phases = {}
+        phases[name] = phases.get(name, 0) + time.time() - start
+
+
+def pop_build_phases():
+    """ Return the dictionnary associating the steps timed with
+    build_phase in the current thread to their duration and start
+    afresh.
+    """
+    phases = getattr(_BUILD_PHASES, 'phases', None) or {}
+    _BUILD_PHASES.phases = {}
+    return phases
+
+
+class Metrics(object):
+    """ Collector of the spans and build metrics of a run. """
+
+    def __init__(self):
+        """ Constructor, nothing is written until configure is called. """
+        self.lock = threading.Lock()
+        self.job = 'rrepo'
+        self.run = time.time()
+        self.stream = None
+        self.textfile = None
+        self.written = 0
+        # Last duration of each phase, by labels
+        self.phases = {}
+        # Number of builds and sums of their metrics, by outcome
+        self.builds = {}
+        self.buckets = dict([(bound, 0) for bound in BUILD_BUCKETS])
+
+    def configure(self, job, jsonfile=None, textfile=None):
+        """ Start a new run and set where the metrics are written.
+
+        :arg job, the name of the script, used as job label.
+        :kwarg jsonfile, the file to which the spans and builds are
+        appended as JSON lines.
+        :kwarg textfile, the Prometheus textfile rewritten with the
+        metrics of the run.
+        """
+        self.close()
+        self.job = job
+        self.run = time.time()
+        self.textfile = textfile
+        if jsonfile is not None:
+            folder = os.path.dirname(os.path.abspath(jsonfile))
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            self.stream = open(jsonfile, 'a')
+
+    def __write_event(self, event):
+        """ Append the given event to the JSON lines file, the lock must
+        be held.
+        """
+        if self.stream is None:
+            return
+        event['job'] = self.job
+        event['run'] = self.run
+        self.stream.write(json.dumps(event, sort_keys=True) + '\n')
+        self.stream.flush()
+
+    @contextlib.contextmanager
+    def span(self, phase, **labels):
+        """ Time the phase with the given name, the labels telling apart
+        the spans of the same phase, eg: span('fetch', repo=url).
+        """
+        start = time.time()
+        succeed = False
+        try:
+            yield
+            succeed = True
+        finally:
+            self.add_span(phase, start, time.time() - start, labels,
+                succeed)
+
+    def add_span(self, phase, start, duration, labels=None, succeed=True):
+        """ Record a phase which started at start and lasted duration
+        seconds.
+        """
+        labels = dict(labels or {})
+        with self.lock:
+            labels['phase'] = phase
+            self.phases[tuple(sorted(labels.items()))] = duration
+            del labels['phase']
+            self.__write_event({'type': 'span', 'phase': phase,
+                'start': start, 'duration': duration, 'labels': labels,
+                'succeed': succeed})
+
+    def add_build(self, package, outcome, start, duration, queue_wait=None,
+            mock_init=None, result_size=None, rss=None, mock_config=None):
+        """ Record a build.
+
+        :arg package, the name of the package built.
+        :arg outcome, 'succeed' or 'failed'.
+        :arg start, the time at which a worker started the build.
+        :arg duration, the wall time of the build in seconds.
+        :kwarg queue_wait, the seconds between the moment the package
+        could be built and the start of its build.
+        :kwarg mock_init, the seconds spent preparing the mock root.
+        :kwarg result_size, the size of the results in bytes.
+        :kwarg rss, the peak memory used by the build in bytes.
+        :kwarg mock_config, the mock configuration used.
+        """
+        build = duration - (mock_init or 0)
+        with self.lock:
+            totals = self.builds.setdefault(outcome, {'count': 0,
+                'queue_wait': 0, 'mock_init': 0, 'build': 0,
+                'duration': 0, 'result_size': 0})
+            totals['count'] = totals['count'] + 1
+            for key, value in [('queue_wait', queue_wait),
+                    ('mock_init', mock_init), ('build', build),
+                    ('duration', duration), ('result_size', result_size)]:
+                totals[key] = totals[key] + (value or 0)
+            for bound in BUILD_BUCKETS:
+                if duration <= bound:
+                    self.buckets[bound] = self.buckets[bound] + 1
+            self.__write_event({'type': 'build', 'package': package,
+                'outcome': outcome, 'start': start, 'duration': duration,
+                'queue_wait': queue_wait, 'mock_init': mock_init,
+                'build': build, 'result_size': result_size, 'rss': rss,
+                'mock_config': mock_config})
+        if time.time() - self.written > TEXTFILE_INTERVAL:
+            self.write_textfile()
+
+    def __format_builds(self, job):
+        """ Return the lines of the build metrics in the Prometheus text
+        format, the lock must be held.
+        """
+        lines = []
+        for name, key, text in [
+                ('rrepo_builds_total', 'count', 'Number of builds.'),
+                ('rrepo_build_queue_wait_seconds_total', 'queue_wait',
+                    'Time the builds waited to be started.'),
+                ('rrepo_build_mock_init_seconds_total', 'mock_init',
+                    'Time spent preparing the mock roots.'),
+                ('rrepo_build_seconds_total', 'build',
+                    'Time spent building, mock root excluded.'),
+                ('rrepo_build_result_bytes_total', 'result_size',
+                    'Size of the results of the builds.')]:
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s counter' % name)
+            for outcome in sorted(self.builds):
+                labels = {'outcome': outcome}
+                labels.update(job)
+                lines.append('%s%s %s' % (name, format_labels(labels),
+                    self.builds[outcome][key]))
+
+        name = 'rrepo_build_duration_seconds'
+        count = sum([totals['count'] for totals in self.builds.values()])
+        lines.append('# HELP %s Wall time of the builds.' % name)
+        lines.append('# TYPE %s histogram' % name)
+        for bound, value in [(bound, self.buckets[bound])
+                for bound in BUILD_BUCKETS] + [('+Inf', count)]:
+            labels = {'le': bound}
+            labels.update(job)
+            lines.append('%s_bucket%s %s' % (name, format_labels(labels),
+                value))
+        lines.append('%s_sum%s %.3f' % (name, format_labels(job),
+            sum([totals['duration'] for totals in self.builds.values()])))
+        lines.append('%s_count%s %s' % (name, format_labels(job), count))
+        return lines
+
+    def format_textfile(self):
+        """ Return the metrics of the run in the Prometheus text format,
+        the build metrics being left out if there was no build.
+        """
+        job = {'job': self.job}
+        lines = []
+        with self.lock:
+            lines.append('# HELP rrepo_phase_duration_seconds Duration of '
+                'the last run of each phase.')
+            lines.append('# TYPE rrepo_phase_duration_seconds gauge')
+            for key in sorted(self.phases):
+                labels = dict(key)
+                labels.update(job)
+                lines.append('rrepo_phase_duration_seconds%s %.3f' % (
+                    format_labels(labels), self.phases[key]))
+            if self.builds:
+                lines.extend(self.__format_builds(job))
+            lines.append('# HELP rrepo_last_run_timestamp_seconds Start of '
+                'the run.')
+            lines.append('# TYPE rrepo_last_run_timestamp_seconds gauge')
+            lines.append('rrepo_last_run_timestamp_seconds%s %.3f' % (
+                format_labels(job), self.run))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self):
+        """ Atomically rewrite the Prometheus textfile, if configured. """
+        self.written = time.time()
+        if self.textfile is None:
+            return
+        folder = os.path.dirname(os.path.abspath(self.textfile))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        # The collector must never read a partial file
+        fd, tmp = tempfile.mkstemp(dir=folder, suffix='.part')
+        stream = os.fdopen(fd, 'w')
+        try:
+            stream.write(self.format_textfile())
+        finally:
+            stream.close()
+        os.chmod(tmp, 0644)
+        os.rename(tmp, self.textfile)
+
+    def close(self):
+        """ Write the textfile and close the JSON lines file. """
+        self.write_textfile()
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+
+# Collector of the current process
+METRICS = Metrics()
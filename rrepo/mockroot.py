@@ -0,0 +1,190 @@
+#-*- coding: utf-8 -*-
+
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# (C) 2011 - Pierre-Yves Chibon <pingou@pingoured.fr>
+
+
+"""
+Long-lived mock roots, one per worker process of the builders.
+
+Instead of having mock create a new chroot for every build, each worker
+gets its own mock configuration, derived from the requested one, whose
+root is kept between the builds. Before each build only the rpmbuild tree
+of the chroot is scrubbed, and the root is recycled after a number of
+builds so that the BuildRequires installed by the previous builds do not
+accumulate.
+
+A root is locked by the process using it for as long as this process runs,
+so that builders run concurrently with the same worker names each use
+their own roots.
+"""
+
+import errno
+import fcntl
+import logging
+import multiprocessing
+import os
+import re
+from subprocess import call
+
+from rrepo.fetch import CACHE_DIR
+from rrepo.metrics import build_phase
+
+LOG = logging.getLogger('rrepo')
+
+# Directory containing the mock configurations
+MOCK_CONFIG_DIR = '/etc/mock'
+
+# Number of builds after which a root is recreated from scratch
+RECYCLE_AFTER = 50
+
+# Command resetting the rpmbuild tree of the chroot between two builds
+SCRUB_COMMAND = 'rm -rf /builddir/build/BUILD/* /builddir/build/BUILDROOT/*' \
+    ' /builddir/build/RPMS/* /builddir/build/SRPMS/*' \
+    ' /builddir/build/SOURCES/* /builddir/build/SPECS/*'
+
+CONFIG_TEMPLATE = '''# Generated by R-repo-utility, warm root of %(worker)s
+try:
+    include('%(base)s')
+except NameError:
+    execfile('%(base)s')
+config_opts['root'] = '%%s-%(suffix)s' %% config_opts['root']
+# Keep the chroot between the builds
+config_opts['clean'] = False
+config_opts['cleanup_on_success'] = False
+config_opts['cleanup_on_failure'] = False
+'''
+
+# The roots of the current process, per mock configuration and worker
+_ROOTS = {}
+
+
+class WarmRoot(object):
+    """ A mock root owned by one worker process and reused between its
+    builds.
+    """
+
+    def __init__(self, mock_config, worker,
+            confdir=os.path.join(CACHE_DIR, 'mock'),
+            recycle_after=RECYCLE_AFTER):
+        """ Constructor.
+        :arg mock_config, the name of, or path to, the mock configuration
+        the root is derived from, eg: epel-6-i386.
+        :arg worker, the name of the worker process owning the root, the
+        first root of this worker which is not locked by another process
+        is used.
+        :kwarg confdir, the directory in which the configuration of the
+        root is written.
+        :kwarg recycle_after, the number of builds after which the root is
+        recreated.
+        """
+        self.mock_config = mock_config
+        self.worker = worker
+        self.recycle_after = recycle_after
+        self.builds = 0
+        self.initialized = False
+        name = os.path.basename(mock_config)
+        if name.endswith('.cfg'):
+            name = name[:-len('.cfg')]
+        if not os.path.isdir(confdir):
+            os.makedirs(confdir)
+        slot = 0
+        while True:
+            suffix = 'rrepo-%s' % worker
+            if slot:
+                suffix = '%s-%s' % (suffix, slot)
+            suffix = re.sub(r'[^\w.-]', '_', suffix)
+            self.config = os.path.join(confdir, '%s-%s.cfg' % (name, suffix))
+            self.lock = self.__lock(self.config[:-len('.cfg')] + '.lock')
+            if self.lock is not None:
+                break
+            slot = slot + 1
+
+        base = mock_config
+        if not base.endswith('.cfg'):
+            base = os.path.join(MOCK_CONFIG_DIR, '%s.cfg' % mock_config)
+        stream = open(self.config, 'w')
+        try:
+            stream.write(CONFIG_TEMPLATE % {'worker': worker, 'base': base,
+                'suffix': suffix})
+        finally:
+            stream.close()
+
+    @staticmethod
+    def __lock(path):
+        """ Lock the given file for as long as the current process runs
+        and return it, None if another process holds the lock.
+        """
+        lock = open(path, 'a')
+        # mock and the builds must not inherit the lock
+        fcntl.fcntl(lock.fileno(), fcntl.F_SETFD,
+            fcntl.fcntl(lock.fileno(), fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, err:
+            lock.close()
+            if err.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return None
+        return lock
+
+    def __mock(self, *args):
+        """ Run mock on this root with the given arguments and return its
+        exit code.
+        """
+        cmd = ['mock', '-r', self.config] + list(args)
+        LOG.debug(' '.join(cmd))
+        return call(cmd)
+
+    def prepare(self):
+        """ Make the root ready for a new build and return the path to its
+        mock configuration.
+        The first time, every recycle_after builds and when scrubbing
+        fails, the root is (re)created, otherwise only its rpmbuild tree
+        is scrubbed.
+        """
+        if self.initialized and self.builds >= self.recycle_after:
+            LOG.debug('Recycling %s' % self.config)
+            self.__mock('--clean')
+            self.initialized = False
+        if self.initialized and self.__mock('--chroot', SCRUB_COMMAND):
+            LOG.info('Could not scrub %s, recreating it' % self.config)
+            self.__mock('--clean')
+            self.initialized = False
+        if not self.initialized:
+            if self.__mock('--init'):
+                raise OSError('Could not initialize the mock root %s'
+                    % self.config)
+            self.initialized = True
+            self.builds = 0
+        self.builds = self.builds + 1
+        return self.config
+
+
+def prepare_root(mock_config, worker=None):
+    """ Return the configuration of the warm root of the current worker
+    process for the given mock configuration, ready for a new build.
+
+    :kwarg worker, the name of the worker owning the root, by default the
+    name of the current process, builds run from threads give the name of
+    their thread.
+    """
+    if worker is None:
+        worker = multiprocessing.current_process().name
+    if (mock_config, worker) not in _ROOTS:
+        _ROOTS[(mock_config, worker)] = WarmRoot(mock_config, worker)
+    with build_phase('mock_init'):
+        return _ROOTS[(mock_config, worker)].prepare()
@@ -0,0 +1,382 @@
+#-*- coding: utf-8 -*-
+
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# (C) 2011 - Pierre-Yves Chibon <pingou@pingoured.fr>
+
+"""
+Parsing and storage of the PACKAGES files of the R repositories.
+
+The PACKAGES files are in the Debian Control File format: one record per
+package, records separated by a blank line, one `Key: value` field per
+line and values spread over several lines when the following lines start
+with a white space.
+"""
+
+import logging
+import re
+from array import array
+import zlib
+
+LOG = logging.getLogger('rrepo')
+
+# Size of the blocks read from the PACKAGES files
+CHUNK_SIZE = 64 * 1024
+
+# A field starts at the beginning of the line, the key is followed by ':'
+FIELD = re.compile(r'^([^\s:]+):\s*(.*)$')
+
+# An entry of a dependency field: a name optionally followed by a version
+# constraint between parenthesis, entries being separated by commas
+DEPENDENCY = re.compile(
+    r'\s*([^\s,()]+)\s*(?:\(\s*([<>=!]+)\s*([^)\s]+)\s*\))?\s*(?:,|$)')
+
+# What is not a package name in an entry DEPENDENCY does not match: the
+# version constraints, possibly unterminated
+CONSTRAINT = re.compile(r'\([^)]*(?:\)|$)')
+
+# Fields listing the dependencies of a package
+DEPENDENCY_FIELDS = ('Depends', 'Imports', 'Suggests')
+
+# Dependencies not to report, they are provided by R itself
+IGNORED_DEPENDENCIES = frozenset(['R'])
+
+# Memoized results of parse_dependencies and their entries
+_DEPENDENCIES_CACHE = {}
+_ENTRIES_CACHE = {}
+
+
+def parse_dependencies(dependencies):
+    """ Return the entries of a Depends, Imports or Suggests field as a
+    tuple of (name, operator, version), operator and version being None
+    for the entries without version constraint.
+    The results are memoized, identical fields being very common.
+    The malformed entries, eg: 'foo bar', are logged and all the names
+    they contain are returned, without version constraint.
+
+    :arg dependencies, the value of the field, for example
+    'R (>= 2.10), methods, Biobase (>= 2.5.5)'.
+    """
+    try:
+        return _DEPENDENCIES_CACHE[dependencies]
+    except KeyError:
+        pass
+    entries = []
+    pos = 0
+    while pos < len(dependencies):
+        match = DEPENDENCY.match(dependencies, pos)
+        if match is not None:
+            found = [(match.group(1), match.group(2) or None,
+                match.group(3) or None)]
+            pos = match.end()
+        else:
+            end = dependencies.find(',', pos)
+            if end == -1:
+                end = len(dependencies)
+            entry = dependencies[pos:end].strip()
+            found = [(name, None, None) for name in
+                CONSTRAINT.sub(' ', entry).split()]
+            if entry:
+                LOG.warning('Malformed dependency "%s" in "%s", read as %s'
+                    % (entry, dependencies, ', '.join([name for name, _, _
+                    in found]) or 'nothing'))
+            pos = end + 1
+        for entry in found:
+            # Share the identical entries, eg: ('R', '>=', '2.10')
+            entries.append(_ENTRIES_CACHE.setdefault(entry, entry))
+    entries = tuple(entries)
+    _DEPENDENCIES_CACHE[dependencies] = entries
+    return entries
+
+
+def format_dependencies(dependencies):
+    """ Format the dependencies cleanning them as much as possible for rpm.
+    """
+    return [name for name, _, _ in parse_dependencies(dependencies)
+        if name not in IGNORED_DEPENDENCIES]
+
+
+class NameTable(object):
+    """ Interning table associating each package name to an integer
+    identifier, so that a name used as dependency by thousands of packages
+    is stored only once.
+    """
+
+    def __init__(self):
+        """ Constructor. """
+        self.names = []
+        self.ids = {}
+
+    def get_id(self, name):
+        """ Return the identifier of the given name, registering it if it
+        is not known yet.
+        """
+        try:
+            return self.ids[name]
+        except KeyError:
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+            return self.ids[name]
+
+    def get_name(self, identifier):
+        """ Return the name associated to the given identifier. """
+        return self.names[identifier]
+
+    def __len__(self):
+        """ Return the number of names registered. """
+        return len(self.names)
+
+
+# The table shared by all the RPackage objects
+DEPENDENCY_NAMES = NameTable()
+
+# Memoized results of get_dependency_ids
+_DEPENDENCY_IDS_CACHE = {}
+
+
+def clear_dependency_caches():
+    """ Empty the memoized results of parse_dependencies and
+    get_dependency_ids, to be called once all the packages are loaded so
+    that the field strings they hold can be freed.
+    """
+    _DEPENDENCIES_CACHE.clear()
+    _ENTRIES_CACHE.clear()
+    _DEPENDENCY_IDS_CACHE.clear()
+
+
+def get_dependency_ids(dependencies):
+    """ Return the identifiers in DEPENDENCY_NAMES of the dependencies
+    of the given field, as an array, and the tuple of the version
+    constraints found in this field.
+    The results are memoized and shared, they should not be modified.
+
+    :arg dependencies, the value of a Depends, Imports or Suggests field.
+    """
+    try:
+        return _DEPENDENCY_IDS_CACHE[dependencies]
+    except KeyError:
+        pass
+    entries = parse_dependencies(dependencies)
+    ids = array('i', [DEPENDENCY_NAMES.get_id(name)
+        for name, _, _ in entries if name not in IGNORED_DEPENDENCIES])
+    constraints = tuple([entry for entry in entries if entry[1]])
+    _DEPENDENCY_IDS_CACHE[dependencies] = (ids, constraints)
+    return (ids, constraints)
+
+
+class RPackage(object):
+    """
+    This is the object used to store the information known about a package.
+
+    The attributes used for every package are stored in slots, the
+    dependencies as arrays of identifiers of the DEPENDENCY_NAMES table,
+    their version constraints as a tuple of the constraints of each of the
+    DEPENDENCY_FIELDS and all the other fields in a dictionnary only
+    created when needed.
+    """
+    __slots__ = ('name', 'version', 'repo', 'depends', 'imports',
+        'suggests', 'constraints', 'fields')
+
+    # Attributes in which the fields are stored
+    ATTRIBUTES = {
+        'Package': 'name',
+        'Version': 'version',
+        'repo': 'repo',
+        'Depends': 'depends',
+        'Imports': 'imports',
+        'Suggests': 'suggests',
+    }
+
+    def __init__(self):
+        """ Constructor. """
+        self.name = None
+        self.version = None
+        self.repo = None
+        self.depends = None
+        self.imports = None
+        self.suggests = None
+        self.constraints = None
+        self.fields = None
+
+    def set(self, key, value):
+        """ Set an attribute with a given value to the object.
+        If the key is in 'Suggests', 'Depends', 'Imports' we will directly
+        format the value the way we want them.
+        """
+        attribute = self.ATTRIBUTES.get(key)
+        if key in DEPENDENCY_FIELDS:
+            deps, constraints = get_dependency_ids(value)
+            if getattr(self, attribute) is not None:
+                deps = getattr(self, attribute) + deps
+            setattr(self, attribute, deps)
+            if constraints:
+                index = DEPENDENCY_FIELDS.index(key)
+                current = self.constraints or ((), (), ())
+                self.constraints = current[:index] + (
+                    current[index] + constraints,) + current[index + 1:]
+        elif attribute is not None:
+            if key == 'repo':
+                value = intern(value)
+            if getattr(self, attribute) is not None:
+                value = getattr(self, attribute) + value
+            setattr(self, attribute, value)
+        else:
+            if self.fields is None:
+                self.fields = {}
+            if key in self.fields:
+                self.fields[key] = self.fields[key] + value
+            else:
+                self.fields[key] = value
+
+    def get(self, key):
+        """ Returned the requested attribute attributed to the given key.
+        """
+        attribute = self.ATTRIBUTES.get(key)
+        if key in DEPENDENCY_FIELDS:
+            deps = getattr(self, attribute)
+            if deps is None:
+                return None
+            return [DEPENDENCY_NAMES.get_name(dep) for dep in deps]
+        elif attribute is not None:
+            return getattr(self, attribute)
+        elif self.fields is not None:
+            return self.fields.get(key)
+        return None
+
+    def get_dependency_ids(self, all_included=False):
+        """ Returned the identifiers of the 'Depends' and 'Imports'. If
+        all_included is True, expend this list with 'Suggests'.
+        """
+        dep = []
+        if self.depends is not None:
+            dep.extend(self.depends)
+        if self.imports is not None:
+            dep.extend(self.imports)
+        if all_included and self.suggests is not None:
+            dep.extend(self.suggests)
+        return dep
+
+    def get_constraints(self, all_included=False):
+        """ Returned the (name, operator, version) version constraints
+        of the 'Depends' and 'Imports'. If all_included is True, expend
+        this list with the ones of 'Suggests'.
+        """
+        if self.constraints is None:
+            return []
+        constraints = list(self.constraints[0] + self.constraints[1])
+        if all_included:
+            constraints.extend(self.constraints[2])
+        return constraints
+
+    def get_dependencies(self, all_included=False):
+        """ Returned the list of 'Depends' and 'Imports'. If all_included
+        is True, expend this list with 'Suggests'.
+        """
+        return [DEPENDENCY_NAMES.get_name(dep)
+            for dep in self.get_dependency_ids(all_included)]
+
+    def __str__(self):
+        """ Give us a nice representation of the object when needed for
+        debugging.
+        """
+        string = ''
+        keys = self.ATTRIBUTES.keys()
+        if self.fields is not None:
+            keys.extend(self.fields.keys())
+        for key in keys:
+            if self.get(key) is not None:
+                string = string + '%s: %s\n' %(key, self.get(key))
+        return string
+
+
+def get_repos(parser):
+    """ Return the list of (section, url) of the repositories configured
+    in the given ConfigParser, url being the url of their PACKAGES file.
+    Only the sections starting with 'repo:' are considered.
+    """
+    repos = []
+    for section in parser.sections():
+        if section.startswith('repo:'):
+            repos.append((section, parser.get(section, 'package')))
+    return repos
+
+
+def iter_lines(stream, compressed=False):
+    """ Yield the lines of the given stream as the bytes arrive.
+    If compressed is True, the stream is gunzipped on the fly.
+
+    :arg stream, a file-like object providing a read(size) method.
+    :arg compressed, whether the content of the stream is gzipped.
+    """
+    decompressor = None
+    if compressed:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    pending = ''
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        if decompressor:
+            chunk = decompressor.decompress(chunk)
+        pending = pending + chunk
+        lines = pending.split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line.rstrip('\r')
+    if decompressor:
+        pending = pending + decompressor.flush()
+    for line in pending.split('\n'):
+        yield line.rstrip('\r')
+
+
+def iter_packages(lines):
+    """ Yield one dictionnary per package record found in the given
+    lines. Continuation lines are appended to the value of the field they
+    belong to, separated by a space.
+
+    :arg lines, an iterable of the lines of a PACKAGES file.
+    """
+    record = {}
+    key = None
+    for line in lines:
+        if not line.strip():
+            if record:
+                yield record
+            record = {}
+            key = None
+        elif line[0] in ' \t':
+            if key is not None:
+                record[key] = '%s %s' % (record[key], line.strip())
+        else:
+            match = FIELD.match(line)
+            if match:
+                key, value = match.groups()
+                record[key] = value.strip()
+    if record:
+        yield record
+
+
+def iter_file_packages(path, compressed=False):
+    """ Yield the package records of the PACKAGES file at the given path.
+
+    :arg path, the path to a local copy of a PACKAGES file.
+    :arg compressed, whether this copy is gzipped.
+    """
+    stream = open(path, 'rb')
+    try:
+        for record in iter_packages(iter_lines(stream, compressed)):
+            yield record
+    finally:
+        stream.close()
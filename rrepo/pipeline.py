@@ -0,0 +1,98 @@
+#-*- coding: utf-8 -*-
+
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# (C) 2011 - Pierre-Yves Chibon <pingou@pingoured.fr>
+
+
+"""
+Stages of threads linked by bounded queues.
+
+Each stage takes the items of its input queue, processes them with its
+own number of threads and puts the items it produces in the queue of the
+next stage, so that, for example, the sources of the next packages are
+retrieved while the previous ones build.
+"""
+
+import logging
+import threading
+
+LOG = logging.getLogger('rrepo')
+
+# Item marking the end of a queue
+STOP = None
+
+
+class Stage(object):
+    """ A pool of threads applying a function to the items of a queue. """
+
+    def __init__(self, name, function, nworkers, inqueue, outqueue=None):
+        """ Constructor, the threads are started right away.
+        :arg name, the name of the stage, used to name its threads.
+        :arg function, the function called on each item, it returns the
+        list of the items to give to the next stage.
+        :arg nworkers, the number of threads of the stage.
+        :arg inqueue, the Queue.Queue the items are read from, STOP being
+        put in it once all the items are.
+        :kwarg outqueue, the Queue.Queue the items produced are put in,
+        STOP is put in it once the stage is done.
+        """
+        self.name = name
+        self.function = function
+        self.inqueue = inqueue
+        self.outqueue = outqueue
+        self.errors = []
+        self.running = nworkers
+        self.lock = threading.Lock()
+        self.threads = []
+        for cnt in range(nworkers):
+            thread = threading.Thread(target=self.__work,
+                name='%s-%s' % (name, cnt + 1))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def __work(self):
+        """ Process the items of the input queue until STOP is found. """
+        while True:
+            item = self.inqueue.get()
+            if item is STOP:
+                # Let the other threads of the stage see it too
+                self.inqueue.put(STOP)
+                break
+            try:
+                outputs = self.function(item)
+            except Exception, err:
+                LOG.error('%s failed on %s: %s' % (self.name, item, err))
+                self.errors.append((item, err))
+                continue
+            if self.outqueue is not None:
+                for output in outputs:
+                    self.outqueue.put(output)
+        self.lock.acquire()
+        try:
+            self.running = self.running - 1
+            last = not self.running
+        finally:
+            self.lock.release()
+        if last and self.outqueue is not None:
+            self.outqueue.put(STOP)
+
+    def join(self):
+        """ Wait for all the threads of the stage to finish. """
+        for thread in self.threads:
+            # A timeout keeps the wait interruptible with Ctrl-C
+            while thread.is_alive():
+                thread.join(1)
@@ -0,0 +1,290 @@
+#-*- coding: utf-8 -*-
+
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# (C) 2011 - Pierre-Yves Chibon <pingou@pingoured.fr>
+
+
+"""
+Resolution of the R libraries provided by the R-core RPM.
+
+The list of libraries provided depends only on the version of R-core, it
+is therefore cached on disk per R-core epoch:version-release (EVR). The
+list can be obtained from the package manager (repoquery) or directly
+from the primary.xml.gz of a local copy of the repository metadata, which
+may contain several versions of R-core. The EVR of the installed R-core
+is cached as well until the RPM database changes, the one of the R-core
+available in the repositories until R-core gets installed or a refresh is
+requested.
+"""
+
+import gzip
+import logging
+import os
+import tempfile
+from subprocess import Popen, PIPE
+from xml.etree import cElementTree as ElementTree
+
+from rrepo.fetch import CACHE_DIR
+
+LOG = logging.getLogger('rrepo')
+
+COMMON_NS = '{http://linux.duke.edu/metadata/common}'
+RPM_NS = '{http://linux.duke.edu/metadata/rpm}'
+
+# Files of the RPM database, modified when a package is installed,
+# upgraded or removed
+RPMDB_FILES = ('/var/lib/rpm/Packages', '/var/lib/rpm/rpmdb.sqlite')
+
+
+def format_evr(epoch, version, release):
+    """ Return the epoch:version-release string of a package, the epoch
+    being 0 if the package does not define it.
+    """
+    if not epoch or epoch == '(none)':
+        epoch = '0'
+    return '%s:%s-%s' % (epoch, version, release)
+
+
+def normalize_evr(evr):
+    """ Return the given [epoch:]version-release with its epoch, 0 if it
+    is not given, eg: 3.0.1-1 gives 0:3.0.1-1.
+    """
+    if ':' not in evr:
+        return '0:%s' % evr
+    return evr
+
+
+def get_rpmdb_mtime():
+    """ Return the last time the RPM database was modified, 0 if it could
+    not be found.
+    """
+    mtimes = [os.path.getmtime(path) for path in RPMDB_FILES
+        if os.path.exists(path)]
+    return max(mtimes or [0])
+
+
+def parse_provides(provides):
+    """ Return the set of R libraries found in the given list of provides
+    of R-core, eg: 'R-MASS = 7.3.16' provides the library MASS.
+    """
+    libraries = set()
+    for prov in provides:
+        if prov.startswith('R-'):
+            libraries.add(prov.split(' ')[0].split('R-', 1)[1])
+    return libraries
+
+
+def get_installed_evr():
+    """ Return the EVR of the installed R-core or None if it is not
+    installed.
+    """
+    cmd = ['rpm', '-q', '--qf', '%{EPOCH} %{VERSION} %{RELEASE}\n',
+        'R-core']
+    LOG.debug(cmd)
+    process = Popen(cmd, stdout=PIPE)
+    output = process.communicate()[0]
+    if process.returncode:
+        return None
+    return format_evr(*output.split('\n')[0].split(' '))
+
+
+def get_available_evr():
+    """ Return the EVR of the R-core available in the repositories or
+    None if it could not be found.
+    """
+    cmd = ['repoquery', '--qf', '%{epoch} %{version} %{release}', 'R-core',
+        '--disablerepo=r-repo']
+    LOG.debug(cmd)
+    output = Popen(cmd, stdout=PIPE).communicate()[0].strip()
+    if not output:
+        return None
+    return format_evr(*output.split('\n')[-1].split(' '))
+
+
+def query_provides(evr):
+    """ Return the set of R libraries provided by the given version of
+    R-core, according to repoquery.
+    """
+    version = evr.split(':', 1)[1]
+    cmd = ['repoquery', '--provides', 'R-core-%s' % version,
+        '--disablerepo=r-repo']
+    LOG.debug(cmd)
+    output = Popen(cmd, stdout=PIPE).communicate()[0]
+    return parse_provides(output.split('\n'))
+
+
+def read_primary(primary):
+    """ Return a dictionnary associating the EVR of each R-core found in
+    the given primary.xml(.gz) file to the set of R libraries it provides.
+    The file is parsed as a stream, only one package is kept in memory at
+    a time.
+
+    :arg primary, the path to the primary.xml or primary.xml.gz file.
+    """
+    if primary.endswith('.gz'):
+        stream = gzip.open(primary)
+    else:
+        stream = open(primary)
+    provides = {}
+    try:
+        for _, element in ElementTree.iterparse(stream):
+            if element.tag != COMMON_NS + 'package':
+                continue
+            if element.findtext(COMMON_NS + 'name') == 'R-core':
+                version = element.find(COMMON_NS + 'version')
+                evr = format_evr(version.get('epoch'), version.get('ver'),
+                    version.get('rel'))
+                entries = element.findall('%sformat/%sprovides/%sentry' % (
+                    COMMON_NS, RPM_NS, RPM_NS))
+                provides[evr] = parse_provides(
+                    [entry.get('name') for entry in entries])
+            element.clear()
+    finally:
+        stream.close()
+    return provides
+
+
+class ProvidesCache(object):
+    """ On-disk cache of the R libraries provided by each version of
+    R-core.
+    """
+
+    def __init__(self, cachedir=CACHE_DIR):
+        """ Constructor.
+        :kwarg cachedir, the directory in which the lists are stored.
+        """
+        self.cachedir = os.path.join(cachedir, 'provides')
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+
+    def __get_path(self, evr):
+        """ Return the file in which the list of the given EVR is stored.
+        """
+        return os.path.join(self.cachedir, 'R-core-%s' % evr)
+
+    def __write(self, path, lines):
+        """ Atomically replace the given file with the given lines. """
+        fd, tmp = tempfile.mkstemp(dir=self.cachedir, suffix='.part')
+        stream = os.fdopen(fd, 'w')
+        try:
+            for line in lines:
+                stream.write(line + '\n')
+        finally:
+            stream.close()
+        os.rename(tmp, path)
+
+    def __read_current(self):
+        """ Return the origin ('installed' or 'available') and the EVR of
+        the R-core found by the last call to find_current, as well as when
+        it was found, (None, None, 0) if it is not known.
+        """
+        path = os.path.join(self.cachedir, 'current')
+        if not os.path.exists(path):
+            return (None, None, 0)
+        stream = open(path)
+        try:
+            fields = stream.read().split()
+        finally:
+            stream.close()
+        if len(fields) != 2:
+            return (None, None, 0)
+        return (fields[0], fields[1], os.path.getmtime(path))
+
+    def find_current(self, refresh=False):
+        """ Return the EVR of the installed R-core or, if it is not
+        installed, of the one available in the repositories.
+        The EVR found by the previous call is used as long as the RPM
+        database did not change since, and the one found in the
+        repositories as long as R-core is not installed.
+
+        :kwarg refresh, whether to ask the package manager even if the EVR
+        found by a previous call is known.
+        """
+        origin, evr, found = self.__read_current()
+        if refresh:
+            origin = evr = None
+        elif evr is not None and get_rpmdb_mtime() < found:
+            return evr
+        path = os.path.join(self.cachedir, 'current')
+        installed = get_installed_evr()
+        if installed is not None:
+            self.__write(path, ['installed %s' % installed])
+            return installed
+        if origin != 'available':
+            evr = get_available_evr()
+            if evr is None:
+                raise ValueError('Could not find the version of R-core')
+        # Rewritten even if unchanged: the RPM database was checked
+        self.__write(path, ['available %s' % evr])
+        return evr
+
+    def get(self, evr):
+        """ Return the set of libraries provided by the given R-core EVR
+        or None if it is not in the cache.
+        """
+        path = self.__get_path(evr)
+        if not os.path.exists(path):
+            return None
+        stream = open(path)
+        try:
+            return set([line.strip() for line in stream if line.strip()])
+        finally:
+            stream.close()
+
+    def set(self, evr, libraries):
+        """ Store the set of libraries provided by the given R-core EVR.
+        """
+        self.__write(self.__get_path(evr), sorted(libraries))
+
+    def resolve(self, evrs=None, primary=None, refresh=False):
+        """ Return a dictionnary associating R-core EVRs to the set of
+        libraries they provide.
+
+        :kwarg evrs, the list of EVRs to resolve, the epoch defaulting to
+        0 when not given. If None, all the R-core found in primary are
+        returned or, if primary is None, the installed R-core or the one
+        available in the repositories (see find_current).
+        :kwarg primary, the path to a primary.xml(.gz) file to read the
+        provides from instead of asking the package manager.
+        :kwarg refresh, whether to ask the package manager for the EVR of
+        the installed or available R-core instead of using the one found
+        by the previous run.
+        """
+        if primary is not None:
+            found = read_primary(primary)
+            for evr, libraries in found.iteritems():
+                self.set(evr, libraries)
+            if evrs is None:
+                return found
+        elif evrs is None:
+            evrs = [self.find_current(refresh)]
+        evrs = [normalize_evr(evr) for evr in evrs]
+
+        provides = {}
+        for evr in evrs:
+            libraries = self.get(evr)
+            if libraries is None:
+                if primary is not None:
+                    raise ValueError('R-core %s not found in %s' % (evr,
+                        primary))
+                LOG.debug('R-core %s not in the cache' % evr)
+                libraries = query_provides(evr)
+                if not libraries:
+                    raise ValueError('Could not find the provides of R-core %s'
+                        % evr)
+                self.set(evr, libraries)
+            provides[evr] = libraries
+        return provides
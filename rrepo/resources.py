@@ -0,0 +1,258 @@
+#-*- coding: utf-8 -*-
+
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# (C) 2011 - Pierre-Yves Chibon <pingou@pingoured.fr>
+
+
+"""
+Admission control of the builds according to the resources of the
+machine.
+
+A build is only started if the memory available, the free space of the
+results directory and the load of the machine allow it, taking into
+account how much memory and disk the package used in the previous builds
+and what the builds already running are expected to use.
+"""
+
+import logging
+import os
+import resource
+import threading
+
+LOG = logging.getLogger('rrepo')
+
+MEGABYTE = 1024 * 1024
+
+# Memory and disk space kept free for the rest of the system (bytes)
+MEMORY_RESERVE = 1024 * MEGABYTE
+DISK_RESERVE = 2048 * MEGABYTE
+
+# Number of seconds between two measures of the memory used by a build
+RSS_POLL = 1
+
+
+def get_available_memory(meminfo='/proc/meminfo'):
+    """ Return the memory available for new processes in bytes, as
+    reported by the kernel, or estimated from the free and cache memory
+    on kernels not reporting it.
+    """
+    values = {}
+    stream = open(meminfo)
+    try:
+        for line in stream:
+            key, value = line.split(':', 1)
+            values[key] = int(value.split()[0]) * 1024
+    finally:
+        stream.close()
+    if 'MemAvailable' in values:
+        return values['MemAvailable']
+    return values.get('MemFree', 0) + values.get('Buffers', 0) \
+        + values.get('Cached', 0)
+
+
+def get_free_disk(path):
+    """ Return the space available to a non-root user on the filesystem
+    of the given path in bytes.
+    """
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def get_children_peak_rss():
+    """ Return the highest resident set size reached by a terminated
+    child (or descendant) of the current process, in bytes.
+    """
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+
+def get_descendants_rss(pid, proc='/proc'):
+    """ Return the total resident set size of the running descendants of
+    the given process, in bytes.
+    """
+    children = {}
+    rss = {}
+    for entry in os.listdir(proc):
+        if not entry.isdigit():
+            continue
+        try:
+            stream = open(os.path.join(proc, entry, 'stat'))
+            try:
+                stat = stream.read()
+            finally:
+                stream.close()
+        except IOError:
+            # The process terminated in the meantime
+            continue
+        # The name of the command, in parentheses, may contain spaces
+        fields = stat[stat.rfind(')') + 2:].split()
+        children.setdefault(int(fields[1]), []).append(int(entry))
+        rss[int(entry)] = int(fields[21])
+    total = 0
+    pending = list(children.get(pid, []))
+    while pending:
+        child = pending.pop()
+        total = total + rss[child]
+        pending.extend(children.get(child, []))
+    return total * resource.getpagesize()
+
+
+class PeakRss(object):
+    """ Measure the highest memory used by the processes started by the
+    current process within a with block, eg: one build, as the total
+    resident set size of its descendants polled every RSS_POLL seconds,
+    or the one of a single descendant terminated within the block if it
+    is higher (which catches the peaks shorter than the polling interval).
+    """
+
+    def __init__(self, interval=RSS_POLL):
+        """ Constructor.
+        :kwarg interval, the number of seconds between two measures.
+        """
+        self.interval = interval
+        self.peak = None
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__children_peak = None
+
+    def __poll(self):
+        """ Record the memory used by the descendants until the end of
+        the block.
+        """
+        pid = os.getpid()
+        while True:
+            try:
+                self.peak = max(self.peak, get_descendants_rss(pid))
+            except (IOError, OSError), err:
+                LOG.debug('Could not measure the memory used: %s' % err)
+            if self.__stop.wait(self.interval):
+                break
+
+    def __enter__(self):
+        self.__children_peak = get_children_peak_rss()
+        self.__thread = threading.Thread(target=self.__poll,
+            name='PeakRss')
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.__stop.set()
+        self.__thread.join()
+        # The descendants measured by getrusage are those of all the
+        # blocks run by this process, only an increase is ours
+        children_peak = get_children_peak_rss()
+        if children_peak > self.__children_peak:
+            self.peak = max(self.peak, children_peak)
+        if not self.peak:
+            self.peak = None
+        return False
+
+
+def get_result_size(resultdir, package, since):
+    """ Return the size in bytes of the files written in the results
+    directory for the given package since the given time.
+    """
+    size = 0
+    prefix = 'R-%s-' % package
+    for entry in os.listdir(resultdir):
+        if not entry.startswith(prefix):
+            continue
+        try:
+            stat = os.stat(os.path.join(resultdir, entry))
+        except OSError:
+            continue
+        if stat.st_mtime >= since:
+            size = size + stat.st_size
+    return size
+
+
+class Admission(object):
+    """ Decide whether a new build can be started given the resources
+    left on the machine.
+    """
+
+    def __init__(self, resultdir, estimates, max_load=None,
+            memory_reserve=MEMORY_RESERVE, disk_reserve=DISK_RESERVE):
+        """ Constructor.
+        :arg resultdir, the directory in which mock writes the results.
+        :arg estimates, a dictionnary associating the packages to the
+        (memory, disk) in bytes their build is expected to use.
+        :kwarg max_load, no build is started while the load average of
+        the last minute is above this value, by default twice the number
+        of processors.
+        :kwarg memory_reserve, the memory to keep free, in bytes.
+        :kwarg disk_reserve, the disk space to keep free, in bytes.
+        """
+        self.resultdir = resultdir
+        self.estimates = estimates
+        self.max_load = max_load
+        if max_load is None:
+            self.max_load = 2 * os.sysconf('SC_NPROCESSORS_ONLN')
+        self.memory_reserve = memory_reserve
+        self.disk_reserve = disk_reserve
+        # Memory usable by the builds, measured before any is started
+        self.memory_budget = get_available_memory() - memory_reserve
+        self.running = {}
+
+    def get_estimate(self, name):
+        """ Return the (memory, disk) the build of the given package is
+        expected to use.
+        """
+        return self.estimates.get(name, (0, 0))
+
+    def admit(self, name):
+        """ Return whether the build of the given package can start now.
+        A build is always admitted when no other is running, so that a
+        package larger than the machine is still built, alone. The free
+        disk space is only checked once the results directory exists.
+        """
+        if not self.running:
+            return True
+        memory, disk = self.get_estimate(name)
+        committed_memory = sum([est[0] for est in self.running.values()])
+        committed_disk = sum([est[1] for est in self.running.values()])
+        load = os.getloadavg()[0]
+        if load > self.max_load:
+            LOG.debug('Holding %s: load %.1f' % (name, load))
+            return False
+        # The running builds may not have reached their peak yet
+        if committed_memory + memory > self.memory_budget \
+                or memory > get_available_memory() - self.memory_reserve:
+            LOG.debug('Holding %s: %s MiB of memory needed' % (name,
+                memory / MEGABYTE))
+            return False
+        # mock creates the results directory with the first build
+        if os.path.isdir(self.resultdir) \
+                and committed_disk + disk > get_free_disk(self.resultdir) \
+                - self.disk_reserve:
+            LOG.debug('Holding %s: %s MiB of disk needed' % (name,
+                disk / MEGABYTE))
+            return False
+        return True
+
+    def start(self, name):
+        """ Record that the build of the given package started. """
+        self.running[name] = self.get_estimate(name)
+
+    def finish(self, name, since):
+        """ Record that the build of the given package, started at the
+        given time, finished and return the size of its results, None if
+        the results directory does not exist.
+        """
+        self.running.pop(name, None)
+        if not os.path.isdir(self.resultdir):
+            return None
+        return get_result_size(self.resultdir, name, since)
@@ -0,0 +1,418 @@
+#-*- coding: utf-8 -*-
+
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# (C) 2011 - Pierre-Yves Chibon <pingou@pingoured.fr>
+
+
+"""
+Scheduling of the builds of a dependency graph on a pool of processes.
+
+Instead of building the packages level by level, each package is started
+as soon as all its own dependencies are built, the ready packages with
+the longest critical path being started first, as long as the resources
+of the machine allow it (see rrepo.resources).
+"""
+
+import errno
+import heapq
+import logging
+import os
+import Queue
+import shutil
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+from rrepo.graph import ReadyQueue, critical_path_lengths, reverse_graph
+from rrepo.metrics import METRICS, pop_build_phases
+from rrepo.resources import PeakRss, get_result_size
+
+LOG = logging.getLogger('rrepo')
+
+# Maximum number of seconds waited for a build to finish
+WAIT_TIMEOUT = 7 * 24 * 3600
+
+# Number of seconds between two checks of the builds the pool may have
+# lost, eg: when a worker was killed
+TASK_POLL = 10
+
+# Number of seconds between two checks of the resources while builds are
+# held back
+ADMISSION_POLL = 30
+
+
+def call(function, args, pidfile=None):
+    """ Run function with the given arguments in a worker of the pool and
+    return its output together with the error it raised, if any, as the
+    pool does not report errors to the callbacks, its start time, its wall
+    time, the peak memory used by the processes it ran (see
+    rrepo.resources.PeakRss), None if it could not be measured, and the
+    duration of the steps timed with rrepo.metrics.build_phase.
+
+    :kwarg pidfile, a file in which the PID of the worker is written
+    first, so that the scheduler notices if the worker dies.
+    """
+    if pidfile is not None:
+        stream = open(pidfile, 'w')
+        try:
+            stream.write('%s\n' % os.getpid())
+        finally:
+            stream.close()
+    start = time.time()
+    error = None
+    output = None
+    pop_build_phases()
+    with PeakRss() as rss:
+        try:
+            output = function(*args)
+        except Exception, err:
+            error = '%s' % err
+    return (output, error, start, time.time() - start, rss.peak,
+        pop_build_phases())
+
+
+def simulate(graph, durations, nworkers, priorities=None):
+    """ Simulate the build of the given graph and return the estimated
+    makespan (in seconds) and the critical path, the longest chain of
+    builds of the graph.
+
+    :arg graph, the dependency graph as described in rrepo.graph.
+    :arg durations, a dictionnary associating each package to its
+    expected build time.
+    :arg nworkers, the number of builds run in parallel.
+    :kwarg priorities, the priorities of the packages in the ready queue,
+    by default their critical path length as used by DagScheduler.
+    """
+    lengths = critical_path_lengths(graph, durations)
+    if priorities is None:
+        priorities = lengths
+    rdeps = reverse_graph(graph)
+    waiting = dict([(name, len(set([dep for dep in deps if dep in graph])))
+        for name, deps in graph.iteritems()])
+    ready = ReadyQueue(priorities)
+    for name in graph:
+        if not waiting[name]:
+            ready.push(name)
+
+    now = 0
+    running = []
+    while ready or running:
+        while ready and len(running) < nworkers:
+            name = ready.pop()
+            heapq.heappush(running, (now + durations[name], name))
+        now, name = heapq.heappop(running)
+        for rdep in rdeps[name]:
+            waiting[rdep] = waiting[rdep] - 1
+            if not waiting[rdep]:
+                ready.push(rdep)
+
+    path = []
+    candidates = [name for name in lengths
+        if not [dep for dep in graph[name] if dep in graph]]
+    while candidates:
+        name = max(candidates, key=lambda name: (lengths.get(name, 0), name))
+        path.append(name)
+        candidates = [rdep for rdep in rdeps[name] if rdep in lengths]
+    return (now, path)
+
+
+def print_simulation(graph, durations, nworkers, priorities=None):
+    """ Simulate the build of the given graph (see simulate), print the
+    estimated makespan and critical path and return the makespan.
+    """
+    makespan, path = simulate(graph, durations, nworkers, priorities)
+    print 'Estimated makespan on %s cores: %s' % (nworkers,
+        timedelta(seconds=int(makespan)))
+    print 'Critical path (%s): %s' % (
+        timedelta(seconds=int(sum([durations[name] for name in path]))),
+        ' -> '.join(path))
+    return makespan
+
+
+def get_queue_priorities(names):
+    """ Return priorities making the ready queue a FIFO of the given list
+    of packages, as a pool running the builds in their order would.
+    """
+    return dict([(name, -cnt) for cnt, name in enumerate(names)])
+
+
+class ResultFiles(object):
+    """ Files listing the packages according to the outcome of their
+    build, a package being appended to its file as soon as its build
+    finishes.
+    """
+
+    def __init__(self, filenames, mode='w'):
+        """ Constructor.
+        :arg filenames, a dictionnary associating each outcome ('succeed',
+        'failed', 'skipped') to the file listing its packages.
+        :kwarg mode, 'w' to start with empty files, 'a' to append to the
+        existing ones.
+        """
+        self.streams = {}
+        for outcome, filename in filenames.iteritems():
+            self.streams[outcome] = open(filename, mode)
+
+    def write(self, outcome, name):
+        """ Add the given package to the file of the given outcome. """
+        if outcome in self.streams:
+            self.streams[outcome].write(name + '\n')
+            self.streams[outcome].flush()
+
+    def close(self):
+        """ Close all the files. """
+        for stream in self.streams.values():
+            stream.close()
+
+
+class Progress(object):
+    """ Report the progress of a run as its builds finish: number of
+    packages done, throughput and estimated time left.
+    """
+
+    def __init__(self, total):
+        """ Constructor.
+        :arg total, the number of packages of the run.
+        """
+        self.total = total
+        self.done = 0
+        self.outcomes = {}
+        self.start = time.time()
+
+    def update(self, name, outcome, count=1):
+        """ Report that count packages, the last one being name, are done
+        with the given outcome.
+        """
+        self.done = self.done + count
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + count
+        elapsed = time.time() - self.start
+        rate = self.done / max(elapsed, 1)
+        eta = (self.total - self.done) / rate
+        print '[%s/%s] %s %s - %s failed, %s skipped - %.1f packages/h' \
+            ' - ETA %s' % (self.done, self.total, name, outcome,
+                self.outcomes.get('failed', 0),
+                self.outcomes.get('skipped', 0), rate * 3600,
+                timedelta(seconds=int(eta)))
+        sys.stdout.flush()
+
+
+class DagScheduler(object):
+    """ Run the builds of the packages of a dependency graph on a pool of
+    processes, respecting their dependencies.
+    """
+
+    def __init__(self, pool, nworkers, graph, weights=None, history=None,
+            mock_config=None, priorities=None, admission=None,
+            resultdir=None):
+        """ Constructor.
+        :arg pool, the multiprocessing Pool running the builds.
+        :arg nworkers, the number of workers of the pool, no more builds
+        are submitted to the pool at once so that the priorities are
+        respected.
+        :arg graph, the dependency graph as described in rrepo.graph.
+        :kwarg weights, a dictionnary associating packages to their
+        expected build time, used to compute the critical paths.
+        :kwarg history, the rrepo.history.BuildHistory in which the builds
+        are recorded.
+        :kwarg mock_config, the mock configuration the builds use, as
+        recorded in the history.
+        :kwarg priorities, the priorities of the packages in the ready
+        queue, by default the length of their critical path.
+        :kwarg admission, the rrepo.resources.Admission deciding whether
+        the next build can start, all the workers are used if None.
+        :kwarg resultdir, the directory in which the builds write their
+        results, to measure their size when there is no admission.
+        """
+        self.pool = pool
+        self.nworkers = nworkers
+        self.graph = graph
+        self.rdeps = reverse_graph(graph)
+        self.priorities = priorities
+        if priorities is None:
+            self.priorities = critical_path_lengths(graph, weights)
+        self.history = history
+        self.mock_config = mock_config
+        self.admission = admission
+        self.resultdir = resultdir
+
+    def run(self, function, get_args, results=None):
+        """ Build all the packages of the graph and return the lists of
+        the packages which succeeded, failed and which were skipped
+        because one of their dependencies failed.
+        The results are collected in the order the builds finish and the
+        progress of the run is printed as they do.
+
+        :arg function, the function building a package, it must return
+        something evaluating to False on success.
+        :arg get_args, a function returning the tuple of arguments to
+        give to function for a given package.
+        :kwarg results, a ResultFiles to which the packages are written as
+        soon as their outcome is known.
+        """
+        done = Queue.Queue()
+        waiting = dict([(name, len(set([dep for dep in deps
+            if dep in self.graph]))) for name, deps in self.graph.iteritems()])
+        ready = ReadyQueue(self.priorities)
+        # When each package became ready to be built
+        readied = {}
+        for name in self.graph:
+            if not waiting[name]:
+                ready.push(name)
+                readied[name] = time.time()
+
+        progress = Progress(len(self.graph))
+        outcomes = {'succeed': [], 'failed': [], 'skipped': []}
+        started = {}
+        # The AsyncResult of each running build and the file in which its
+        # worker writes its PID
+        tasks = {}
+        piddir = tempfile.mkdtemp(prefix='rrepo-scheduler-')
+        try:
+            while ready or started:
+                while ready and len(started) < self.nworkers:
+                    name = ready.pop()
+                    if self.admission is not None \
+                            and not self.admission.admit(name):
+                        # Keep the priorities: wait for resources to free up
+                        ready.push(name)
+                        break
+                    LOG.debug('Starting %s' % name)
+                    started[name] = time.time()
+                    if self.admission is not None:
+                        self.admission.start(name)
+                    fd, pidfile = tempfile.mkstemp(dir=piddir)
+                    os.close(fd)
+                    tasks[name] = (self.pool.apply_async(call, (function,
+                        get_args(name), pidfile), callback=lambda result,
+                        name=name: done.put((name, result))), pidfile)
+
+                # A timeout keeps the wait interruptible with Ctrl-C and
+                # lets the held builds be admitted again
+                try:
+                    name, (output, error, start, duration, rss, phases) = \
+                        done.get(True, min(TASK_POLL, ADMISSION_POLL))
+                except Queue.Empty:
+                    # The callback is not called for the builds the pool
+                    # lost: report them as failed
+                    for lost, error in self.__find_lost(tasks, started):
+                        done.put((lost, (None, error, started[lost],
+                            time.time() - started[lost], None, {})))
+                    continue
+                tasks.pop(name, None)
+                disk = None
+                if self.admission is not None:
+                    disk = self.admission.finish(name, started[name])
+                elif self.resultdir is not None \
+                        and os.path.isdir(self.resultdir):
+                    disk = get_result_size(self.resultdir, name, started[name])
+                del started[name]
+                if error is not None:
+                    print "ERROR:", error
+                    print "On:", name
+                outcome = 'succeed'
+                if output or error is not None:
+                    outcome = 'failed'
+                if self.history is not None:
+                    self.history.record(name, self.mock_config, duration,
+                        outcome, rss, disk)
+                METRICS.add_build(name, outcome, start, duration,
+                    start - readied.pop(name), phases.get('mock_init'), disk,
+                    rss, self.mock_config)
+                outcomes[outcome].append(name)
+                if results is not None:
+                    results.write(outcome, name)
+                progress.update(name, outcome)
+
+                if outcome == 'failed':
+                    skipped = self.__skip(name, outcomes['skipped'])
+                    outcomes['skipped'].extend(skipped)
+                    for rdep in skipped:
+                        if results is not None:
+                            results.write('skipped', rdep)
+                    if skipped:
+                        progress.update('%s dependent packages' % len(skipped),
+                            'skipped', len(skipped))
+                    continue
+                for rdep in self.rdeps[name]:
+                    waiting[rdep] = waiting[rdep] - 1
+                    if not waiting[rdep]:
+                        ready.push(rdep)
+                        readied[rdep] = time.time()
+        finally:
+            shutil.rmtree(piddir, True)
+
+        cycle = len(self.graph) - progress.done
+        if cycle:
+            LOG.info('%s packages never became ready (dependency cycle)'
+                % cycle)
+        return (outcomes['succeed'], outcomes['failed'], outcomes['skipped'])
+
+    @staticmethod
+    def __find_lost(tasks, started):
+        """ Return the list of the (package, error) of the running builds
+        whose result will never reach the callback: the result could not
+        be sent back (eg: it cannot be pickled), the worker running the
+        build died (eg: killed by the OOM killer) or the build ran for
+        more than WAIT_TIMEOUT seconds. They are removed from tasks.
+        """
+        lost = []
+        for name, (task, pidfile) in tasks.items():
+            error = None
+            if task.ready():
+                if task.successful():
+                    # The result is already in the queue
+                    continue
+                try:
+                    task.get(0)
+                except Exception, err:
+                    error = 'The result of the build was lost: %s' % err
+            elif time.time() - started[name] > WAIT_TIMEOUT:
+                error = 'The build did not finish within %s' % timedelta(
+                    seconds=WAIT_TIMEOUT)
+            else:
+                stream = open(pidfile)
+                try:
+                    # Empty until a worker starts the build
+                    pid = int(stream.read().strip() or 0)
+                finally:
+                    stream.close()
+                try:
+                    if pid:
+                        os.kill(pid, 0)
+                except OSError, err:
+                    if err.errno != errno.ESRCH:
+                        raise
+                    error = 'The worker building %s died' % name
+            if error is not None:
+                tasks.pop(name, None)
+                lost.append((name, error))
+        return lost
+
+    def __skip(self, name, already):
+        """ Return the packages depending, directly or not, on the given
+        failed package which are not in the list already skipped.
+        """
+        seen = set(already)
+        skipped = []
+        queue = [name]
+        while queue:
+            for rdep in self.rdeps[queue.pop()]:
+                if rdep not in seen:
+                    seen.add(rdep)
+                    skipped.append(rdep)
+                    queue.append(rdep)
+        return skipped
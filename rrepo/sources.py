@@ -0,0 +1,206 @@
+#-*- coding: utf-8 -*-
+
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# (C) 2011 - Pierre-Yves Chibon <pingou@pingoured.fr>
+
+
+"""
+Content-addressed cache of the source tarballs of the R packages.
+
+The tarballs are stored under the MD5 sum announced for them in the
+PACKAGES files, and only once they were checked against it, so that any
+file in the cache is complete. Interrupted downloads are resumed from
+where they stopped and several processes may share the cache.
+"""
+
+import fcntl
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import urllib2
+
+from rrepo.fetch import CACHE_DIR, CHUNK_SIZE
+
+LOG = logging.getLogger('rrepo')
+
+
+def get_md5(path):
+    """ Return the MD5 sum of the content of the given file. """
+    digest = hashlib.md5()
+    stream = open(path, 'rb')
+    try:
+        chunk = stream.read(CHUNK_SIZE)
+        while chunk:
+            digest.update(chunk)
+            chunk = stream.read(CHUNK_SIZE)
+    finally:
+        stream.close()
+    return digest.hexdigest()
+
+
+def is_complete_gzip(path):
+    """ Return whether the given file is a complete gzip file, used to
+    check the tarballs for which no MD5 sum is known.
+    """
+    stream = gzip.open(path, 'rb')
+    try:
+        while stream.read(CHUNK_SIZE):
+            pass
+    except (IOError, EOFError, ValueError):
+        return False
+    finally:
+        stream.close()
+    return True
+
+
+class SourceCache(object):
+    """ Cache of the source tarballs, shared by all the scripts. """
+
+    def __init__(self, cachedir=CACHE_DIR):
+        """ Constructor.
+        :kwarg cachedir, the root directory of the cache.
+        """
+        self.cachedir = os.path.join(cachedir, 'sources')
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+
+    def get_path(self, url, md5=None):
+        """ Return the path to the tarball with the given MD5 sum in the
+        cache, or to the one retrieved from the given url if no MD5 sum is
+        known.
+        """
+        if md5:
+            md5 = md5.lower()
+            return os.path.join(self.cachedir, md5[:2], md5)
+        key = hashlib.sha1(url).hexdigest()
+        return os.path.join(self.cachedir, 'url', key)
+
+    def fetch(self, url, md5=None):
+        """ Return the path to the tarball at the given url in the cache,
+        retrieving it if it is not there yet.
+        An IOError is raised if it cannot be retrieved or does not match
+        the given MD5 sum.
+        """
+        if md5:
+            md5 = md5.lower()
+        path = self.get_path(url, md5)
+        if os.path.exists(path):
+            return path
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                # Created meanwhile by another thread
+                if not os.path.isdir(folder):
+                    raise
+
+        part = path + '.part'
+        # Kept once the tarball is retrieved: the part file is renamed or
+        # removed while other processes may be waiting for the lock
+        lock = open(path + '.lock', 'ab')
+        try:
+            # Another process may be retrieving the same tarball
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            if os.path.exists(path):
+                return path
+            open(part, 'ab').close()
+            try:
+                resumed = self.__download(url, part)
+                if not self.__check(part, md5) and resumed:
+                    LOG.info('%s corrupted, retrieving it again' % url)
+                    open(part, 'wb').close()
+                    self.__download(url, part)
+                if not self.__check(part, md5):
+                    os.unlink(part)
+                    if md5:
+                        raise IOError('%s does not match its MD5 sum %s'
+                            % (url, md5))
+                    raise IOError('%s is not a complete tarball' % url)
+            except IOError:
+                # Keep what was retrieved to resume from it next time
+                if os.path.exists(part) and not os.path.getsize(part):
+                    os.unlink(part)
+                raise
+            os.rename(part, path)
+        finally:
+            lock.close()
+        LOG.debug('%s retrieved' % url)
+        return path
+
+    def __check(self, part, md5):
+        """ Return whether the retrieved file matches the given MD5 sum,
+        or is a complete gzip file if none is known.
+        """
+        if md5:
+            return get_md5(part) == md5
+        return is_complete_gzip(part)
+
+    def __download(self, url, part):
+        """ Retrieve the file at the given url into the file part,
+        resuming from its current size, and return whether the download
+        was resumed.
+        """
+        offset = os.path.getsize(part)
+        request = urllib2.Request(url)
+        if offset:
+            request.add_header('Range', 'bytes=%s-' % offset)
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError, err:
+            if offset and err.code == 416:
+                # Nothing left to retrieve
+                return True
+            raise
+        resumed = offset and response.getcode() == 206
+        try:
+            stream = open(part, 'r+b')
+            try:
+                if resumed:
+                    stream.seek(offset)
+                else:
+                    stream.truncate(0)
+                chunk = response.read(CHUNK_SIZE)
+                while chunk:
+                    stream.write(chunk)
+                    chunk = response.read(CHUNK_SIZE)
+            finally:
+                stream.close()
+        finally:
+            response.close()
+        return bool(resumed)
+
+
+def install_source(path, folder, filename):
+    """ Make the tarball at the given path in the cache available in the
+    given folder under the given name, as a hard link when possible.
+    """
+    target = os.path.join(folder, filename)
+    if os.path.exists(target) and os.path.samefile(path, target):
+        return target
+    fd, tmp = tempfile.mkstemp(dir=folder, suffix='.part')
+    os.close(fd)
+    os.unlink(tmp)
+    try:
+        os.link(path, tmp)
+    except OSError:
+        # Not on the same filesystem
+        shutil.copyfile(path, tmp)
+    os.rename(tmp, target)
+    return target
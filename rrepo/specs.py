@@ -0,0 +1,326 @@
+#-*- coding: utf-8 -*-
+
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# (C) 2011 - Pierre-Yves Chibon <pingou@pingoured.fr>
+
+
+"""
+Scanner and updater of the folder containing the spec files of the R
+packages.
+
+The Name, Version and Release of each spec, as well as the name of the R
+package it builds, are extracted in process by a pool of threads. The
+results are cached together with the modification time and size of the
+specs so that a new scan only reopens the specs which changed.
+
+The specs are updated to new versions in bulk, each one being written to
+a temporary file renamed over the original, so that a crash never leaves
+a half written spec, and the changed specs are then added to git at once.
+"""
+
+import datetime
+import json
+import logging
+import os
+import re
+import subprocess
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+from rrepo.fetch import CACHE_DIR
+from rrepo.version import is_newer
+
+LOG = logging.getLogger('rrepo')
+
+# Tags of the spec file extracted
+TAGS = ('Name', 'Version', 'Release')
+
+TAG = re.compile(r'^(%s)\s*:\s*(.*?)\s*$' % '|'.join(TAGS))
+MACRO_DEFINITION = re.compile(r'^%(?:global|define)\s+(\w+)\s+(.*?)\s*$')
+MACRO = re.compile(r'%\{\??(\w+)\}|%(\w+)')
+
+# Author of the changelog entries of the updated specs
+PACKAGER = 'Pierre-Yves Chibon <pingou@pingoured.fr>'
+
+
+def expand_macros(value, macros):
+    """ Expand in the given value the macros defined in the spec itself,
+    the unknown macros are left untouched.
+    """
+    def replace(match):
+        name = match.group(1) or match.group(2)
+        if name in macros:
+            return macros[name]
+        return match.group(0)
+    # Macros may be defined using other macros
+    for _ in range(5):
+        expanded = MACRO.sub(replace, value)
+        if expanded == value:
+            break
+        value = expanded
+    return value
+
+
+def parse_spec(specfile):
+    """ Return a dictionnary with the 'Name', 'Version' and 'Release' of
+    the given spec file and the name of the R package it builds as
+    'packname' (None if the spec does not define it).
+
+    :arg specfile, full path to the spec file to read.
+    """
+    macros = {}
+    info = dict([(tag, None) for tag in TAGS])
+    stream = open(specfile)
+    try:
+        for line in stream:
+            match = MACRO_DEFINITION.match(line)
+            if match:
+                macros[match.group(1)] = match.group(2)
+                continue
+            match = TAG.match(line)
+            if match and info[match.group(1)] is None:
+                info[match.group(1)] = match.group(2)
+                if match.group(1) == 'Name':
+                    macros['name'] = match.group(2)
+                elif match.group(1) == 'Version':
+                    macros['version'] = match.group(2)
+            if line.startswith('%description'):
+                # Nothing of interest after the preamble
+                break
+    finally:
+        stream.close()
+    for tag in TAGS:
+        if info[tag] is not None:
+            info[tag] = expand_macros(info[tag], macros)
+    packname = macros.get('packname')
+    if packname is not None:
+        packname = expand_macros(packname, macros)
+    info['packname'] = packname
+    return info
+
+
+def update_spec_content(content, version, packager=PACKAGER, date=None):
+    """ Return the given content of a spec file updated to the given
+    version: new Version, Release reset to 1 and a changelog entry, or
+    None if the spec is already at this version or a newer one.
+
+    :arg content, the content of the spec file.
+    :arg version, the new version of the R package.
+    :kwarg packager, the author of the changelog entry.
+    :kwarg date, the datetime of the changelog entry, now by default.
+    """
+    version = version.replace('-', '.')
+    spec = content.split('\n')
+    for line in spec:
+        if line.startswith('Version') and not is_newer(version,
+                line.strip().split(' ')[-1]):
+            return None
+
+    if date is None:
+        date = datetime.datetime.now()
+    entry = '* %s %s %s-1' % (date.strftime('%a %b %d %Y'), packager,
+        version)
+    cnt = 0
+    while cnt < len(spec):
+        line = spec[cnt]
+        if line.startswith('Version'):
+            newline = line.strip().split(' ')
+            newline[-1] = version
+            spec[cnt] = ' '.join(newline)
+        elif line.startswith('Release'):
+            newline = line.strip().split(' ')
+            newline[-1] = '1%{dist}'
+            spec[cnt] = ' '.join(newline)
+        elif line.startswith('%changelog'):
+            if cnt + 1 >= len(spec) or spec[cnt + 1] != entry:
+                spec[cnt + 1:cnt + 1] = [entry,
+                    '- Update to version %s' % version, '']
+            break
+        cnt = cnt + 1
+    return '\n'.join(spec)
+
+
+def write_atomic(path, content):
+    """ Replace the content of the given file by writing it to a temporary
+    file renamed over it, keeping its permissions.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+        suffix='.part')
+    try:
+        stream = os.fdopen(fd, 'w')
+        try:
+            stream.write(content)
+        finally:
+            stream.close()
+        if os.path.exists(path):
+            os.chmod(tmp, os.stat(path).st_mode & 07777)
+        os.rename(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+def update_spec(specfile, version, packager=PACKAGER, date=None):
+    """ Update the given spec file to the given version (see
+    update_spec_content) and return whether it changed.
+    An IOError is raised if the spec cannot be read or written.
+    """
+    stream = open(specfile)
+    try:
+        content = stream.read()
+    finally:
+        stream.close()
+    new_content = update_spec_content(content, version, packager, date)
+    if new_content is None or new_content == content:
+        return False
+    write_atomic(specfile, new_content)
+    LOG.debug('%s updated to %s' % (specfile, version))
+    return True
+
+
+def update_specs(versions, nthreads=8, packager=PACKAGER):
+    """ Update all the given spec files in parallel and return a
+    dictionnary associating each of them to whether it changed or to the
+    IOError raised while updating it.
+
+    :arg versions, a dictionnary associating the path to spec files to
+    the version they should be updated to.
+    :kwarg nthreads, the number of specs updated at once.
+    :kwarg packager, the author of the changelog entries.
+    """
+    if not versions:
+        return {}
+    date = datetime.datetime.now()
+
+    def update(item):
+        specfile, version = item
+        try:
+            return update_spec(specfile, version, packager, date)
+        except (IOError, OSError), err:
+            return err
+
+    items = versions.items()
+    pool = ThreadPool(min(nthreads, len(items)))
+    try:
+        results = pool.map(update, items)
+    finally:
+        pool.close()
+    return dict(zip([specfile for specfile, _ in items], results))
+
+
+def git_add(paths, cwd=None):
+    """ Stage the given files in git with a single git process and return
+    its exit code. The paths are given to git on its standard input when
+    they would not fit on the command line.
+
+    :arg paths, the list of the files to add.
+    :kwarg cwd, the working tree of the git repository.
+    """
+    if sum([len(path) + 1 for path in paths]) < os.sysconf('SC_ARG_MAX') / 2:
+        cmd = ['git', 'add', '--'] + paths
+        LOG.debug(' '.join(cmd))
+        return subprocess.call(cmd, cwd=cwd)
+    cmd = ['git', 'add', '--pathspec-from-file=-', '--pathspec-file-nul']
+    LOG.debug(' '.join(cmd))
+    process = subprocess.Popen(cmd, cwd=cwd, stdin=subprocess.PIPE)
+    process.communicate('\0'.join(paths))
+    return process.returncode
+
+
+class SpecScanner(object):
+    """ Scan a folder of spec files, reusing the information cached for
+    the specs which did not change since the previous scan.
+    """
+
+    def __init__(self, cachefile=os.path.join(CACHE_DIR, 'specs.json'),
+            nthreads=8):
+        """ Constructor.
+        :kwarg cachefile, the file in which the information about the
+        specs is cached.
+        :kwarg nthreads, the number of threads reading the specs.
+        """
+        self.cachefile = cachefile
+        self.nthreads = nthreads
+
+    def __load_cache(self):
+        """ Return the content of the cache, an empty one if it does not
+        exist or cannot be read.
+        """
+        if not os.path.exists(self.cachefile):
+            return {}
+        stream = open(self.cachefile)
+        try:
+            return json.load(stream)
+        except ValueError:
+            LOG.info('Could not read %s, ignoring it' % self.cachefile)
+            return {}
+        finally:
+            stream.close()
+
+    def __save_cache(self, cache):
+        """ Atomically write the given cache to the disk. """
+        folder = os.path.dirname(self.cachefile)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        fd, tmp = tempfile.mkstemp(dir=folder, suffix='.part')
+        stream = os.fdopen(fd, 'w')
+        try:
+            json.dump(cache, stream)
+        finally:
+            stream.close()
+        os.rename(tmp, self.cachefile)
+
+    def scan(self, folder):
+        """ Return a dictionnary associating the full path of each R-*.spec
+        file of the given folder to its information as returned by
+        parse_spec.
+
+        :arg folder, the folder containing the spec files.
+        """
+        folder = os.path.abspath(folder)
+        cache = self.__load_cache()
+        specs = {}
+        todo = []
+        for filename in os.listdir(folder):
+            if not (filename.endswith('.spec') and filename.startswith('R-')):
+                continue
+            path = os.path.join(folder, filename)
+            stat = os.stat(path)
+            signature = [stat.st_mtime, stat.st_size]
+            if path in cache and cache[path]['signature'] == signature:
+                specs[path] = cache[path]['info']
+            else:
+                todo.append((path, signature))
+
+        LOG.debug('%s specs cached, %s to read' % (len(specs), len(todo)))
+        if todo:
+            pool = ThreadPool(self.nthreads)
+            try:
+                infos = pool.map(parse_spec, [path for path, _ in todo])
+            finally:
+                pool.close()
+            for (path, signature), info in zip(todo, infos):
+                specs[path] = info
+                cache[path] = {'signature': signature, 'info': info}
+
+        # Forget about the specs removed from this folder
+        removed = [path for path in cache
+            if os.path.dirname(path) == folder and path not in specs]
+        for path in removed:
+            del cache[path]
+        if todo or removed:
+            self.__save_cache(cache)
+        return specs
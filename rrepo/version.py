@@ -0,0 +1,83 @@
+#-*- coding: utf-8 -*-
+
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# (C) 2011 - Pierre-Yves Chibon <pingou@pingoured.fr>
+
+
+"""
+Comparison of the versions of the R packages.
+
+The versions follow the semantic of R's package_version: a sequence of
+non-negative integers separated by '.' or '-', compared component by
+component, a version being older than any longer version it is a prefix
+of (1.0 < 1.0.0 < 1.0-1 == 1.0.1).
+Each version string is converted once into a tuple of integers, all
+comparisons are then simple tuple comparisons.
+"""
+
+import re
+
+# A valid R version, eg: 1.0, 1.0-2 or 2.10.1
+VALID_VERSION = re.compile(r'^\d+([.-]\d+)+$')
+SEPARATOR = re.compile(r'[.-]')
+DIGITS = re.compile(r'\d+')
+
+# Memoized results of version_key
+_KEYS = {}
+
+
+def version_key(version):
+    """ Return the tuple of integers used to compare the given version.
+    Versions R would refuse (eg: 1.0a, %{version}) are compared using the
+    numbers they contain.
+
+    :arg version, the version as found in a PACKAGES file or a spec.
+    """
+    try:
+        return _KEYS[version]
+    except KeyError:
+        pass
+    stripped = version.strip()
+    if VALID_VERSION.match(stripped):
+        key = tuple([int(part) for part in SEPARATOR.split(stripped)])
+    else:
+        key = tuple([int(part) for part in DIGITS.findall(stripped)])
+    _KEYS[version] = key
+    return key
+
+
+def is_newer(version, other):
+    """ Return whether version is newer than other. """
+    return version_key(version) > version_key(other)
+
+
+def get_newer(local, upstream):
+    """ Return the sorted list of the packages whose upstream version is
+    newer than the local one.
+    The packages absent from one of the dictionnaries are ignored.
+
+    :arg local, a dictionnary associating package names to the version
+    available locally.
+    :arg upstream, a dictionnary associating package names to their
+    version upstream.
+    """
+    newer = []
+    for name, version in local.iteritems():
+        if name in upstream and version_key(upstream[name]) > version_key(
+                version):
+            newer.append(name)
+    newer.sort()
+    return newer
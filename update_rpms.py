@@ -20,120 +20,52 @@
 #
 #***********************************************
 
-import urllib, re, os, subprocess, sys, datetime
+import argparse, ConfigParser, Queue, logging, os, threading
 from r2spec.r2spec_obj import RPackage
 from r2spec import get_rpm_tag
 from r2spec.build import Build
-
-def parseConfig(package):
-    ''' Returns a dictionnary of all the options available '''
-    COMMENT_CHAR = '#' # char for comments
-    OPTION_CHAR =  ':' # char used to separate option from value
-    
-    options = {}
-    for line in package:
-        # First, remove comments:
-        if COMMENT_CHAR in line:
-            # split on comment char, keep only the part before
-            line, comment = line.split(COMMENT_CHAR, 1)
-        # Second, find lines with an option=value:
-        if OPTION_CHAR in line:
-            # split on option char:
-            option, value = line.split(OPTION_CHAR, 1)
-            # strip spaces:
-            option = option.strip().lower()
-            value = value.strip()
-            # store in dictionary:
-            options[option] = value
-        else:
-            values = line.split(' ')
-            for value in values:
-                if value.strip() != '':
-                    options[option] += ' ' +value.strip()
-
-    return options
-
-def addToKnown(known, deps, source, filterlist):
-    ''' Add all the dependencies given in deps and the source
-        to the list given as known.
-    '''
-    for dep in deps:
-        p =  parseConfig( dep.split('\n') )
-        if p != {}:
-            if p['package'] in filterlist:
-                p['source'] = source
-                known[ p['package'] ] = p
-    return known
-
-def updateSpec(specfile, new_version):
-    ''' For a given package name, find the spec in the %_specdir and
-       update its version, release and changelog
+from rrepo.fetch import HttpCache
+from rrepo.index import load_index
+from rrepo.mockroot import prepare_root
+from rrepo.packages import get_repos
+from rrepo.pipeline import STOP, Stage
+from rrepo.sources import SourceCache, install_source
+from rrepo.specs import git_add, update_specs
+
+logging.basicConfig()
+
+def updateSpecs(versions, folder, nthreads):
+    ''' For the given dictionnary associating package names to their new
+       version, update in parallel their spec in the given folder
+       (version, release and changelog) and add the changed ones to git.
+       Return the list of the packages whose spec could not be updated.
     '''
-    new_version = new_version.replace('-','.')
-    if not os.path.exists(specfile):
-        print 'ERROR: spec file "%s" not found' % specfile
-        return 1
-    else:
-        print ' ** Updating spec: %s' % specfile
-        f = open(specfile)
-        s = f.read()
-        f.close()
-        spec = s.split('\n')
-        
-        cnt = 0
-        for line in spec:
-            # Update version
-            if line.startswith('Version'):
-                newline = line.strip().split(' ')
-                newline[len(newline) -1] = new_version
-                newline = ' '.join(newline)
-                if newline != line:
-                    print ' Update version'
-                    spec[cnt] = newline
-            # Update release
-            if line.startswith('Release'):
-                newline = line.strip().split(' ')
-                newline[len(newline) -1] = '1%{dist}'
-                newline = ' '.join(newline)
-                if newline != line:
-                    print ' Update release'
-                    spec[cnt] = newline
-            # Update changelog
-            if line.startswith('%changelog'):
-                date= datetime.datetime.now().strftime('%a %b %d %Y')
-                string1 = '* %s Pierre-Yves Chibon <pingou@pingoured.fr> %s-1' %(date, new_version)
-                string2 ='- Update to version %s'%(new_version)
-                if spec[cnt+1] != string1:
-                    print ' Update changelog'
-                    spec.insert(cnt+1, string1)
-                    spec.insert(cnt+2, string2)
-                    spec.insert(cnt+3, '')
-            
-            # Counter for the rows
-            cnt = cnt + 1
-            
-    # Write down the new spec
-    spec = '\n'.join(spec)
-    if spec != s:
-        f = open(specfile, 'w')
-        s = f.write(spec)
-        f.close()
-    
-    return 0
-
-def downloadSources(url):
-    ''' For a given url to a tarball, check if the sources
-       are already in the %_sourcedir, else download them.
+    specs = dict([(os.path.join(folder, 'R-%s.spec' % package), package)
+        for package in versions])
+    results = update_specs(dict([(specfile, versions[package])
+        for specfile, package in specs.items()]), nthreads)
+    failed = []
+    changed = []
+    for specfile in sorted(results):
+        if isinstance(results[specfile], EnvironmentError):
+            print 'ERROR: spec file "%s" could not be updated: %s' % (
+                specfile, results[specfile])
+            failed.append(specs[specfile])
+        elif results[specfile]:
+            changed.append(os.path.basename(specfile))
+    print '%s spec files updated' % len(changed)
+    if changed and git_add(changed, folder):
+        print 'ERROR: the spec files could not be added to git'
+    return failed
+
+def downloadSource(record, cache, sourcedir):
+    ''' For the given record of a package in the repositories, retrieve
+       its tarball in the shared cache, checking it against its MD5 sum,
+       and place it in the sourcedir.
     '''
-    start_folder = os.getcwd()
-    os.chdir(get_rpm_tag('_sourcedir'))
-    tarball = url.rsplit('/',1)[1]
-    if os.path.exists(tarball):
-        print '%s already there, no need to re-download it'%tarball
-    else:
-        cmd = 'wget %s' % url
-        outcode = subprocess.call(cmd , shell=True)
-    os.chdir(start_folder)
+    url = record['source']
+    path = cache.fetch(url, record.get('MD5sum'))
+    install_source(path, sourcedir, url.rsplit('/', 1)[1])
 
 def build(specfile, mock_config, mock_resultdir):
     ''' For a given package, build the new version.
@@ -142,36 +74,45 @@ def build(specfile, mock_config, mock_resultdir):
     build = Build()
     build.build(specfile, mock_config=mock_config,
         mock_resultdir=mock_resultdir)
-    build.outcode
+    return build.outcode
 
-def addSpec(package):
-    ''' Add the spec file to the git.
+def setup_parser():
+    ''' Set the command line arguments.
     '''
-    print ' Add to git R-%s.spec' %package
-    cmd = 'git add R-%s.spec'%package
-    print cmd
-    outcode = subprocess.call(cmd , shell=True)
-    return outcode
+    parser = argparse.ArgumentParser()
+    parser.add_argument('outdated',
+        help='File containing the name of the packages to update.')
+    parser.add_argument('specfolder',
+        help='Folder containing the spec files of the R-repo.')
+    parser.add_argument('--mock-config', action='append',
+        help='Mock configuration to build with, can be given several times (defaults to epel-6-i386 and epel-6-x86_64).')
+    parser.add_argument('--spec-workers', type=int, default=2,
+        help='Number of spec files updated at once (defaults to %(default)s).')
+    parser.add_argument('--download-workers', type=int, default=8,
+        help='Number of sources downloaded at once (defaults to %(default)s).')
+    parser.add_argument('--build-workers', type=int, default=2,
+        help='Number of builds run at once (defaults to %(default)s).')
+    parser.add_argument('--queue-size', type=int, default=10,
+        help='Number of packages waiting between two steps, downloads stop getting ahead of the builds past it (defaults to %(default)s).')
+    return parser
 
 def main():
     ''' Main function.
     This function reads the content of the file provided. This file
     should contain the name of the packages to update.
-    Their spec files are updated and build using mock.
+    Their spec files are updated at once, then their sources are
+    downloaded and they are built using mock, each of these two steps
+    running on its own threads so that the sources of the next packages
+    are downloaded while the previous ones build.
     '''
-    if len(sys.argv) < 2:
-        print 'Not enough arguments specified. Usage: python update_rpms.py'\
-        ' outdate_rpms path/to/R-repo-spec_folder'
-        return 1
-    if len(sys.argv) > 3:
-        print 'Too many arguments specified. Usage: python update_rpms.py outdate_rpms'
-        return 2
-
-    if not os.path.exists(sys.argv[1]):
-        print 'The file "%s" could not be found' % sys.argv[1]
+    args = setup_parser().parse_args()
+    mock_configs = args.mock_config or ['epel-6-i386', 'epel-6-x86_64']
+
+    if not os.path.exists(args.outdated):
+        print 'The file "%s" could not be found' % args.outdated
         return 3
 
-    folder = os.path.expanduser(sys.argv[2])
+    folder = os.path.expanduser(args.specfolder)
     if not os.path.exists(folder):
         print 'The file "%s" could not be found' % folder
         return 4
@@ -180,59 +121,90 @@ def main():
         return 5
 
     outdatedlist = []
-    stream = open(sys.argv[1])
-    outdatelist = []
+    stream = open(args.outdated)
     for line in stream.readlines():
-        outdatedlist.append(line.strip())
+        if line.strip():
+            outdatedlist.append(line.strip())
     stream.close()
 
     print '%s packages to update' %len(outdatedlist)
 
-    urls = [
-            'http://www.bioconductor.org/packages/release/data/experiment/src/contrib/PACKAGES',
-            'http://www.bioconductor.org/packages/release/data/annotation/src/contrib/PACKAGES',
-            'http://www.bioconductor.org/packages/release/bioc/src/contrib/PACKAGES',
-            'http://cran-mirror.cs.uu.nl/src/contrib/PACKAGES',
-            'http://cran.at.r-project.org/src/contrib/PACKAGES',
-            'http://r-forge.r-project.org/src/contrib/PACKAGES',
-            ]
-
+    # Use the same repositories, and thus the same cached metadata, as
+    # check_spec_to_update
+    parser = ConfigParser.ConfigParser()
+    parser.read('depgenerator/repos.cfg')
+    index = load_index(get_repos(parser), HttpCache())
     upstream = {}
-    for url in urls:
-        f = urllib.urlopen(url)
-        s = f.read()
-        f.close()
-        upstream = addToKnown( upstream, s.split('\n\n'), url, outdatedlist )
+    for package in outdatedlist:
+        record = index.get(package)
+        if record is not None:
+            upstream[package] = record
+    index.close()
 
     print '%s packages found in the repository' %len(upstream)
 
-    updatefailed = []
-    buildfailed = []
-    ok = []
+    updatefailed = updateSpecs(dict([(package, record['Version'])
+        for package, record in upstream.items()]), folder, args.spec_workers)
+    # Filled by the threads of the stages
+    downloadfailed = set()
+    buildfailed = set()
+    failedlock = threading.Lock()
     mock_resultdir = '/data/mock/results/'
+    sourcedir = get_rpm_tag('_sourcedir')
+    cache = SourceCache()
+
+    def download_step(package):
+        try:
+            downloadSource(upstream[package], cache, sourcedir)
+        except Exception, err:
+            print 'Could not retrieve the sources of %s: %s' % (package, err)
+            with failedlock:
+                downloadfailed.add(package)
+            return []
+        return [(package, mock) for mock in mock_configs]
+
+    def build_step(item):
+        package, mock = item
+        specfile = os.path.join(folder, 'R-%s.spec' % package)
+        try:
+            # Each thread builds in its own mock root
+            mock = prepare_root(mock, threading.current_thread().name)
+            outcode = build(specfile, mock, mock_resultdir)
+        except Exception, err:
+            print 'Could not build %s: %s' % (specfile, err)
+            outcode = 1
+        if outcode:
+            # Both mock configurations of a package may fail at once
+            with failedlock:
+                buildfailed.add(package)
+        return []
+
+    downloads = Queue.Queue(args.queue_size)
+    builds = Queue.Queue(args.queue_size)
+    stages = [
+        Stage('download', download_step, args.download_workers, downloads,
+            builds),
+        Stage('build', build_step, args.build_workers, builds),
+    ]
     for package in outdatedlist:
-        if package != '':
-            version = upstream[package]['version']
-            specfile = folder + 'R-%s.spec' % package
-            code = updateSpec(specfile, version)
-            if code == 1:
-                updatefailed.append(package)
-            downloadSources( upstream[package]['source'].split(
-                'PACKAGES')[0] + '%s_%s.tar.gz' %(package, version) )
-            for mock in ['epel-6-i386', 'epel-6-x86_64']:
-                try:
-                    outcode = build(specfile, mock, mock_resultdir)
-                except:
-                    print 'Could not build %s' % specfile
-                    buildfailed.append(package)
-                    continue
-                if outcode:
-                    buildfailed.append(package)
-                if not code and not outcode:
-                    ok.append(package)
-
+        if package in upstream and package not in updatefailed:
+            downloads.put(package)
+    downloads.put(STOP)
+    for stage in stages:
+        stage.join()
+    # Errors the steps did not expect, the package is not updated either
+    for item, err in stages[0].errors:
+        print 'Could not retrieve the sources of %s: %s' % (item, err)
+        downloadfailed.add(item)
+    for (package, mock), err in stages[1].errors:
+        print 'Could not build %s with %s: %s' % (package, mock, err)
+        buildfailed.add(package)
+
+    ok = [package for package in upstream if package not in updatefailed
+        and package not in downloadfailed and package not in buildfailed]
     print '%s packages were successfully updated' %len(ok)
     print '%s spec failed to be updated' %len(updatefailed)
+    print '%s sources failed to be downloaded' %len(downloadfailed)
     print '%s package failed to be build' %len(buildfailed)
 
 if __name__ == '__main__':